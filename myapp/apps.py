@@ -5,4 +5,9 @@ class ApiConfig(AppConfig):
     name = 'myapp'
 
     def ready(self):
-        import myapp.signals  # Import signals to register them
\ No newline at end of file
+        from django.db.backends.signals import connection_created
+        from .metrics import instrument_connection
+        import myapp.signals  # Import signals to register them
+        import myapp.tasks  # Register background jobs
+        # Per-request query counts, see metrics.py
+        connection_created.connect(instrument_connection)
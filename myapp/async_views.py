@@ -0,0 +1,101 @@
+"""Async GET handlers for the busiest read endpoints.
+
+Under ASGI (myproject/asgi.py sets ASYNC_READ_VIEWS) the article list and
+detail, comment list, category list and user profile views are mounted with
+``as_async_view()``: a GET runs on the event loop and only the database work
+is handed to threads, so a request waiting on the database or on a slow
+client does not hold a worker thread. Other methods, and GETs a view leaves
+to its synchronous code (``async_get_supported()``, e.g. article search),
+run the regular DRF view in a thread.
+
+Django's async ORM (``aget()``, ``async for``) runs every query of a request
+on that request's one thread, one after the other. Reads that do not depend
+on each other, such as an article and the like state of its comments, go
+through ``fetch()`` instead: each runs on a thread of its own, with its own
+connection, and they are awaited together.
+
+The response cache and the auth state are looked up inline; both live in
+local memory unless configured otherwise.
+"""
+import asyncio
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.views.decorators.csrf import csrf_exempt
+
+
+def _closing_connections(func):
+    @wraps(func)
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # Pool threads serve no requests, so nothing else closes their
+            # connections; this keeps CONN_MAX_AGE and pooling in effect
+            close_old_connections()
+    return run
+
+
+async def fetch(func, *args, **kwargs):
+    """Runs ``func`` (synchronous ORM code) on a pool thread and returns its
+    result; several fetches awaited with ``asyncio.gather()`` run at once."""
+    return await sync_to_async(_closing_connections(func), thread_sensitive=False)(*args, **kwargs)
+
+
+async def gather(*awaitables):
+    # Skips the pieces a request does not need (None)
+    pending = [awaitable for awaitable in awaitables if awaitable is not None]
+    results = iter(await asyncio.gather(*pending))
+    return [None if awaitable is None else next(results) for awaitable in awaitables]
+
+
+class AsyncReadMixin:
+    """Lets a DRF view serve GET with ``async def aget()``.
+
+    Views implement ``alist()`` or ``aretrieve()``; the view mixins with a
+    ``get()`` (replica reads, response cache) have an ``aget()`` counterpart.
+    """
+
+    @classmethod
+    def async_get_supported(cls, request):
+        return True
+
+    @classmethod
+    def as_async_view(cls, **initkwargs):
+        sync_view = sync_to_async(cls.as_view(**initkwargs))
+
+        async def view(request, *args, **kwargs):
+            if request.method != 'GET' or not cls.async_get_supported(request):
+                return await sync_view(request, *args, **kwargs)
+            self = cls(**initkwargs)
+            self.setup(request, *args, **kwargs)
+            return await self.async_dispatch(request, *args, **kwargs)
+
+        view.cls = cls
+        view.initkwargs = initkwargs
+        return csrf_exempt(view)
+
+    async def async_dispatch(self, request, *args, **kwargs):
+        # APIView.dispatch() with the handler awaited
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            if 'HTTP_AUTHORIZATION' in request.META:
+                # Token checks may read the database
+                await sync_to_async(self.initial)(request, *args, **kwargs)
+            else:
+                # Anonymous: no authenticator looks anything up
+                self.initial(request, *args, **kwargs)
+            response = await self.aget(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def aget(self, request, *args, **kwargs):
+        if hasattr(self, 'alist'):
+            return await self.alist(request, *args, **kwargs)
+        return await self.aretrieve(request, *args, **kwargs)
@@ -0,0 +1,163 @@
+"""Stateless JWT authentication.
+
+Tokens carry the claims permission checks need (username, is_staff and the
+user's auth version ``ver``), so an authenticated request does not load the
+user row. The only per-request check is that ``ver`` is still the user's
+current auth version, which is cached for ``AUTH_STATE_TTL`` seconds in a
+cache every worker shares (AUTH_STATE_CACHE_ALIAS); a per-process cache
+would let the other workers accept revoked tokens until it expires.
+Making a user admin bumps the version (``revoke_tokens``) and deleting or
+deactivating a user drops the cached state, so older tokens stop working;
+refreshing re-reads the user and issues tokens with up to date claims.
+
+Tokens issued without ``ver`` still authenticate the old way, with a user
+lookup per request.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from .models import UserProfile
+
+VERSION_CLAIM = 'ver'
+# Cached for users that no longer exist or are inactive
+GONE = -1
+
+
+def state_cache():
+    return caches[settings.AUTH_STATE_CACHE_ALIAS]
+
+
+def state_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def auth_version(user):
+    try:
+        return user.profile.auth_version
+    except UserProfile.DoesNotExist:
+        return 0
+
+
+def current_version(user_id):
+    """The user's auth version, or None when they are gone or inactive."""
+    version = state_cache().get(state_key(user_id))
+    if version is None:
+        row = User.objects.filter(pk=user_id, is_active=True).values_list('id', 'profile__auth_version').first()
+        version = GONE if row is None else row[1] or 0
+        state_cache().set(state_key(user_id), version, settings.AUTH_STATE_TTL)
+    return None if version == GONE else version
+
+
+def forget_user_state(user_id):
+    state_cache().delete(state_key(user_id))
+
+
+def revoke_tokens(user_id):
+    # Every token issued to the user so far stops authenticating
+    if not UserProfile.objects.filter(user_id=user_id).update(auth_version=F('auth_version') + 1):
+        UserProfile.objects.create(user_id=user_id, auth_version=1)
+    forget_user_state(user_id)
+
+
+def add_claims(token, user):
+    version = auth_version(user)
+    token['username'] = user.username
+    token['is_staff'] = user.is_staff
+    token[VERSION_CLAIM] = version
+    state_cache().set(state_key(user.pk), version if user.is_active else GONE, settings.AUTH_STATE_TTL)
+    return token
+
+
+def token_for(user):
+    return add_claims(RefreshToken.for_user(user), user)
+
+
+def claims_user(token):
+    # An unsaved-looking User holding only what the token says; enough for
+    # permission checks and for use as a foreign key value
+    user = User(id=int(token[api_settings.USER_ID_CLAIM]), username=token.get('username', ''),
+                is_staff=token.get('is_staff', False), is_active=True)
+    user._state.adding = False
+    user._state.db = DEFAULT_DB_ALIAS
+    user.from_token = True
+    return user
+
+
+def full_user(user):
+    # The complete row (with profile) for views that render the user itself
+    if getattr(user, 'from_token', False):
+        return User.objects.select_related('profile').get(pk=user.pk)
+    return user
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        if VERSION_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        version = current_version(validated_token[api_settings.USER_ID_CLAIM])
+        if version is None:
+            raise AuthenticationFailed('User not found', code='user_not_found')
+        if version != validated_token[VERSION_CLAIM]:
+            raise AuthenticationFailed('Token has been revoked', code='token_revoked')
+        return claims_user(validated_token)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        return add_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        if VERSION_CLAIM not in refresh or current_version(user_id) != refresh[VERSION_CLAIM]:
+            # Old claims: re-read the user and refresh them
+            user = User.objects.select_related('profile').filter(pk=user_id, is_active=True).first()
+            if user is None:
+                raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+            add_claims(refresh, user)
+
+        data = {'access': str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                try:
+                    refresh.blacklist()
+                except AttributeError:
+                    # The token_blacklist app is not installed
+                    pass
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+        return data
+
+
+class UserWithProfileBackend(ModelBackend):
+    """ModelBackend that loads the profile in the same query, so logging in
+    needs no second lookup to render the user."""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User.objects.select_related('profile').get(**{User.USERNAME_FIELD: username})
+        except User.DoesNotExist:
+            # Hash anyway so response times do not reveal which users exist
+            User().set_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
@@ -0,0 +1,209 @@
+"""Helpers shared by the benchmark management commands.
+
+Benchmarks never touch the real database: ``throwaway_database()`` builds a
+fresh, fully migrated database the same way the test runner does, and
+``seed_dataset()`` fills it with realistic data using bulk inserts. Code
+that must not run against real data checks ``in_throwaway_database()``.
+"""
+import itertools
+import random
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+from .counters import reconcile_counters
+from .models import Article, Category, Comment, Like, UserProfile
+from .search import get_backend
+from .trending import recompute_trending
+from .view_counts import view_counts
+
+# NAMEs of the databases throwaway_database() created and has not destroyed
+_throwaway_names = set()
+
+
+@contextmanager
+def throwaway_database(verbosity=0, name=None):
+    # ``name`` picks the database (for SQLite: the file) instead of the
+    # test runner's default, e.g. so that server processes can open it
+    old_name = connection.settings_dict['NAME']
+    test_settings = connection.settings_dict['TEST']
+    old_test_name = test_settings.get('NAME')
+    if name is not None:
+        test_settings['NAME'] = name
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    throwaway_name = connection.settings_dict['NAME']
+    _throwaway_names.add(throwaway_name)
+    try:
+        yield
+    finally:
+        # Article views buffered by the benchmark go away with the database
+        view_counts.clear()
+        _throwaway_names.discard(throwaway_name)
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+        test_settings['NAME'] = old_test_name
+
+
+def in_throwaway_database():
+    return connection.settings_dict['NAME'] in _throwaway_names
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    # Lets seeded rows keep the created_at values we give them
+    fields = [model._meta.get_field('created_at') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def seed_dataset(users=200, categories=10, articles=2000, comments_per_article=10,
+                 thread_depth=4, likes_per_article=10, likes_per_comment=1,
+                 vocabulary_size=None, batch_size=5000, seed=1, stdout=None):
+    """Bulk-insert a realistic dataset and return the row counts per model.
+
+    Articles are spread over the last year, comments form threads up to
+    ``thread_depth`` levels deep, and likes are drawn without duplicates.
+    With ``vocabulary_size`` the text is drawn from that many words with
+    Zipf-like frequencies (``term<n>`` words fill up the vocabulary), so
+    rare and common search terms both exist.
+    Denormalized counters, trending scores and the search index are rebuilt
+    at the end.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    start_user = User.objects.count()
+    User.objects.bulk_create(
+        [User(username=f'bench{start_user + i}', password='!', email=f'bench{start_user + i}@example.com')
+         for i in range(users)], batch_size=batch_size)
+    user_ids = list(User.objects.values_list('id', flat=True))
+    with_profile = set(UserProfile.objects.values_list('user_id', flat=True))
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id, bio='Benchmark user') for user_id in user_ids
+         if user_id not in with_profile], batch_size=batch_size)
+    start_category = Category.objects.count()
+    Category.objects.bulk_create(
+        [Category(name=f'Bench category {start_category + i}') for i in range(categories)])
+    category_ids = list(Category.objects.values_list('id', flat=True))
+    log(f'{len(user_ids)} users, {len(category_ids)} categories')
+
+    words = ('performance index query cache latency thread comment article feed django '
+             'python sqlite signal serializer cursor keyset rank trend media image').split()
+
+    if vocabulary_size:
+        words += [f'term{i}' for i in range(max(0, vocabulary_size - len(words)))]
+        weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+        def text(length):
+            return ' '.join(rng.choices(words, cum_weights=weights, k=length))
+    else:
+        def text(length):
+            return ' '.join(rng.choice(words) for _ in range(length))
+
+    with explicit_timestamps(Article, Comment, Like):
+        article_rows = []
+        for i in range(articles):
+            article_rows.append(Article(
+                title=text(6).capitalize(), thumbnail='thumbnails/bench.png', content=text(120),
+                category_id=rng.choice(category_ids), author_id=rng.choice(user_ids),
+                views=rng.randint(0, 5000), created_at=now - timedelta(seconds=rng.randint(0, 365 * 86400)),
+            ))
+            if len(article_rows) >= batch_size:
+                Article.objects.bulk_create(article_rows)
+                article_rows = []
+        Article.objects.bulk_create(article_rows)
+        articles_created = list(Article.objects.order_by('-id').values_list('id', 'created_at')[:articles])
+        log(f'{len(articles_created)} articles')
+
+        # Comments level by level so every reply can point at a stored parent
+        total_comments = 0
+        parents = [(article_id, None, created_at) for article_id, created_at in articles_created]
+        per_level = max(1, comments_per_article // (thread_depth + 1)) if comments_per_article else 0
+        for level in range(thread_depth + 1):
+            rows = []
+            for article_id, parent_id, created_at in parents:
+                count = per_level if level == 0 else rng.randint(0, 2)
+                for _ in range(count):
+                    rows.append(Comment(
+                        article_id=article_id, parent_id=parent_id, user_id=rng.choice(user_ids),
+                        content=text(20),
+                        created_at=min(now, created_at + timedelta(minutes=rng.randint(1, 600))),
+                    ))
+            created = []
+            for start in range(0, len(rows), batch_size):
+                created += Comment.objects.bulk_create(rows[start:start + batch_size])
+            total_comments += len(created)
+            parents = [(comment.article_id, comment.id, comment.created_at) for comment in created]
+            if not parents:
+                break
+        log(f'{total_comments} comments')
+
+        likes, seen = [], set()
+        for article_id, created_at in articles_created:
+            for user_id in rng.sample(user_ids, min(likes_per_article, len(user_ids))):
+                likes.append(Like(user_id=user_id, article_id=article_id, created_at=created_at))
+        comment_ids = list(Comment.objects.values_list('id', flat=True))
+        for _ in range(int(len(comment_ids) * likes_per_comment)):
+            key = (rng.choice(user_ids), rng.choice(comment_ids))
+            if key not in seen:
+                seen.add(key)
+                likes.append(Like(user_id=key[0], comment_id=key[1], created_at=now))
+        Like.objects.bulk_create(likes, batch_size=batch_size, ignore_conflicts=True)
+        log(f'{len(likes)} likes')
+
+    reconcile_counters()
+    recompute_trending()
+    get_backend().rebuild(Article.objects.all())
+    return {
+        'users': len(user_ids), 'categories': len(category_ids), 'articles': len(articles_created),
+        'comments': total_comments, 'likes': len(likes),
+    }
+
+
+def measure(func, repeat=20, warmup=2):
+    """Run ``func`` repeatedly and return latency percentiles in milliseconds."""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def peak_memory(func):
+    """Run ``func`` under tracemalloc and return its result and the most
+    memory it had allocated at once, in bytes (NumPy buffers included)."""
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def summarize(samples):
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+    return {
+        'count': len(samples), 'mean_ms': round(statistics.fmean(samples), 3),
+        'p50_ms': round(percentile(50), 3), 'p95_ms': round(percentile(95), 3),
+        'p99_ms': round(percentile(99), 3),
+    }
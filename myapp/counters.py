@@ -0,0 +1,69 @@
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from .models import Article, Comment, Like
+from .response_cache import response_cache
+
+
+def _count(queryset, field):
+    # Correlated COUNT(*) of ``queryset`` rows pointing at the outer row
+    counts = (queryset.filter(**{field: OuterRef('pk')}).order_by()
+              .values(field).annotate(total=Count('pk')).values('total'))
+    return Coalesce(Subquery(counts), 0)
+
+
+def adjust(model, pk, field, delta):
+    # Atomic in-place increment; decrements never take a counter below zero
+    if pk is None:
+        return
+    queryset = model.objects.filter(pk=pk)
+    if delta < 0:
+        queryset = queryset.filter(**{f'{field}__gte': -delta})
+    queryset.update(**{field: F(field) + delta})
+
+
+def recount_likes(model, pks):
+    # Used after bulk like changes, which bypass the per-row signals
+    field = 'article' if model is Article else 'comment'
+    model.objects.filter(pk__in=pks).update(like_count=_count(Like.objects.all(), field))
+
+
+def recount_comments(article_ids, parent_ids=()):
+    # Used after bulk comment inserts, which bypass the per-row signals
+    Article.objects.filter(pk__in=article_ids).update(comment_count=_count(Comment.objects.all(), 'article'))
+    if parent_ids:
+        Comment.objects.filter(pk__in=parent_ids).update(reply_count=_count(Comment.objects.all(), 'parent'))
+
+
+def reconcile_counters(chunk_size=10000):
+    """Recompute every denormalized counter from the source tables.
+
+    Works through each table in primary-key ranges of ``chunk_size`` rows,
+    one UPDATE per range and table, so the write lock is only held briefly.
+    Returns the number of rows visited per model.
+    """
+    plans = [
+        (Article, {
+            'like_count': _count(Like.objects.all(), 'article'),
+            'comment_count': _count(Comment.objects.all(), 'article'),
+        }),
+        (Comment, {
+            'like_count': _count(Like.objects.all(), 'comment'),
+            'reply_count': _count(Comment.objects.all(), 'parent'),
+        }),
+    ]
+    visited = {}
+    for model, counters in plans:
+        visited[model.__name__] = 0
+        last_pk = 0
+        while True:
+            pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                model.objects.filter(pk__gte=pks[0], pk__lte=pks[-1]).update(**counters)
+            visited[model.__name__] += len(pks)
+            last_pk = pks[-1]
+    response_cache.invalidate_all()
+    return visited
@@ -0,0 +1,93 @@
+"""Routes the reads of read-only views to database replicas.
+
+Queries run while ``replica_reads()`` is active (ReplicaReadsMixin enters it
+for GET requests of the public list/detail views) go to a random replica
+configured through DATABASE_REPLICA_URLS. Everything else, and every write,
+goes to the primary.
+
+Replicas lag behind, so a client that just wrote is pinned to the primary
+for DATABASE_READ_YOUR_WRITES_SECONDS (ReadYourWritesMiddleware): by cookie,
+and for authenticated users also by a cache entry, since API clients do not
+always keep cookies. Use a shared cache with more than one worker process.
+
+Locally two SQLite files can stand in for primary and replica:
+DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3 and
+``manage.py sync_sqlite_replicas --interval 2`` copying the primary over.
+"""
+import random
+import sqlite3
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+use_replicas = ContextVar('use_replicas', default=False)
+
+PIN_COOKIE = 'db_primary'
+
+
+def replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica_')]
+
+
+@contextmanager
+def replica_reads():
+    token = use_replicas.set(True)
+    try:
+        yield
+    finally:
+        use_replicas.reset(token)
+
+
+def pin_key(user_id):
+    return f'db:pin:{user_id}'
+
+
+def pin_to_primary(request, response):
+    seconds = settings.DATABASE_READ_YOUR_WRITES_SECONDS
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        cache.set(pin_key(user.pk), True, seconds)
+
+
+def pinned_to_primary(request):
+    if PIN_COOKIE in request.COOKIES:
+        return True
+    user = request.user
+    return user.is_authenticated and cache.get(pin_key(user.pk)) is not None
+
+
+def sync_sqlite_replicas():
+    """Copy the SQLite primary over every SQLite replica; returns their aliases."""
+    primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+    synced = []
+    for alias in replica_aliases():
+        replica = settings.DATABASES[alias]
+        if replica['ENGINE'] != primary['ENGINE'] or 'sqlite3' not in replica['ENGINE']:
+            continue
+        source, target = sqlite3.connect(primary['NAME']), sqlite3.connect(replica['NAME'])
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        synced.append(alias)
+    return synced
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if use_replicas.get():
+            replicas = replica_aliases()
+            if replicas:
+                return random.choice(replicas)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
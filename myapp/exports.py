@@ -0,0 +1,237 @@
+"""Streaming exports of articles, comments and users.
+
+Rows are read with a chunked ``.iterator()`` over flat ``values_list``
+queries ordered by id and written out as they arrive, so memory use does
+not depend on the table size. An export can be resumed by passing the id of
+the last row received as ``cursor``. Under ASGI the chunks are handed out
+through ``aiter_chunks()``.
+"""
+import csv
+import json
+from datetime import datetime, time
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.contrib.auth.models import User
+from .models import Article, Comment
+
+
+class ExportError(ValueError):
+    pass
+
+
+class Export:
+    # (column, lookup, type); type is one of int, str, bool, datetime
+    columns = []
+    # Filter name -> lookup; since/until always apply to date_field
+    filters = {}
+    date_field = 'created_at'
+    chunk_size = 2000
+
+    def __init__(self, category=None, author=None, since=None, until=None, cursor=None, chunk_size=None):
+        # Everything is validated up front, before the first byte is sent
+        self.params = {}
+        for name, value in {'category': category, 'author': author}.items():
+            value = parse_int(value, name)
+            if value is not None:
+                if name not in self.filters:
+                    raise ExportError(f'{name} cannot be used to filter {self.name}')
+                self.params[self.filters[name]] = value
+        self.since, self.until = parse_bound(since, 'since'), parse_bound(until, 'until', end=True)
+        self.cursor = parse_int(cursor, 'cursor')
+        self.chunk_size = chunk_size or self.chunk_size
+
+    def queryset(self):
+        queryset = self.model.objects.filter(**self.params).order_by('id')
+        if self.since:
+            queryset = queryset.filter(**{f'{self.date_field}__gte': self.since})
+        if self.until:
+            queryset = queryset.filter(**{f'{self.date_field}__lte': self.until})
+        if self.cursor is not None:
+            queryset = queryset.filter(id__gt=self.cursor)
+        return queryset
+
+    @property
+    def column_names(self):
+        return [column[0] for column in self.columns]
+
+    def rows(self):
+        lookups = [column[1] for column in self.columns]
+        return self.queryset().values_list(*lookups).iterator(chunk_size=self.chunk_size)
+
+    def batches(self):
+        batch = []
+        for row in self.rows():
+            batch.append(row)
+            if len(batch) >= self.chunk_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class ArticleExport(Export):
+    name = 'articles'
+    model = Article
+    columns = [
+        ('id', 'id', 'int'), ('title', 'title', 'str'), ('content', 'content', 'str'),
+        ('thumbnail', 'thumbnail', 'str'), ('category_id', 'category_id', 'int'),
+        ('category', 'category__name', 'str'), ('author_id', 'author_id', 'int'),
+        ('author', 'author__username', 'str'), ('views', 'views', 'int'),
+        ('likes', 'like_count', 'int'), ('comments', 'comment_count', 'int'),
+        ('created_at', 'created_at', 'datetime'), ('updated_at', 'updated_at', 'datetime'),
+    ]
+    filters = {'category': 'category_id', 'author': 'author_id'}
+
+
+class CommentExport(Export):
+    name = 'comments'
+    model = Comment
+    columns = [
+        ('id', 'id', 'int'), ('article_id', 'article_id', 'int'), ('parent_id', 'parent_id', 'int'),
+        ('user_id', 'user_id', 'int'), ('username', 'user__username', 'str'),
+        ('content', 'content', 'str'), ('likes', 'like_count', 'int'),
+        ('replies', 'reply_count', 'int'), ('created_at', 'created_at', 'datetime'),
+    ]
+    filters = {'category': 'article__category_id', 'author': 'user_id'}
+
+
+class UserExport(Export):
+    name = 'users'
+    model = User
+    columns = [
+        ('id', 'id', 'int'), ('username', 'username', 'str'), ('email', 'email', 'str'),
+        ('is_staff', 'is_staff', 'bool'), ('is_active', 'is_active', 'bool'),
+        ('bio', 'profile__bio', 'str'), ('date_joined', 'date_joined', 'datetime'),
+    ]
+    date_field = 'date_joined'
+
+
+EXPORTS = {export.name: export for export in (ArticleExport, CommentExport, UserExport)}
+
+
+def parse_int(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ExportError(f'{name} must be an integer')
+
+
+def parse_bound(value, name, end=False):
+    # Accepts a date (whole day) or an ISO datetime
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ExportError(f'{name} must be an ISO date or datetime')
+        parsed = datetime.combine(day, time.max if end else time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+# Writers turn batches of row tuples into chunks of bytes
+
+def write_ndjson(export):
+    names = export.column_names
+    for batch in export.batches():
+        yield ''.join(json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder) + '\n' for row in batch).encode()
+
+
+class LineBuffer:
+    # csv.writer target that hands back what was written
+    def write(self, value):
+        return value
+
+
+def write_csv(export):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(export.column_names).encode()
+    for batch in export.batches():
+        yield ''.join(writer.writerow(row) for row in batch).encode()
+
+
+class ChunkSink:
+    # Write-only file object pyarrow streams the Parquet file into
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def write_parquet(export):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError('Parquet exports need pyarrow installed')
+
+    types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_(), 'datetime': pa.timestamp('us', tz='UTC')}
+    schema = pa.schema([(name, types[kind]) for name, _, kind in export.columns])
+
+    def generate():
+        sink = ChunkSink()
+        # One row group per batch, sent as soon as it is written
+        with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema) as writer:
+            for batch in export.batches():
+                columns = list(zip(*batch))
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+                yield sink.drain()
+        yield sink.drain()
+    return generate()
+
+
+FORMATS = {
+    'ndjson': (write_ndjson, 'application/x-ndjson'),
+    'csv': (write_csv, 'text/csv'),
+    'parquet': (write_parquet, 'application/vnd.apache.parquet'),
+}
+
+
+def stream_export(resource, file_format='ndjson', **filters):
+    """Returns ``(chunks, content_type)`` for an export; raises ExportError
+    for an unknown resource or format and for invalid filters."""
+    if resource not in EXPORTS:
+        raise ExportError(f'Unknown export {resource!r}, choose from {", ".join(EXPORTS)}')
+    if file_format not in FORMATS:
+        raise ExportError(f'Unknown format {file_format!r}, choose from {", ".join(FORMATS)}')
+    writer, content_type = FORMATS[file_format]
+    return writer(EXPORTS[resource](**filters)), content_type
+
+
+async def aiter_chunks(chunks):
+    # Django's ASGI handler reads a synchronous iterator to the end before
+    # sending any of it; this advances the writer one chunk at a time on
+    # the request's thread, which holds the open cursor's connection
+    advance = sync_to_async(next)
+    try:
+        while (chunk := await advance(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
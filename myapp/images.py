@@ -0,0 +1,136 @@
+"""Resized, re-encoded copies ("derivatives") of uploaded images.
+
+For an upload such as ``thumbnails/shot.png`` every configured format and
+width is stored next to it as ``thumbnails/shot_320w.1a2b3c4d5e6f.webp`` and
+so on, named after a hash of its bytes so media.py can serve it as immutable,
+and the model keeps a ``{format: {width: name}}`` map of what was written so
+serializers can render ``srcset`` strings without touching the storage.
+"""
+import logging
+import os
+from hashlib import md5
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# Pillow format name and file extension per configurable format
+FORMATS = {'webp': ('WEBP', 'webp'), 'jpeg': ('JPEG', 'jpg')}
+
+
+def derivative_name(name, width, fmt, content):
+    root, _ = os.path.splitext(name)
+    # 12 hex digits of MD5, like ManifestStaticFilesStorage
+    digest = md5(content, usedforsecurity=False).hexdigest()[:12]
+    return f'{root}_{width}w.{digest}.{FORMATS[fmt][1]}'
+
+
+def available_formats():
+    formats = [fmt for fmt in settings.IMAGE_DERIVATIVE_FORMATS if fmt in FORMATS]
+    if 'webp' in formats and not features.check('webp'):
+        formats.remove('webp')
+    return formats
+
+
+def encode(image, fmt):
+    pil_format = FORMATS[fmt][0]
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        # No alpha channel in JPEG: flatten onto white
+        background = Image.new('RGB', image.size, 'white')
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+    elif pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+    options = {'method': 4} if pil_format == 'WEBP' else {'optimize': True, 'progressive': True}
+    buffer = BytesIO()
+    image.save(buffer, pil_format, quality=settings.IMAGE_DERIVATIVE_QUALITY, **options)
+    return buffer.getvalue()
+
+
+def render_derivatives(name, widths, storage=None):
+    """Write every derivative of the stored image ``name``; returns the map.
+
+    Widths at or above the original's are skipped (no upscaling); an image
+    smaller than all of them gets a single derivative at its own width.
+    Safe to run in a worker process, it only touches the storage.
+    """
+    storage = storage or default_storage
+    with storage.open(name, 'rb') as source:
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    targets = [width for width in sorted(set(widths)) if width < image.width] or [image.width]
+    derivatives = {}
+    for width in targets:
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for fmt in available_formats():
+            content = encode(resized, fmt)
+            target = derivative_name(name, width, fmt, content)
+            if not storage.exists(target):
+                target = storage.save(target, ContentFile(content))
+            derivatives.setdefault(fmt, {})[str(width)] = target
+    return derivatives
+
+
+def delete_derivatives(derivatives, storage=None, keep=None):
+    # ``keep`` is the map replacing ``derivatives``: names are content
+    # hashes, so re-rendering an image writes some of the same files
+    storage = storage or default_storage
+    kept = {name for names in (keep or {}).values() for name in names.values()}
+    for names in (derivatives or {}).values():
+        for name in names.values():
+            if name not in kept:
+                storage.delete(name)
+
+
+def process_image(instance, field, derivatives_field, widths):
+    """Regenerate the derivatives of ``instance.<field>`` and save the map.
+
+    Old derivatives are removed once the new map is saved, so the stored
+    map never points at deleted files; a file Pillow cannot read leaves the
+    map empty so the original keeps being served.
+    """
+    old = getattr(instance, derivatives_field)
+    derivatives = {}
+    file = getattr(instance, field)
+    if file:
+        try:
+            derivatives = render_derivatives(file.name, widths, file.storage)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            logger.warning('Could not create derivatives of %s', file.name, exc_info=True)
+    setattr(instance, derivatives_field, derivatives)
+    instance.save(update_fields=[derivatives_field])
+    delete_derivatives(old, keep=derivatives)
+    return derivatives
+
+
+def stored_files(file, derivatives):
+    # Names of an image and its derivatives, e.g. to delete them later
+    names = [file.name] if file else []
+    return names + [name for names_by_width in (derivatives or {}).values() for name in names_by_width.values()]
+
+
+def process_thumbnail(article):
+    return process_image(article, 'thumbnail', 'thumbnail_derivatives', settings.THUMBNAIL_DERIVATIVE_WIDTHS)
+
+
+def process_profile_picture(profile):
+    return process_image(profile, 'profile_picture', 'profile_picture_derivatives',
+                         settings.PROFILE_PICTURE_DERIVATIVE_WIDTHS)
+
+
+def srcset(derivatives, build_url):
+    # {'webp': 'https://.../a_320w.webp 320w, ...', 'jpeg': ...} or None
+    if not derivatives:
+        return None
+    return {
+        fmt: ', '.join(f'{build_url(default_storage.url(name))} {width}w'
+                       for width, name in sorted(names.items(), key=lambda item: int(item[0])))
+        for fmt, names in derivatives.items()
+    }
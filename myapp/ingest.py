@@ -0,0 +1,287 @@
+"""Bulk import of articles and comments from NDJSON.
+
+Lines are read lazily and handled in chunks: every row of a chunk is
+validated, its category/author/article references are resolved with one
+query per kind, and the valid rows are written with ``bulk_create`` in one
+transaction per chunk. Invalid rows are reported with their line number
+and never stop the rest of the import.
+"""
+import json
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .counters import recount_comments
+from .jobs import enqueue
+from .models import Article, Category, Comment
+from .response_cache import response_cache
+from .search import get_backend
+from .trending import recompute_trending
+
+
+class Ingest:
+    chunk_size = 1000
+    # Only this many row errors are listed in the report
+    max_reported_errors = 1000
+
+    def __init__(self, default_user=None, create_categories=True, chunk_size=None):
+        self.default_user = default_user
+        self.create_categories = create_categories
+        self.chunk_size = chunk_size or self.chunk_size
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+        # Lookups already answered in earlier chunks
+        self.user_ids = {}
+        self.known_user_ids = set()
+
+    def run(self, lines):
+        chunk = []
+        for number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', errors='replace')
+            if not line.strip():
+                continue
+            chunk.append((number, line))
+            if len(chunk) >= self.chunk_size:
+                self.ingest_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.ingest_chunk(chunk)
+        if self.created:
+            # bulk_create skips the signals
+            response_cache.invalidate_all()
+        return self.report()
+
+    def report(self):
+        return {'created': self.created, 'failed': self.failed, 'errors': self.errors}
+
+    def fail(self, number, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_reported_errors:
+            self.errors.append({'line': number, 'errors': errors})
+
+    def ingest_chunk(self, chunk):
+        rows = []
+        for number, line in chunk:
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                self.fail(number, {'json': str(e)})
+                continue
+            if not isinstance(data, dict):
+                self.fail(number, {'json': 'Each line must be a JSON object'})
+                continue
+            errors = {}
+            row = self.clean(data, errors)
+            if errors:
+                self.fail(number, errors)
+            else:
+                rows.append((number, row))
+
+        rows = self.resolve(rows)
+        if not rows:
+            return
+        try:
+            with transaction.atomic():
+                objects = self.model.objects.bulk_create([self.build(row) for _, row in rows])
+                self.set_timestamps(objects, rows)
+                self.after_create(objects)
+        except DatabaseError as e:
+            for number, _ in rows:
+                self.fail(number, {'database': str(e)})
+            return
+        self.created += len(objects)
+
+    def set_timestamps(self, objects, rows):
+        # created_at is auto_now_add, so given timestamps are written after
+        # the insert; a plain executemany is much cheaper than bulk_update's
+        # CASE expression over a whole chunk
+        dated = []
+        for obj, (_, row) in zip(objects, rows):
+            if row['created_at']:
+                obj.created_at = row['created_at']
+                dated.append((connection.ops.adapt_datetimefield_value(obj.created_at), obj.pk))
+        if dated:
+            with connection.cursor() as cursor:
+                cursor.executemany(f'UPDATE {self.model._meta.db_table} SET created_at = %s WHERE id = %s', dated)
+
+    # Field helpers; each records an error and returns None on bad input
+
+    def text(self, data, errors, name, max_length=None, required=True):
+        value = data.get(name)
+        if value in (None, ''):
+            if required:
+                errors[name] = 'This field is required.'
+            return None
+        if not isinstance(value, str):
+            errors[name] = 'Must be a string.'
+        elif max_length and len(value) > max_length:
+            errors[name] = f'Ensure this field has no more than {max_length} characters.'
+        else:
+            return value
+        return None
+
+    def integer(self, data, errors, name):
+        value = data.get(name)
+        if value in (None, ''):
+            return None
+        if isinstance(value, bool) or not isinstance(value, int):
+            errors[name] = 'Must be an integer.'
+            return None
+        return value
+
+    def timestamp(self, data, errors, name='created_at'):
+        value = data.get(name)
+        if value in (None, ''):
+            return None
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+        if parsed is None:
+            errors[name] = 'Must be an ISO 8601 datetime.'
+            return None
+        return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+    def user_reference(self, data, errors, name):
+        # ``<name>`` is a username, ``<name>_id`` an id; defaults to the
+        # importing user
+        username = self.text(data, errors, name, required=False)
+        user_id = self.integer(data, errors, f'{name}_id')
+        if username is None and user_id is None:
+            if self.default_user is None:
+                errors[name] = f'Give {name} (username) or {name}_id.'
+            return {'user_id': getattr(self.default_user, 'id', None)}
+        return {'username': username, 'user_id': user_id}
+
+    def resolve_users(self, rows, name):
+        usernames = {row[name]['username'] for _, row in rows if row[name].get('username')} - self.user_ids.keys()
+        if usernames:
+            self.user_ids.update(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        user_ids = {row[name]['user_id'] for _, row in rows if row[name].get('user_id')} - self.known_user_ids
+        if user_ids:
+            self.known_user_ids.update(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+        resolved = []
+        for number, row in rows:
+            reference = row[name]
+            if reference.get('username'):
+                user_id = self.user_ids.get(reference['username'])
+                if user_id is None:
+                    self.fail(number, {name: f"Unknown user {reference['username']!r}."})
+                    continue
+            else:
+                user_id = reference['user_id']
+                if user_id not in self.known_user_ids and user_id != getattr(self.default_user, 'id', None):
+                    self.fail(number, {f'{name}_id': f'Unknown user {user_id}.'})
+                    continue
+            row[name] = user_id
+            resolved.append((number, row))
+        return resolved
+
+
+class ArticleIngest(Ingest):
+    """Rows: ``title``, ``content``, ``category`` (name, created when
+    missing) or ``category_id``, ``author`` (username) or ``author_id``,
+    and optional ``thumbnail`` (stored path) and ``created_at``."""
+    model = Article
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.category_ids = {}
+        self.known_category_ids = set()
+
+    def clean(self, data, errors):
+        row = {
+            'title': self.text(data, errors, 'title', 200),
+            'content': self.text(data, errors, 'content'),
+            'thumbnail': self.text(data, errors, 'thumbnail', 100, required=False) or '',
+            'category': self.text(data, errors, 'category', 100, required=False),
+            'category_id': self.integer(data, errors, 'category_id'),
+            'author': self.user_reference(data, errors, 'author'),
+            'created_at': self.timestamp(data, errors),
+        }
+        if row['category'] is None and row['category_id'] is None and 'category' not in errors:
+            errors['category'] = 'Give category (name) or category_id.'
+        return row
+
+    def resolve(self, rows):
+        rows = self.resolve_users(rows, 'author')
+        names = {row['category'] for _, row in rows if row['category']} - self.category_ids.keys()
+        if names:
+            self.category_ids.update(Category.objects.filter(name__in=names).values_list('name', 'id'))
+            missing = names - self.category_ids.keys()
+            if missing and self.create_categories:
+                Category.objects.bulk_create([Category(name=name) for name in missing], ignore_conflicts=True)
+                self.category_ids.update(Category.objects.filter(name__in=missing).values_list('name', 'id'))
+        ids = {row['category_id'] for _, row in rows if row['category_id']} - self.known_category_ids
+        if ids:
+            self.known_category_ids.update(Category.objects.filter(id__in=ids).values_list('id', flat=True))
+
+        resolved = []
+        for number, row in rows:
+            if row['category']:
+                row['category_id'] = self.category_ids.get(row['category'])
+                if row['category_id'] is None:
+                    self.fail(number, {'category': f"Unknown category {row['category']!r}."})
+                    continue
+            elif row['category_id'] not in self.known_category_ids:
+                self.fail(number, {'category_id': f"Unknown category {row['category_id']}."})
+                continue
+            resolved.append((number, row))
+        return resolved
+
+    def build(self, row):
+        return Article(title=row['title'], content=row['content'], thumbnail=row['thumbnail'],
+                       category_id=row['category_id'], author_id=row['author'])
+
+    def after_create(self, articles):
+        get_backend().index(articles)
+        recompute_trending([article.id for article in articles])
+        enqueue('update_recommendations', key='update_recommendations',
+                delay=settings.RECOMMENDATIONS_UPDATE_DELAY)
+
+
+class CommentIngest(Ingest):
+    """Rows: ``article_id``, ``content``, ``user`` (username) or
+    ``user_id``, and optional ``parent_id`` (an already stored comment on
+    the same article) and ``created_at``."""
+    model = Comment
+
+    def clean(self, data, errors):
+        row = {
+            'article_id': self.integer(data, errors, 'article_id'),
+            'parent_id': self.integer(data, errors, 'parent_id'),
+            'content': self.text(data, errors, 'content'),
+            'user': self.user_reference(data, errors, 'user'),
+            'created_at': self.timestamp(data, errors),
+        }
+        if row['article_id'] is None and 'article_id' not in errors:
+            errors['article_id'] = 'This field is required.'
+        return row
+
+    def resolve(self, rows):
+        rows = self.resolve_users(rows, 'user')
+        articles = set(Article.objects.filter(id__in={row['article_id'] for _, row in rows})
+                       .values_list('id', flat=True))
+        parents = dict(Comment.objects.filter(id__in={row['parent_id'] for _, row in rows if row['parent_id']})
+                       .values_list('id', 'article_id'))
+        resolved = []
+        for number, row in rows:
+            if row['article_id'] not in articles:
+                self.fail(number, {'article_id': f"Unknown article {row['article_id']}."})
+            elif row['parent_id'] and parents.get(row['parent_id']) != row['article_id']:
+                self.fail(number, {'parent_id': 'Must be a comment on the same article.'})
+            else:
+                resolved.append((number, row))
+        return resolved
+
+    def build(self, row):
+        return Comment(article_id=row['article_id'], parent_id=row['parent_id'],
+                       user_id=row['user'], content=row['content'])
+
+    def after_create(self, comments):
+        recount_comments({comment.article_id for comment in comments},
+                         {comment.parent_id for comment in comments if comment.parent_id})
+
+
+INGESTS = {'articles': ArticleIngest, 'comments': CommentIngest}
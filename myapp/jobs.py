@@ -0,0 +1,208 @@
+"""Database-backed background jobs.
+
+Request handlers ``enqueue()`` side effects (image processing, deleting
+replaced files, ...) and return; ``manage.py run_jobs`` executes them.
+Jobs are rows in the same database, so one enqueued inside a transaction
+only becomes visible to workers once that transaction commits.
+
+Failed jobs are retried with exponential backoff up to ``max_attempts``
+times; finished jobs are purged after JOB_QUEUE_KEEP_DONE/JOB_QUEUE_KEEP_FAILED
+seconds. Passing ``key`` makes enqueueing idempotent: while a job with that
+key is still queued, enqueueing it again returns the queued job.
+"""
+import logging
+import random
+import statistics
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Min
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    # Registers a function as a job; its arguments must be JSON-serializable
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(name, *args, key=None, delay=0, max_attempts=None):
+    if name not in TASKS:
+        raise KeyError(f'Unknown job {name!r}')
+    job = Job(name=name, args=list(args), key=key,
+              max_attempts=max_attempts or settings.JOB_QUEUE_MAX_ATTEMPTS,
+              run_at=timezone.now() + timedelta(seconds=delay))
+    if key is None:
+        job.save()
+        return job
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        queued = Job.objects.filter(key=key, status=Job.QUEUED).first()
+        if queued is None:
+            # Picked up by a worker in the meantime; this change needs a new run
+            return enqueue(name, *args, key=key, delay=delay, max_attempts=max_attempts)
+        return queued
+    return job
+
+
+def backoff(attempts):
+    # 1x, 2x, 4x, ... the base delay, capped, with jitter so failed jobs
+    # do not all come back at the same moment
+    delay = min(settings.JOB_QUEUE_RETRY_BASE_DELAY * 2 ** (attempts - 1), settings.JOB_QUEUE_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim():
+    """Mark the next due job as running and return it (None when idle).
+
+    Claiming is a conditional UPDATE on the queued status, so when several
+    workers race for the same row only one of them gets it.
+    """
+    now = timezone.now()
+    candidates = (Job.objects.filter(status=Job.QUEUED, run_at__lte=now)
+                  .order_by('run_at').values_list('id', flat=True)[:10])
+    for job_id in candidates:
+        claimed = Job.objects.filter(id=job_id, status=Job.QUEUED).update(
+            status=Job.RUNNING, started_at=now, attempts=F('attempts') + 1)
+        if claimed:
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def run(job):
+    # Returns True when the job succeeded
+    started = time.monotonic()
+    try:
+        TASKS[job.name](*job.args)
+    except Exception as exc:
+        job.last_error = ''.join(traceback.format_exception(exc))[-4000:]
+        if job.attempts < job.max_attempts and job.name in TASKS:
+            job.status = Job.QUEUED
+            job.run_at = timezone.now() + timedelta(seconds=backoff(job.attempts))
+            logger.warning('Job %s failed (attempt %d/%d), retrying', job, job.attempts, job.max_attempts)
+            stats.record('retried')
+        else:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+            logger.error('Job %s failed for good after %d attempts', job, job.attempts)
+            stats.record('failed')
+        try:
+            job.save(update_fields=['status', 'run_at', 'finished_at', 'last_error'])
+        except IntegrityError:
+            # The same key was queued again meanwhile; that job covers the retry
+            Job.objects.filter(id=job.id).update(status=Job.FAILED, finished_at=timezone.now(),
+                                                 last_error=job.last_error)
+        return False
+    job.status = Job.DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+    stats.record('done', run_time=time.monotonic() - started,
+                 latency=(job.finished_at - job.created_at).total_seconds())
+    return True
+
+
+def requeue_stale():
+    # Jobs left running by a worker that died are tried again
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_QUEUE_STALE_AFTER)
+    requeued = 0
+    for job_id in Job.objects.filter(status=Job.RUNNING, started_at__lt=cutoff).values_list('id', flat=True):
+        try:
+            with transaction.atomic():
+                requeued += Job.objects.filter(id=job_id, status=Job.RUNNING).update(status=Job.QUEUED)
+        except IntegrityError:
+            # Its key is queued again already
+            Job.objects.filter(id=job_id).update(status=Job.FAILED, finished_at=timezone.now(),
+                                                 last_error='Abandoned by its worker')
+    return requeued
+
+
+def purge_finished(batch_size=1000):
+    # Finished jobs past their retention, deleted in batches so no single
+    # delete holds the table for long; None keeps them forever
+    now = timezone.now()
+    purged = 0
+    for status, keep in [(Job.DONE, settings.JOB_QUEUE_KEEP_DONE), (Job.FAILED, settings.JOB_QUEUE_KEEP_FAILED)]:
+        if keep is None:
+            continue
+        expired = Job.objects.filter(status=status, finished_at__lt=now - timedelta(seconds=keep))
+        while ids := list(expired.values_list('id', flat=True)[:batch_size]):
+            purged += Job.objects.filter(id__in=ids).delete()[0]
+    return purged
+
+
+def run_pending(limit=None):
+    """Run due jobs in this thread until none are left; returns how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim()
+        if job is None:
+            break
+        run(job)
+        ran += 1
+    return ran
+
+
+class JobStats:
+    """Per-process counters and recent timings of the jobs run here."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.run_times = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def record(self, outcome, run_time=None, latency=None):
+        with self._lock:
+            self.counts[outcome] += 1
+            if run_time is not None:
+                self.run_times.append(run_time)
+                self.latencies.append(latency)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counts': dict(self.counts),
+                'run_time_ms': summarize_seconds(self.run_times),
+                'latency_ms': summarize_seconds(self.latencies),
+            }
+
+
+stats = JobStats()
+
+
+def summarize_seconds(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'mean': round(statistics.fmean(values) * 1000, 3),
+        'p50': round(values[len(values) // 2] * 1000, 3),
+        'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+    }
+
+
+def queue_stats():
+    """Queue depth per status, how overdue the oldest job is and end-to-end
+    latency (enqueue to finish) of recently finished jobs."""
+    depth = dict(Job.objects.values_list('status').annotate(total=Count('id')).order_by())
+    oldest = Job.objects.filter(status=Job.QUEUED, run_at__lte=timezone.now()).aggregate(Min('run_at'))['run_at__min']
+    recent = Job.objects.filter(status=Job.DONE).order_by('-finished_at').values_list(
+        'created_at', 'finished_at')[:1000]
+    return {
+        'depth': {status: depth.get(status, 0) for status, _ in Job.STATUS_CHOICES},
+        'oldest_due_seconds': round((timezone.now() - oldest).total_seconds(), 3) if oldest else 0,
+        'latency_ms': summarize_seconds([(finished - created).total_seconds() for created, finished in recent]),
+    }
@@ -0,0 +1,121 @@
+from django.db import IntegrityError, connections, transaction
+from django.http import Http404
+from .counters import adjust, recount_likes
+from .models import Article, Comment, Like
+from .realtime import publish_likes
+from .response_cache import like_tags, response_cache
+
+TARGETS = {'article_id': Article, 'comment_id': Comment}
+DELTAS = {'article_id': 'article_deltas', 'comment_id': 'comment_deltas'}
+
+
+def _lookup(user, key, target_id):
+    # Article likes have no comment and comment likes have no article
+    other = 'comment_id' if key == 'article_id' else 'article_id'
+    lookup = {'user': user, other: None}
+    if isinstance(target_id, (set, list)):
+        lookup[f'{key}__in'] = target_id
+    else:
+        lookup[key] = target_id
+    return lookup
+
+
+def _delete_likes(lookup):
+    """Delete the matching likes with one plain DELETE and return how many.
+
+    QuerySet.delete() would select the rows first and send post_delete for
+    each; callers adjust the counters, the response cache and subscribers
+    themselves instead, so no signal fires here. The ids are read through a
+    derived table, which MySQL needs to delete from the table it reads.
+    """
+    connection = connections[Like.objects.db]
+    pk = Like._meta.pk.column
+    query = Like.objects.filter(**lookup).values_list(pk, flat=True).query
+    select, params = query.get_compiler(connection=connection).as_sql()
+    table, pk = connection.ops.quote_name(Like._meta.db_table), connection.ops.quote_name(pk)
+    with connection.cursor() as cursor:
+        # doomed.<pk> is qualified so it can never resolve to the outer row
+        cursor.execute(f'DELETE FROM {table} WHERE {pk} IN (SELECT doomed.{pk} FROM ({select}) doomed)', params)
+        return cursor.rowcount
+
+
+def toggle_like(user, key, target_id):
+    """Flip the user's like on one article or comment.
+
+    The existing like is removed with a single DELETE; only when nothing was
+    deleted is a like inserted, so the outcome is decided by one write and
+    concurrent toggles are serialized by the database. Returns the new liked
+    state and the target's like count.
+    """
+    model = TARGETS[key]
+    lookup = _lookup(user, key, target_id)
+    with transaction.atomic():
+        # No post_delete signals: the counter, the response cache and
+        # subscribers are updated here
+        removed = _delete_likes(lookup)
+        if removed:
+            adjust(model, target_id, 'like_count', -removed)
+            response_cache.invalidate(*like_tags(**{f'{model._meta.model_name}_ids': [target_id]}))
+            publish_likes(**{DELTAS[key]: {target_id: -removed}})
+        elif model.objects.filter(pk=target_id).exists():
+            try:
+                with transaction.atomic():
+                    Like.objects.create(**lookup)
+            except IntegrityError:
+                # A concurrent toggle inserted the same like first; the
+                # unique constraint keeps a single row and it stays liked
+                pass
+        else:
+            raise Http404
+        likes = model.objects.filter(pk=target_id).values_list('like_count', flat=True).get()
+    return not removed, likes
+
+
+def apply_likes(user, items):
+    """Apply many like changes for one user in a fixed number of queries.
+
+    ``items`` are ``(key, target_id, liked)`` tuples in request order, where
+    ``liked`` is True/False to set the state or None to toggle it. Returns
+    one result dict per item; unknown targets are reported, not raised.
+    """
+    results = [None] * len(items)
+    with transaction.atomic():
+        for key, model in TARGETS.items():
+            positions = [i for i, item in enumerate(items) if item[0] == key]
+            if not positions:
+                continue
+            target_ids = {items[i][1] for i in positions}
+            found = set(model.objects.filter(pk__in=target_ids).values_list('pk', flat=True))
+            before = set(Like.objects.filter(**_lookup(user, key, found)).values_list(key, flat=True))
+
+            # Replay the changes in order so repeated ids behave as expected
+            state = set(before)
+            for i in positions:
+                target_id, liked = items[i][1], items[i][2]
+                if target_id not in found:
+                    results[i] = {key: target_id, 'error': 'Not found'}
+                    continue
+                if liked is None:
+                    liked = target_id not in state
+                if liked:
+                    state.add(target_id)
+                else:
+                    state.discard(target_id)
+
+            removed, added = before - state, state - before
+            if removed:
+                _delete_likes(_lookup(user, key, removed))
+            if added:
+                Like.objects.bulk_create([Like(**_lookup(user, key, target_id)) for target_id in added],
+                                         ignore_conflicts=True)
+            if removed or added:
+                recount_likes(model, removed | added)
+                response_cache.invalidate(*like_tags(**{f'{model._meta.model_name}_ids': removed | added}))
+                publish_likes(**{DELTAS[key]: {**dict.fromkeys(removed, -1), **dict.fromkeys(added, 1)}})
+
+            counts = dict(model.objects.filter(pk__in=found).values_list('pk', 'like_count'))
+            for i in positions:
+                if results[i] is None:
+                    target_id = items[i][1]
+                    results[i] = {key: target_id, 'liked': target_id in state, 'likes': counts[target_id]}
+    return results
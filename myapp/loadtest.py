@@ -0,0 +1,217 @@
+"""Drives every API route with concurrent clients.
+
+``LoadTest`` resets the passwords of the users it logs in as and creates a
+superuser, so it only runs inside ``throwaway_database()``; the
+``benchmark_api`` command gives it one filled by ``seed_dataset()``. Each scenario sends ``requests`` requests from
+``clients`` threads, every thread with its own test client and database
+connection, and reports latency percentiles, throughput, queries per
+request and response statuses. Nothing leaves the process, so it runs
+offline.
+"""
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter, namedtuple
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.urls import reverse
+from rest_framework.test import APIClient
+from .authentication import token_for
+from .benchmarking import in_throwaway_database, summarize
+from .models import Article, Category, Comment, UserProfile
+
+PASSWORD = 'load-test-password'
+SEARCH_TERMS = ['performance', 'cache query', 'thread', 'serializer keyset']
+
+# One request: ``user`` is the id of the user whose access token is sent,
+# ``format`` 'ndjson' posts ``data`` as a raw NDJSON body
+Call = namedtuple('Call', 'method path data format user', defaults=(None, 'json', None))
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class LoadTest:
+    def __init__(self, clients=8, requests=200, client_users=50, seed=1):
+        self.clients = clients
+        self.requests = requests
+        self.client_users = client_users
+        self.seed = seed
+
+    def prepare(self):
+        """Pick the users that log in and build the pools write scenarios use up."""
+        if not in_throwaway_database():
+            raise RuntimeError('LoadTest changes passwords and creates a superuser; '
+                               'run it inside throwaway_database()')
+        rng = random.Random(self.seed)
+        run = int(time.time())
+        users = list(User.objects.filter(is_staff=False).order_by('id').values_list('id', flat=True))
+        self.user_ids = rng.sample(users, min(self.client_users, len(users)))
+        User.objects.filter(id__in=self.user_ids).update(password=make_password(PASSWORD))
+        self.usernames = dict(User.objects.filter(id__in=self.user_ids).values_list('id', 'username'))
+        admin = User.objects.create_superuser(f'loadtest-admin-{run}', password=PASSWORD)
+        UserProfile.objects.get_or_create(user=admin)
+        self.admin_id = admin.id
+        self.tokens = {user.id: str(token_for(user).access_token)
+                       for user in User.objects.filter(id__in=[*self.user_ids, admin.id])}
+
+        self.article_ids = list(Article.objects.values_list('id', flat=True))
+        self.category_ids = list(Category.objects.values_list('id', flat=True))
+        self.comment_ids = list(Comment.objects.values_list('id', flat=True))
+        self.commented_article_ids = list(Article.objects.filter(comment_count__gt=0).values_list('id', flat=True))
+        self.all_user_ids = users
+
+        # Used up one per request: rotated refresh tokens are blacklisted,
+        # promoted and suspended users cannot be promoted or suspended again
+        self.refresh_tokens = [str(token_for(User.objects.get(id=user_id)))
+                               for user_id in rng.choices(self.user_ids, k=self.requests)]
+        victims = User.objects.bulk_create([User(username=f'loadtest-{run}-{i}', password='!')
+                                            for i in range(2 * self.requests)])
+        self.victim_ids = [user.id for user in User.objects.filter(
+            username__in=[user.username for user in victims])]
+        self.registrations = itertools.count()
+        self.run_id = run
+
+    def scenarios(self):
+        """Scenario name -> (URL name, function building a Call from a Random)."""
+        return {
+            'token_obtain_pair': ('token_obtain_pair', self.obtain_token),
+            'token_refresh': ('token_refresh', lambda rng: Call(
+                'post', reverse('token_refresh'), {'refresh': self.refresh_tokens.pop()})),
+            'register': ('register', self.register),
+            'user_list': ('user_list', lambda rng: Call(
+                'get', f"{reverse('user_list')}?page={rng.randint(1, 5)}", user=self.admin_id)),
+            'profile': ('profile', lambda rng: Call('get', reverse('profile'), user=rng.choice(self.user_ids))),
+            'profile_update': ('profile', lambda rng: Call(
+                'put', reverse('profile'), {'bio': f'Updated {rng.random()}'}, 'multipart',
+                user=rng.choice(self.user_ids))),
+            'category_list': ('category_list', lambda rng: Call('get', reverse('category_list'))),
+            'category_detail': ('category_detail', lambda rng: Call(
+                'get', reverse('category_detail', args=[rng.choice(self.category_ids)]))),
+            'article_list': ('article_list', lambda rng: Call('get', reverse('article_list'))),
+            'article_list_category': ('article_list', lambda rng: Call(
+                'get', f"{reverse('article_list')}?category={rng.choice(self.category_ids)}")),
+            'article_list_trending': ('article_list', lambda rng: Call(
+                'get', f"{reverse('article_list')}?ordering=trending&cursor=")),
+            'article_list_search': ('article_list', lambda rng: Call(
+                'get', f"{reverse('article_list')}?search={rng.choice(SEARCH_TERMS)}")),
+            'article_detail': ('article_detail', lambda rng: Call(
+                'get', reverse('article_detail', args=[rng.choice(self.article_ids)]))),
+            'article_related': ('article_related', lambda rng: Call(
+                'get', reverse('article_related', args=[rng.choice(self.article_ids)]))),
+            'recommendations': ('recommendations', lambda rng: Call(
+                'get', reverse('recommendations'), user=rng.choice(self.user_ids))),
+            'user_profile': ('user_profile', lambda rng: Call(
+                'get', reverse('user_profile', args=[rng.choice(self.all_user_ids)]))),
+            'comment_create': ('comment_create', lambda rng: Call(
+                'post', reverse('comment_create'), {'article': rng.choice(self.article_ids), 'content': 'Load test'},
+                user=rng.choice(self.user_ids))),
+            'comment_detail': ('comment_detail', lambda rng: Call(
+                'get', reverse('comment_detail', args=[rng.choice(self.comment_ids)]), user=rng.choice(self.user_ids))),
+            'comment_list': ('comment_list', lambda rng: Call(
+                'get', f"{reverse('comment_list')}?article={rng.choice(self.commented_article_ids)}")),
+            'like': ('like', lambda rng: Call(
+                'post', reverse('like'), {'article_id': rng.choice(self.article_ids)}, user=rng.choice(self.user_ids))),
+            'make_admin': ('make_admin', lambda rng: Call(
+                'post', reverse('make_admin', args=[self.victim_ids.pop()]), user=self.admin_id)),
+            'suspend_user': ('suspend_user', lambda rng: Call(
+                'post', reverse('suspend_user', args=[self.victim_ids.pop()]), user=self.admin_id)),
+            'export': ('export', lambda rng: Call(
+                'get', f"{reverse('export', args=['articles'])}?category={rng.choice(self.category_ids)}",
+                user=self.admin_id)),
+            'ingest': ('ingest', self.ingest),
+        }
+
+    def obtain_token(self, rng):
+        user_id = rng.choice(self.user_ids)
+        return Call('post', reverse('token_obtain_pair'), {'username': self.usernames[user_id], 'password': PASSWORD})
+
+    def register(self, rng):
+        name = f'loadtest-{self.run_id}-new-{next(self.registrations)}'
+        return Call('post', reverse('register'), {'username': name, 'email': f'{name}@example.com',
+                                                  'password': PASSWORD})
+
+    def ingest(self, rng):
+        rows = [{'title': f'Ingested {i}', 'content': 'Load test body', 'category_id': rng.choice(self.category_ids)}
+                for i in range(10)]
+        body = ''.join(json.dumps(row) + '\n' for row in rows)
+        return Call('post', reverse('ingest', args=['articles']), body, 'ndjson', user=self.admin_id)
+
+    def run(self, only=None, stdout=None):
+        report = {}
+        for name, (route, build) in self.scenarios().items():
+            if only and name not in only:
+                continue
+            report[name] = {'route': route, **self.drive(build)}
+            if stdout is not None:
+                stdout.write(f"{name}: {report[name]['per_second']:.0f} req/s")
+        return report
+
+    def send(self, client, call):
+        extra = {'HTTP_AUTHORIZATION': f'Bearer {self.tokens[call.user]}'} if call.user else {}
+        if call.format == 'ndjson':
+            return client.generic(call.method.upper(), call.path, call.data, 'application/x-ndjson', **extra)
+        if call.method == 'get':
+            return client.get(call.path, **extra)
+        return getattr(client, call.method)(call.path, call.data, format=call.format, **extra)
+
+    def drive(self, build):
+        sent = itertools.count()
+        lock = threading.Lock()
+        latencies, queries, statuses, cache = [], [], Counter(), Counter()
+
+        def worker(seed):
+            rng = random.Random(seed)
+            # A host ALLOWED_HOSTS accepts outside the test runner
+            client = APIClient(raise_request_exception=False, SERVER_NAME='localhost')
+            counter = QueryCounter()
+            samples, counts, codes, hits = [], [], Counter(), Counter()
+            try:
+                with connection.execute_wrapper(counter):
+                    while next(sent) < self.requests:
+                        call = build(rng)
+                        counter.count = 0
+                        started = time.perf_counter()
+                        response = self.send(client, call)
+                        if response.streaming:
+                            b''.join(response.streaming_content)
+                        samples.append((time.perf_counter() - started) * 1000)
+                        response.close()
+                        counts.append(counter.count)
+                        codes[response.status_code] += 1
+                        if 'X-Cache' in response:
+                            hits[response['X-Cache']] += 1
+            finally:
+                connections.close_all()
+                with lock:
+                    latencies.extend(samples)
+                    queries.extend(counts)
+                    statuses.update(codes)
+                    cache.update(hits)
+
+        threads = [threading.Thread(target=worker, args=(self.seed * 1000 + i,)) for i in range(self.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {
+            'requests': len(latencies), 'seconds': round(elapsed, 3),
+            'per_second': round(len(latencies) / elapsed, 1) if elapsed else 0,
+            'latency': summarize(latencies) if latencies else None,
+            'queries': {'mean': round(statistics.fmean(queries), 2), 'max': max(queries)} if queries else None,
+            'statuses': {str(code): count for code, count in sorted(statuses.items())},
+            'errors': sum(count for code, count in statuses.items() if code >= 400),
+            'cache': dict(cache),
+        }
@@ -0,0 +1,62 @@
+import json
+import tempfile
+from contextlib import nullcontext
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from myapp.benchmarking import seed_dataset, throwaway_database
+from myapp.loadtest import LoadTest
+from myapp.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway database and drive every API route with concurrent clients, '
+            'reporting latency percentiles, throughput and queries per request')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--articles', type=int, default=5000)
+        parser.add_argument('--comments-per-article', type=int, default=10)
+        parser.add_argument('--thread-depth', type=int, default=4)
+        parser.add_argument('--likes-per-article', type=int, default=20)
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent client threads')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+        parser.add_argument('--only', nargs='+', metavar='SCENARIO', help='Run only these scenarios')
+        parser.add_argument('--throttle', action='store_true',
+                            help='Keep THROTTLE_RATES; by default every client is let through')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        load_test = LoadTest(clients=options['clients'], requests=options['requests'])
+        unknown = set(options['only'] or []) - set(load_test.scenarios())
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        with throwaway_database(), tempfile.TemporaryDirectory() as directory, \
+                override_settings(RECOMMENDATIONS_DIR=directory):
+            log = None if options['json'] else self.stdout
+            dataset = seed_dataset(users=options['users'], articles=options['articles'],
+                                   comments_per_article=options['comments_per_article'],
+                                   thread_depth=options['thread_depth'],
+                                   likes_per_article=options['likes_per_article'], stdout=log)
+            build_recommendations()
+            load_test.prepare()
+            with nullcontext() if options['throttle'] else override_settings(THROTTLE_RATES={}):
+                scenarios = load_test.run(only=options['only'], stdout=log)
+
+        report = {'dataset': dataset, 'clients': options['clients'], 'requests': options['requests'],
+                  'scenarios': scenarios}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\n{'scenario':<24}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}  statuses"))
+        for name, result in scenarios.items():
+            latency = result['latency'] or {'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0}
+            queries = result['queries'] or {'mean': 0}
+            statuses = ' '.join(f'{code}x{count}' for code, count in result['statuses'].items())
+            line = (f"{name:<24}{result['per_second']:>8.0f}{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}"
+                    f"{latency['p99_ms']:>10.2f}{queries['mean']:>9.1f}  {statuses}")
+            self.stdout.write(self.style.ERROR(line) if result['errors'] else line)
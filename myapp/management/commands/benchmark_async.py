@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+from urllib.parse import unquote
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from myapp.benchmarking import seed_dataset, summarize, throwaway_database
+from myapp.models import Article, Category
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """A fixed number of worker threads, each serving one connection from
+    the moment it is accepted until the response is sent, like gunicorn's
+    sync and gthread workers without a buffering proxy in front."""
+    request_queue_size = 4096
+
+    def __init__(self, address, threads, handler=QuietHandler):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve_wsgi(port, threads, ready, handler=QuietHandler):
+    from django.core.wsgi import get_wsgi_application
+
+    server = PooledWSGIServer(('127.0.0.1', port), threads, handler)
+    server.set_app(get_wsgi_application())
+    ready()
+    server.serve_forever()
+
+
+async def serve_asgi(port, ready):
+    # HTTP/1.1 with one request per connection, enough to drive the ASGI
+    # application the way uvicorn or daphne would
+    from myproject.asgi import application
+
+    async def handle(reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = request_line.split(' ', 2)
+        headers = [(name.strip().lower().encode('latin-1'), value.strip().encode('latin-1'))
+                   for name, value in (line.split(':', 1) for line in header_lines if line)]
+        length = int(dict(headers).get(b'content-length', 0))
+        body = await reader.readexactly(length) if length else b''
+        path, _, query = target.partition('?')
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+            'scheme': 'http', 'path': unquote(path), 'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'), 'root_path': '', 'headers': headers,
+            'server': ('127.0.0.1', port), 'client': writer.get_extra_info('peername')[:2],
+        }
+        finished = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}'.encode('latin-1')]
+                lines += [name + b': ' + value for name, value in message.get('headers', [])]
+                writer.write(b'\r\n'.join(lines + [b'Connection: close', b'', b'']))
+            elif message['type'] == 'http.response.body':
+                writer.write(message.get('body', b''))
+                # A slow reader holds this coroutine only
+                await writer.drain()
+                if not message.get('more_body'):
+                    finished.set()
+
+        try:
+            await application(scope, receive, send)
+        except ConnectionError:
+            pass
+        finally:
+            finished.set()
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+    ready()
+    async with server:
+        await server.serve_forever()
+
+
+async def open_slow_connection(port, window):
+    # A small receive buffer on both the socket and the stream keeps the
+    # kernel from soaking up the response faster than the client reads it
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, window)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    except OSError:
+        sock.close()
+        raise
+    return await asyncio.open_connection(sock=sock, limit=window)
+
+
+async def slow_client(port, paths, deadline, options, results):
+    # Sends each request a few bytes at a time over --send-ms, then reads
+    # the response --read-bytes at a time with --read-pause-ms in between
+    rng = random.Random()
+    while time.monotonic() < deadline:
+        path = rng.choice(paths)
+        request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode()
+        pieces = max(1, options['send_pieces'])
+        step = -(-len(request) // pieces)
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(open_slow_connection(port, options['read_bytes']),
+                                                    options['timeout'])
+            async with asyncio.timeout(options['timeout']):
+                for start in range(0, len(request), step):
+                    if start:
+                        await asyncio.sleep(options['send_ms'] / 1000 / pieces)
+                    writer.write(request[start:start + step])
+                    await writer.drain()
+                status = int((await reader.readline()).split()[1])
+                while await reader.read(options['read_bytes']):
+                    await asyncio.sleep(options['read_pause_ms'] / 1000)
+            writer.close()
+        except (OSError, TimeoutError, ValueError, IndexError):
+            results['errors'] += 1
+            continue
+        results['latencies'].append((time.perf_counter() - started) * 1000)
+        results['statuses'][status] = results['statuses'].get(status, 0) + 1
+
+
+async def drive(port, paths, options):
+    results = {'latencies': [], 'statuses': {}, 'errors': 0}
+    started = time.monotonic()
+    deadline = started + options['duration']
+    await asyncio.gather(*[slow_client(port, paths, deadline, options, results)
+                           for _ in range(options['clients'])])
+    elapsed = time.monotonic() - started
+    return {
+        'requests': len(results['latencies']), 'per_second': round(len(results['latencies']) / elapsed, 1),
+        'latency': summarize(results['latencies']) if results['latencies'] else None,
+        'statuses': {str(code): count for code, count in sorted(results['statuses'].items())},
+        'errors': results['errors'],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway SQLite database and compare the sync WSGI application (a fixed pool of '
+            'worker threads) with the ASGI application (async read views) under many slow clients')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--articles', type=int, default=2000)
+        parser.add_argument('--clients', type=int, default=200, help='Concurrent slow clients')
+        parser.add_argument('--duration', type=float, default=15, help='Seconds each server is driven')
+        parser.add_argument('--threads', type=int, default=16, help='WSGI worker threads')
+        parser.add_argument('--send-ms', type=float, default=200,
+                            help='Time a client takes to send its request')
+        parser.add_argument('--send-pieces', type=int, default=4)
+        parser.add_argument('--read-bytes', type=int, default=4096,
+                            help="Bytes per read, and the size of the client's receive buffer")
+        parser.add_argument('--read-pause-ms', type=float, default=20,
+                            help='Pause between reads; 4096 bytes every 20 ms is about 200 kB/s')
+        parser.add_argument('--timeout', type=float, default=30)
+        parser.add_argument('--cache', action='store_true', help='Keep the response cache on')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+        # Used by the benchmark to start its servers
+        parser.add_argument('--serve', choices=['wsgi', 'asgi'], help=argparse.SUPPRESS)
+        parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['serve']:
+            return self.serve(options)
+        if connection.vendor != 'sqlite':
+            raise CommandError('The server processes share a seeded SQLite file; run with a SQLite DATABASE_URL')
+        log = None if options['json'] else self.stdout
+        with tempfile.TemporaryDirectory() as directory:
+            database = str(Path(directory) / 'benchmark.sqlite3')
+            with throwaway_database(name=database):
+                dataset = seed_dataset(users=options['users'], articles=options['articles'], stdout=log)
+                paths = self.paths()
+                connection.close()
+                report = {'dataset': dataset, 'clients': options['clients'], 'servers': {}}
+                for kind in ['wsgi', 'asgi']:
+                    if log:
+                        log.write(f'Driving the {kind.upper()} server...')
+                    report['servers'][kind] = self.run_server(kind, database, paths, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\n{'server':<8}{'requests':>10}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+            f"{'CPU ms':>8}{'errors':>8}  statuses"))
+        for kind, result in report['servers'].items():
+            latency = result['latency'] or {'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0}
+            statuses = ' '.join(f'{code}x{count}' for code, count in result['statuses'].items())
+            self.stdout.write(f"{kind:<8}{result['requests']:>10}{result['per_second']:>8.0f}"
+                              f"{latency['p50_ms']:>10.2f}{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}"
+                              f"{result['cpu_ms_per_request']:>8.2f}{result['errors']:>8}  {statuses}")
+
+    def paths(self):
+        # The async read endpoints, weighted roughly like real traffic
+        rng = random.Random(1)
+        articles = list(Article.objects.values_list('id', flat=True))
+        users = list(User.objects.values_list('id', flat=True))
+        paths = ['/api/categories/'] * 5
+        paths += [f'/api/articles/?page={rng.randint(1, 20)}' for _ in range(20)]
+        paths += [f'/api/articles/?category={pk}' for pk in Category.objects.values_list('id', flat=True)[:5]]
+        paths += [f'/api/articles/{rng.choice(articles)}/' for _ in range(30)]
+        paths += [f'/api/comments/?article={rng.choice(articles)}' for _ in range(30)]
+        paths += [f'/api/profile/{rng.choice(users)}/' for _ in range(10)]
+        return paths
+
+    def run_server(self, kind, database, paths, options):
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}', DATABASE_REPLICA_URLS='',
+                   ASYNC_READ_VIEWS='True' if kind == 'asgi' else 'False')
+        command = [sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), 'benchmark_async', '--serve', kind,
+                   '--threads', str(options['threads'])]
+        if options['cache']:
+            command.append('--cache')
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+        try:
+            # "listening on <port> <CPU seconds spent starting up>"
+            *_, port, startup = server.stdout.readline().split()
+            result = asyncio.run(drive(int(port), paths, options))
+        finally:
+            server.terminate()
+            server.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # The servers share the machine with the clients, so CPU time per
+        # request compares them more fairly than throughput alone
+        cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime - float(startup)
+        result['cpu_ms_per_request'] = round(cpu * 1000 / max(1, result['requests']), 2)
+        return result
+
+    def serve(self, options):
+        overrides = {'SLOW_REQUEST_THRESHOLD_MS': None}
+        if not options['cache']:
+            overrides['RESPONSE_CACHE_TIMEOUT'] = 0
+        port = options['port'] or free_port()
+
+        def ready():
+            print(f'listening on {port} {time.process_time():.3f}', flush=True)
+
+        with override_settings(**overrides):
+            if options['serve'] == 'wsgi':
+                serve_wsgi(port, options['threads'], ready)
+            else:
+                asyncio.run(serve_asgi(port, ready))
+
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
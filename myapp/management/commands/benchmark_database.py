@@ -0,0 +1,115 @@
+import json
+import random
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections, transaction
+from myapp.benchmarking import seed_dataset, summarize, throwaway_database
+from myapp.models import Article, Comment
+
+# The "before" run uses SQLite's rollback journal and deferred transactions,
+# as Django configures it out of the box
+BASELINE_OPTIONS = {}
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway SQLite database and measure throughput of concurrent readers and '
+            'writers with the default connection settings and with the tuned ones')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=5000)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=4)
+        parser.add_argument('--duration', type=float, default=5, help='Seconds per run')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('This load test compares SQLite settings')
+        tuned_options = connection.settings_dict['OPTIONS']
+        report = {}
+        with throwaway_database():
+            log = None if options['json'] else self.stdout
+            report['dataset'] = seed_dataset(articles=options['articles'], comments_per_article=5,
+                                             thread_depth=1, stdout=log)
+            self.article_ids = list(Article.objects.values_list('id', flat=True))
+            self.user_ids = list(Article.objects.values_list('author_id', flat=True).distinct())
+            try:
+                for name, db_options, journal_mode in [('default', BASELINE_OPTIONS, 'DELETE'),
+                                                       ('tuned', tuned_options, 'WAL')]:
+                    # Worker threads open their connections from these settings;
+                    # the journal mode belongs to the file and is switched here
+                    connections.close_all()
+                    connection.settings_dict['OPTIONS'] = db_options
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+                    report[name] = self.run(options)
+            finally:
+                connections.close_all()
+                connection.settings_dict['OPTIONS'] = tuned_options
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name in ('default', 'tuned'):
+            result = report[name]
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name} ({result["journal_mode"]} journal)'))
+            for kind in ('reads', 'writes'):
+                ops = result[kind]
+                latency = ops['latency'] or {'p50_ms': 0, 'p95_ms': 0}
+                self.stdout.write(f"  {kind}: {ops['per_second']:.0f}/s  p50 {latency['p50_ms']:.2f} ms  "
+                                  f"p95 {latency['p95_ms']:.2f} ms  {ops['errors']} locked errors")
+
+    def run(self, options):
+        stop = threading.Event()
+        results = {'reads': [], 'writes': []}
+        errors = {'reads': 0, 'writes': 0}
+        lock = threading.Lock()
+
+        def worker(kind, operation, seed):
+            rng = random.Random(seed)
+            samples, failed = [], 0
+            try:
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    try:
+                        operation(rng)
+                    except OperationalError:
+                        failed += 1
+                        continue
+                    samples.append((time.perf_counter() - started) * 1000)
+            finally:
+                connections.close_all()
+                with lock:
+                    results[kind] += samples
+                    errors[kind] += failed
+
+        threads = [threading.Thread(target=worker, args=('reads', self.read, i)) for i in range(options['readers'])]
+        threads += [threading.Thread(target=worker, args=('writes', self.write, 1000 + i))
+                    for i in range(options['writers'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['duration'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+        return {'journal_mode': journal_mode, **{kind: {
+            'operations': len(samples), 'per_second': len(samples) / options['duration'],
+            'errors': errors[kind], 'latency': summarize(samples) if samples else None,
+        } for kind, samples in results.items()}}
+
+    def read(self, rng):
+        # The article feed and one article's comments
+        list(Article.objects.select_related('author', 'category').order_by('-created_at', '-id')[:20])
+        list(Comment.objects.filter(article_id=rng.choice(self.article_ids)).order_by('-created_at'))
+
+    def write(self, rng):
+        # Like CommentCreateView: look the article up, then insert (the
+        # signals bump the denormalized counters in the same transaction)
+        with transaction.atomic():
+            article = Article.objects.only('id').get(pk=rng.choice(self.article_ids))
+            Comment.objects.create(article=article, user_id=rng.choice(self.user_ids), content='Load test')
@@ -0,0 +1,87 @@
+import json
+from django.core.management.base import BaseCommand
+from django.db import connection
+from myapp.benchmarking import measure, seed_dataset, throwaway_database
+from myapp.models import Article, Comment, Like
+
+# Indexes and constraints added for the hot paths, dropped for the
+# "before" run, which also gets back the old unique_together index
+NEW_INDEXES = [
+    'article_feed_idx', 'article_category_feed_idx', 'comment_article_idx',
+    'comment_user_idx', 'comment_parent_idx', 'unique_article_like', 'unique_comment_like',
+]
+LEGACY_INDEX = 'CREATE UNIQUE INDEX legacy_like_unique ON myapp_like (user_id, article_id, comment_id)'
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway database and compare query plans and latencies of the '
+            'hot article/comment/like queries with and without the hot-path indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=50000)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--comments-per-article', type=int, default=10)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        with throwaway_database():
+            log = None if options['json'] else self.stdout
+            dataset = seed_dataset(users=options['users'], articles=options['articles'],
+                                   comments_per_article=options['comments_per_article'], stdout=log)
+            queries = self.hot_queries()
+            after = self.run(queries, options['repeat'])
+            with connection.cursor() as cursor:
+                for name in NEW_INDEXES:
+                    cursor.execute(f'DROP INDEX IF EXISTS {name}')
+                cursor.execute(LEGACY_INDEX)
+            before = self.run(queries, options['repeat'])
+
+        report = {'dataset': dataset, 'queries': {
+            name: {'before': before[name], 'after': after[name]} for name in queries
+        }}
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, result in report['queries'].items():
+            old, new = result['before'], result['after']
+            speedup = old['p50_ms'] / new['p50_ms'] if new['p50_ms'] else float('inf')
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{name}'))
+            self.stdout.write(f"  before: p50 {old['p50_ms']:.3f} ms  p95 {old['p95_ms']:.3f} ms")
+            self.stdout.write(f"          {old['plan']}")
+            self.stdout.write(f"  after:  p50 {new['p50_ms']:.3f} ms  p95 {new['p95_ms']:.3f} ms  ({speedup:.1f}x)")
+            self.stdout.write(f"          {new['plan']}")
+
+    def hot_queries(self):
+        # Query shapes issued by ArticleListView, CommentListView and LikeView
+        article = Article.objects.order_by('-comment_count').first()
+        deep = Article.objects.order_by('-created_at', '-id')[Article.objects.count() // 2]
+        comment = Comment.objects.filter(reply_count__gt=0).first()
+        like = Like.objects.filter(article__isnull=False).first()
+        page_ids = list(Article.objects.order_by('-created_at', '-id').values_list('id', flat=True)[:10])
+        comment_ids = list(Comment.objects.filter(article_id__in=page_ids).values_list('id', flat=True))
+        return {
+            'article feed, first page': Article.objects.order_by('-created_at', '-id')[:10],
+            'article feed, keyset page half way down': Article.objects.filter(
+                created_at__lt=deep.created_at).order_by('-created_at', '-id')[:10],
+            'article feed by category': Article.objects.filter(
+                category_id=article.category_id).order_by('-created_at', '-id')[:10],
+            'comments of an article': Comment.objects.filter(article=article).order_by('-created_at'),
+            'comments of a user': Comment.objects.filter(user_id=comment.user_id).order_by('-created_at')[:50],
+            'replies of a comment': Comment.objects.filter(parent=comment).order_by('created_at', 'id')[:20],
+            'comment threads of a page': Comment.objects.filter(
+                article_id__in=page_ids).order_by('parent_id', 'created_at'),
+            'like toggle lookup': Like.objects.filter(
+                user_id=like.user_id, article_id=like.article_id, comment__isnull=True),
+            'liked comments of a page': Like.objects.filter(
+                user_id=like.user_id, comment_id__in=comment_ids, article__isnull=True,
+            ).values_list('comment_id', flat=True),
+        }
+
+    def run(self, queries, repeat):
+        results = {}
+        for name, queryset in queries.items():
+            result = measure(lambda: list(queryset.all()), repeat=repeat)
+            result['plan'] = ' | '.join(queryset.explain().splitlines())
+            results[name] = result
+        return results
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from myapp.benchmarking import seed_dataset, throwaway_database
+from myapp.ingest import ArticleIngest, CommentIngest
+from myapp.models import Article
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway database and time bulk NDJSON ingestion of articles and comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=100000)
+        parser.add_argument('--comments', type=int, default=100000)
+        parser.add_argument('--chunk-size', type=int, default=None)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        with throwaway_database(), tempfile.TemporaryDirectory() as directory:
+            seed_dataset(users=100, categories=0, articles=0, comments_per_article=0, stdout=None)
+            usernames = [f'bench{i}' for i in range(100)]
+            articles = os.path.join(directory, 'articles.ndjson')
+            with open(articles, 'w') as out:
+                for i in range(options['articles']):
+                    out.write(json.dumps({
+                        'title': f'Imported article {i}', 'content': f'Body of imported article {i} ' * 20,
+                        'category': f'Imported category {i % 25}', 'author': usernames[i % len(usernames)],
+                        'created_at': '2024-01-01T12:00:00Z' if i % 2 else None,
+                    }) + '\n')
+            report = {'articles': self.time(ArticleIngest, articles, options)}
+
+            article_ids = list(Article.objects.values_list('id', flat=True)[:1000])
+            comments = os.path.join(directory, 'comments.ndjson')
+            if article_ids:
+                with open(comments, 'w') as out:
+                    for i in range(options['comments']):
+                        out.write(json.dumps({
+                            'article_id': article_ids[i % len(article_ids)], 'content': f'Imported comment {i}',
+                            'user': usernames[i % len(usernames)],
+                        }) + '\n')
+                report['comments'] = self.time(CommentIngest, comments, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for resource, result in report.items():
+            self.stdout.write(f"{resource}: {result['created']} created, {result['failed']} failed in "
+                              f"{result['seconds']:.2f} s ({result['rows_per_second']:.0f} rows/s)")
+
+    def time(self, ingest_class, path, options):
+        started = time.perf_counter()
+        with open(path, 'rb') as lines:
+            result = ingest_class(chunk_size=options['chunk_size']).run(lines)
+        seconds = time.perf_counter() - started
+        return {'created': result['created'], 'failed': result['failed'], 'seconds': round(seconds, 3),
+                'rows_per_second': round(result['created'] / seconds) if seconds else 0}
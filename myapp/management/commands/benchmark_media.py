@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from wsgiref.simple_server import ServerHandler
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import re_path
+from django.views.static import serve as static_serve
+from PIL import Image
+from myapp.benchmarking import summarize
+from .benchmark_async import QuietHandler, free_port, serve_asgi, serve_wsgi
+
+# name: (server, media served by, zero-copy)
+SETUPS = {
+    'static': ('wsgi', 'static() view', True),
+    'copy': ('wsgi', 'MediaMiddleware', False),
+    'sendfile': ('wsgi', 'MediaMiddleware', True),
+    'asgi': ('asgi', 'MediaMiddleware', False),
+}
+
+
+def static_media(request, path):
+    return static_serve(request, path, document_root=settings.MEDIA_ROOT)
+
+
+# What `static(settings.MEDIA_URL, ...)` in myproject/urls.py used to serve,
+# used as the URLconf of the "static" setup
+urlpatterns = [re_path(r'^media/(?P<path>.*)$', static_media)]
+
+
+class SendfileServerHandler(ServerHandler):
+    def sendfile(self):
+        # Like gunicorn: a wsgi.file_wrapper over a real file goes out with
+        # os.sendfile() from its current offset; byte ranges (no fileno) and
+        # other bodies are written by wsgiref as usual
+        try:
+            fileno = self.result.filelike.fileno()
+        except (AttributeError, OSError):
+            return False
+        offset = os.lseek(fileno, 0, os.SEEK_CUR)
+        remaining = os.fstat(fileno).st_size - offset
+        if 'Content-Length' in self.headers:
+            remaining = min(remaining, int(self.headers['Content-Length']))
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        sock = self.request_handler.connection.fileno()
+        while remaining > 0:
+            sent = os.sendfile(sock, fileno, offset, remaining)
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+        return True
+
+
+class SendfileHandler(QuietHandler):
+    def handle(self):
+        # WSGIRequestHandler.handle() with the sendfile-capable handler
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536 or not self.parse_request():
+            return
+        handler = SendfileServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+                                        multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+def write_images(root, count, min_kb, max_kb):
+    # Noise, so the encoded files come out about as large as asked for and
+    # nothing compresses them in transit
+    rng = random.Random(1)
+    directory = Path(root) / 'thumbnails'
+    directory.mkdir(parents=True)
+    names = []
+    for index in range(count):
+        target = rng.randint(min_kb, max_kb) * 1024
+        side = max(16, int((target / 1.5) ** 0.5))
+        image = Image.frombytes('RGB', (side, side), rng.randbytes(side * side * 3))
+        name = f'thumbnails/image{index}_{side}w.{index:012x}.jpg'
+        image.save(Path(root) / name, 'JPEG', quality=90)
+        names.append(name)
+    return names
+
+
+async def download(port, path, headers):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        lines = [f'GET {path} HTTP/1.1', 'Host: 127.0.0.1', 'Connection: close']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        size = 0
+        while chunk := await reader.read(1 << 16):
+            size += len(chunk)
+    finally:
+        writer.close()
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    response_headers = {name.strip().lower(): value.strip()
+                        for name, value in (line.split(':', 1) for line in header_lines if line)}
+    return int(status_line.split()[1]), response_headers, size
+
+
+async def client(port, paths, deadline, options, results):
+    # Downloads random images back to back; --conditional of the requests
+    # revalidate an image this client has already seen
+    rng = random.Random()
+    seen = {}
+    while time.monotonic() < deadline:
+        path = rng.choice(paths)
+        headers = {}
+        if path in seen and rng.random() < options['conditional']:
+            headers = seen[path]
+        elif rng.random() < options['ranges']:
+            headers = {'Range': f'bytes=0-{options["range_bytes"] - 1}'}
+        started = time.perf_counter()
+        try:
+            status, response_headers, size = await asyncio.wait_for(download(port, path, headers),
+                                                                    options['timeout'])
+        except (OSError, TimeoutError, ValueError, IndexError, asyncio.IncompleteReadError):
+            results['errors'] += 1
+            continue
+        results['latencies'].append((time.perf_counter() - started) * 1000)
+        results['bytes'] += size
+        results['statuses'][status] = results['statuses'].get(status, 0) + 1
+        if status == 200:
+            seen[path] = {name: response_headers[key] for name, key in
+                          [('If-None-Match', 'etag'), ('If-Modified-Since', 'last-modified')]
+                          if key in response_headers}
+
+
+async def drive(port, paths, options):
+    results = {'latencies': [], 'statuses': {}, 'bytes': 0, 'errors': 0}
+    started = time.monotonic()
+    deadline = started + options['duration']
+    await asyncio.gather(*[client(port, paths, deadline, options, results) for _ in range(options['clients'])])
+    elapsed = time.monotonic() - started
+    return {
+        'requests': len(results['latencies']), 'per_second': round(len(results['latencies']) / elapsed, 1),
+        'mb_per_second': round(results['bytes'] / elapsed / 2 ** 20, 1),
+        'latency': summarize(results['latencies']) if results['latencies'] else None,
+        'statuses': {str(code): count for code, count in sorted(results['statuses'].items())},
+        'errors': results['errors'],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Write a directory of JPEG thumbnails and measure concurrent downloads of them through the old '
+            'static() view and through MediaMiddleware, with and without sendfile(), and under ASGI')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=200)
+        parser.add_argument('--min-kb', type=int, default=20)
+        parser.add_argument('--max-kb', type=int, default=300)
+        parser.add_argument('--clients', type=int, default=32, help='Concurrent downloading clients')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds each setup is driven')
+        parser.add_argument('--threads', type=int, default=16, help='WSGI worker threads')
+        parser.add_argument('--conditional', type=float, default=0,
+                            help='Share of requests revalidating an image the client has seen (0-1)')
+        parser.add_argument('--ranges', type=float, default=0, help='Share of byte-range requests (0-1)')
+        parser.add_argument('--range-bytes', type=int, default=65536)
+        parser.add_argument('--timeout', type=float, default=30)
+        parser.add_argument('--setups', nargs='+', choices=list(SETUPS), default=list(SETUPS))
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+        # Used by the benchmark to start its servers
+        parser.add_argument('--serve', choices=list(SETUPS), help=argparse.SUPPRESS)
+        parser.add_argument('--media-root', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['serve']:
+            return self.serve(options)
+        log = None if options['json'] else self.stdout
+        with tempfile.TemporaryDirectory() as root:
+            if log:
+                log.write(f"Writing {options['images']} images...")
+            names = write_images(root, options['images'], options['min_kb'], options['max_kb'])
+            sizes = [os.path.getsize(Path(root) / name) for name in names]
+            paths = [settings.MEDIA_URL + name for name in names]
+            report = {'images': len(names), 'average_kb': round(sum(sizes) / len(sizes) / 1024, 1),
+                      'clients': options['clients'], 'setups': {}}
+            for setup in options['setups']:
+                if log:
+                    log.write(f'Driving {setup}...')
+                report['setups'][setup] = self.run_server(setup, root, paths, options)
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"\n{report['images']} images, {report['average_kb']} kB on average, "
+                          f"{report['clients']} clients")
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{'setup':<10}{'requests':>10}{'req/s':>8}{'MB/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+            f"{'CPU ms':>8}{'errors':>8}  statuses"))
+        for setup, result in report['setups'].items():
+            latency = result['latency'] or {'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0}
+            statuses = ' '.join(f'{code}x{count}' for code, count in result['statuses'].items())
+            self.stdout.write(f"{setup:<10}{result['requests']:>10}{result['per_second']:>8.0f}"
+                              f"{result['mb_per_second']:>8.1f}{latency['p50_ms']:>10.2f}"
+                              f"{latency['p95_ms']:>10.2f}{latency['p99_ms']:>10.2f}"
+                              f"{result['cpu_ms_per_request']:>8.2f}{result['errors']:>8}  {statuses}")
+
+    def run_server(self, setup, root, paths, options):
+        command = [sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), 'benchmark_media', '--serve', setup,
+                   '--media-root', root, '--threads', str(options['threads'])]
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        try:
+            # "listening on <port> <CPU seconds spent starting up>"
+            *_, port, startup = server.stdout.readline().split()
+            result = asyncio.run(drive(int(port), paths, options))
+        finally:
+            server.terminate()
+            server.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime - float(startup)
+        result['cpu_ms_per_request'] = round(cpu * 1000 / max(1, result['requests']), 2)
+        return result
+
+    def serve(self, options):
+        kind, _, zero_copy = SETUPS[options['serve']]
+        overrides = {'MEDIA_ROOT': options['media_root'], 'MEDIA_URL': '/media/', 'DEBUG': False,
+                     'SLOW_REQUEST_THRESHOLD_MS': None}
+        if options['serve'] == 'static':
+            overrides.update(MEDIA_SERVE_DIRS=[], ROOT_URLCONF=__name__)
+        port = free_port()
+
+        def ready():
+            print(f'listening on {port} {time.process_time():.3f}', flush=True)
+
+        with override_settings(**overrides):
+            if kind == 'asgi':
+                asyncio.run(serve_asgi(port, ready))
+            else:
+                serve_wsgi(port, options['threads'], ready, SendfileHandler if zero_copy else QuietHandler)
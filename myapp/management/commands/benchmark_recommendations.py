@@ -0,0 +1,64 @@
+import json
+import tempfile
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from myapp.benchmarking import measure, peak_memory, seed_dataset, throwaway_database
+from myapp.models import Article, UserRecommendations
+from myapp.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway database and time the recommendation build: a full build, an update '
+            'after new articles arrive, and reading the stored lists')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--articles', type=int, default=20000)
+        parser.add_argument('--likes-per-article', type=int, default=10)
+        parser.add_argument('--new-articles', type=int, default=100,
+                            help='Articles added before the incremental update')
+        parser.add_argument('--vocabulary', type=int, default=20000)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        log = None if options['json'] else self.stdout
+        with throwaway_database(), tempfile.TemporaryDirectory() as directory, \
+                override_settings(RECOMMENDATIONS_DIR=directory, RESPONSE_CACHE_TIMEOUT=0):
+            report = {'dataset': seed_dataset(
+                users=options['users'], articles=options['articles'], comments_per_article=0,
+                likes_per_article=options['likes_per_article'], likes_per_comment=0,
+                vocabulary_size=options['vocabulary'], stdout=log)}
+            report['full_build'] = self.build(update=False)
+            seed_dataset(users=0, categories=0, articles=options['new_articles'], comments_per_article=0,
+                         likes_per_article=0, likes_per_comment=0, vocabulary_size=options['vocabulary'], seed=2)
+            report['update'] = self.build(update=True)
+
+            client = APIClient(SERVER_NAME='localhost')
+            article = Article.objects.order_by('?').first()
+            client.force_authenticate(User.objects.get(pk=UserRecommendations.objects.values_list(
+                'user_id', flat=True).first()))
+            report['reads'] = {
+                'related articles': measure(lambda: client.get(reverse('article_related', args=[article.id]))),
+                'recommendations': measure(lambda: client.get(reverse('recommendations'))),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name in ('full_build', 'update'):
+            result = report[name]
+            self.stdout.write(
+                f"{name.replace('_', ' ')}: {result['seconds']:.2f}s for {result['scored']} of {result['articles']} "
+                f"articles and {result['users']} users, TF-IDF {result['matrix_mb']:.1f} MB, "
+                f"peak {result['peak_mb']:.1f} MB")
+        for name, result in report['reads'].items():
+            self.stdout.write(f"  {name}: p50 {result['p50_ms']:.2f} ms, p95 {result['p95_ms']:.2f} ms")
+
+    def build(self, update):
+        result, peak = peak_memory(lambda: build_recommendations(update=update))
+        result['matrix_mb'] = round(result.pop('matrix_bytes') / 2 ** 20, 1)
+        result['peak_mb'] = round(peak / 2 ** 20, 1)
+        return result
@@ -0,0 +1,50 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from myapp.benchmarking import measure, seed_dataset, throwaway_database
+from myapp.search import LikeSearchBackend, SQLiteFTSBackend
+
+# Common words, rare words (the term<n> tail of the seeded vocabulary),
+# several words at once and prefixes
+QUERIES = ['performance', 'cache query', 'term4321', 'term250 term900', 'term12', 'thread ser']
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway database and compare article search latency of the '
+            'SQLite FTS5 index against icontains matching')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=50000)
+        parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words in the seeded text')
+        parser.add_argument('--limit', type=int, default=20, help='Results fetched per search')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The FTS5 backend needs SQLite')
+        backends = {'icontains': LikeSearchBackend(), 'fts5': SQLiteFTSBackend()}
+        with throwaway_database():
+            log = None if options['json'] else self.stdout
+            dataset = seed_dataset(articles=options['articles'], comments_per_article=0, thread_depth=0,
+                                   likes_per_article=0, likes_per_comment=0,
+                                   vocabulary_size=options['vocabulary'], stdout=log)
+            results = {}
+            for query in QUERIES:
+                results[query] = {}
+                for name, backend in backends.items():
+                    result = measure(lambda: backend.search(query, options['limit']), repeat=options['repeat'])
+                    result['hits'] = len(backend.search(query, options['limit']))
+                    results[query][name] = result
+
+        report = {'dataset': dataset, 'limit': options['limit'], 'queries': results}
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for query, result in results.items():
+            old, new = result['icontains'], result['fts5']
+            speedup = old['p50_ms'] / new['p50_ms'] if new['p50_ms'] else float('inf')
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n"{query}"'))
+            self.stdout.write(f"  icontains: p50 {old['p50_ms']:.3f} ms  p95 {old['p95_ms']:.3f} ms  {old['hits']} hits")
+            self.stdout.write(f"  fts5:      p50 {new['p50_ms']:.3f} ms  p95 {new['p95_ms']:.3f} ms  "
+                              f"{new['hits']} hits  ({speedup:.1f}x)")
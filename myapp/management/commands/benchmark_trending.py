@@ -0,0 +1,96 @@
+import json
+import time
+from datetime import timedelta
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from myapp.benchmarking import measure, seed_dataset, throwaway_database
+from myapp.models import Article, Category
+from myapp.trending import EPOCH, recompute_trending, trending_scores
+
+
+class Command(BaseCommand):
+    help = ('Fill a throwaway database with articles and time the trending recompute: '
+            'the first full scoring, a pass with nothing to change and one after new engagement')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=1000000)
+        parser.add_argument('--active', type=float, default=0.01,
+                            help='Share of articles that get new likes and views before the last pass')
+        parser.add_argument('--chunk-size', type=int, default=100000)
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(1)
+        chunk_size = options['chunk_size']
+        report = {'articles': options['articles']}
+        with throwaway_database():
+            seed_dataset(users=1000, categories=20, articles=0, comments_per_article=0, likes_per_article=0,
+                         likes_per_comment=0)
+            started = time.perf_counter()
+            self.insert_articles(options['articles'], rng)
+            report['insert_seconds'] = round(time.perf_counter() - started, 3)
+
+            report['first_pass'] = recompute_trending(chunk_size=chunk_size)
+            report['unchanged_pass'] = recompute_trending(chunk_size=chunk_size)
+            ids = np.array(Article.objects.values_list('id', flat=True))
+            active = rng.choice(ids, size=int(len(ids) * options['active']), replace=False)
+            with connection.cursor() as cursor:
+                cursor.executemany('UPDATE myapp_article SET like_count = like_count + %s, views = views + %s '
+                                   'WHERE id = %s',
+                                   [(int(rng.integers(1, 20)), int(rng.integers(10, 500)), int(pk)) for pk in active])
+            report['after_engagement_pass'] = recompute_trending(chunk_size=chunk_size)
+
+            # Scoring alone, the part NumPy does
+            n = options['articles']
+            columns = [rng.integers(0, 5000, n).astype(float) for _ in range(3)]
+            report['scoring_only'] = measure(lambda: trending_scores(*columns, np.full(n, EPOCH)), repeat=5, warmup=1)
+
+            category = Category.objects.first()
+            report['reads'] = {
+                'trending, first page': measure(lambda: list(
+                    Article.objects.order_by('-trending_score', '-id').values_list('id', flat=True)[:20])),
+                'trending in a category': measure(lambda: list(
+                    Article.objects.filter(category=category).order_by('-trending_score', '-id')
+                    .values_list('id', flat=True)[:20])),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{report['articles']} articles inserted in {report['insert_seconds']:.1f}s")
+        for name in ('first_pass', 'unchanged_pass', 'after_engagement_pass'):
+            result = report[name]
+            self.stdout.write(f"  {name.replace('_', ' ')}: {result['seconds']:.2f}s, "
+                              f"{result['updated']} of {result['articles']} scores written")
+        self.stdout.write(f"  NumPy scoring alone: p50 {report['scoring_only']['p50_ms']:.1f} ms")
+        for name, result in report['reads'].items():
+            self.stdout.write(f"  {name}: p50 {result['p50_ms']:.3f} ms")
+
+    def insert_articles(self, count, rng, batch_size=50000):
+        category_ids = np.array(Category.objects.values_list('id', flat=True))
+        user_ids = np.array(User.objects.values_list('id', flat=True))
+        now = timezone.now().replace(tzinfo=None)
+        year = 365 * 86400
+        sql = ('INSERT INTO myapp_article (title, thumbnail, thumbnail_derivatives, content, category_id, '
+               'created_at, updated_at, author_id, views, like_count, comment_count, trending_score) '
+               'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 0)')
+        for start in range(0, count, batch_size):
+            n = min(batch_size, count - start)
+            ages = rng.integers(0, year, n)
+            # Heavy-tailed engagement: most articles get little, a few a lot
+            views = np.minimum(rng.zipf(1.6, n) * 10, 10 ** 6)
+            likes = np.minimum(rng.zipf(1.8, n), 10 ** 5)
+            comments = np.minimum(rng.zipf(2.0, n), 10 ** 4)
+            categories = rng.choice(category_ids, n)
+            authors = rng.choice(user_ids, n)
+            rows = []
+            for i in range(n):
+                created = (now - timedelta(seconds=int(ages[i]))).isoformat(' ')
+                rows.append((f'Article {start + i}', 'thumbnails/bench.png', '{}', 'Benchmark body',
+                             int(categories[i]), created, created, int(authors[i]),
+                             int(views[i]), int(likes[i]), int(comments[i])))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
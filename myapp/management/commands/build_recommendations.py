@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from myapp.benchmarking import peak_memory
+from myapp.recommendations import build_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the related-article lists and every user\'s recommendations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--update', action='store_true',
+                            help='Only score articles added since the last build (full build if there is none)')
+
+    def handle(self, *args, **options):
+        result, peak = peak_memory(lambda: build_recommendations(update=options['update']))
+        self.stdout.write(self.style.SUCCESS(
+            f"Scored {result['scored']} of {result['articles']} articles and {result['users']} users "
+            f"in {result['seconds']:.2f}s; TF-IDF matrix {result['matrix_bytes'] / 2 ** 20:.1f} MB, "
+            f"peak memory {peak / 2 ** 20:.1f} MB"))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from myapp.exports import EXPORTS, FORMATS, ExportError, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Stream articles, comments or users to a file (or stdout) as NDJSON, CSV or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=list(EXPORTS))
+        parser.add_argument('--format', dest='file_format', choices=list(FORMATS), default='ndjson')
+        parser.add_argument('--output', '-o', help='File to write (default: stdout)')
+        parser.add_argument('--category', type=int)
+        parser.add_argument('--author', type=int)
+        parser.add_argument('--since', help='ISO date or datetime')
+        parser.add_argument('--until', help='ISO date or datetime')
+        parser.add_argument('--cursor', type=int, help='Resume after this id')
+        parser.add_argument('--chunk-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        try:
+            chunks, _ = stream_export(
+                options['resource'], options['file_format'], category=options['category'],
+                author=options['author'], since=options['since'], until=options['until'],
+                cursor=options['cursor'], chunk_size=options['chunk_size'],
+            )
+        except ExportError as e:
+            raise CommandError(str(e))
+        output = open(options['output'], 'wb') if options['output'] else getattr(self.stdout, 'buffer', None)
+        if output is None:
+            # Not a real stream (e.g. StringIO in tests): text formats only
+            for chunk in chunks:
+                self.stdout.write(chunk.decode(), ending='')
+            return
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
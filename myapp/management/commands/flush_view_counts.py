@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from myapp.view_counts import view_counts
+
+
+class Command(BaseCommand):
+    help = 'Write buffered article view counts to the database'
+
+    def handle(self, *args, **options):
+        flushed = view_counts.flush()
+        self.stdout.write(self.style.SUCCESS(f'Flushed {flushed} article views'))
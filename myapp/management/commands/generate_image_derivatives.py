@@ -0,0 +1,69 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from myapp.images import delete_derivatives, render_derivatives
+from myapp.models import Article, UserProfile
+from myapp.response_cache import response_cache
+
+# model, image field, derivatives field, widths setting
+TARGETS = [
+    (Article, 'thumbnail', 'thumbnail_derivatives', 'THUMBNAIL_DERIVATIVE_WIDTHS'),
+    (UserProfile, 'profile_picture', 'profile_picture_derivatives', 'PROFILE_PICTURE_DERIVATIVE_WIDTHS'),
+]
+
+
+def render(pk, name, widths):
+    # Runs in a worker process; returns the map instead of touching the database
+    try:
+        return pk, render_derivatives(name, widths), None
+    except Exception as exc:
+        return pk, None, f'{type(exc).__name__}: {exc}'
+
+
+class Command(BaseCommand):
+    help = 'Generate resized image derivatives for existing thumbnails and profile pictures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Worker processes (default: one per CPU)')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate images that already have derivatives')
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            for model, field, derivatives_field, widths_setting in TARGETS:
+                widths = getattr(settings, widths_setting)
+                queryset = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                if not options['force']:
+                    queryset = queryset.filter(**{derivatives_field: {}})
+                rows = {pk: (name, derivatives) for pk, name, derivatives
+                        in queryset.values_list('pk', field, derivatives_field).iterator()}
+                if not rows:
+                    continue
+
+                def save(batch):
+                    # The old files go once the new maps are stored; a row
+                    # that failed or was never reached keeps its old map
+                    model.objects.bulk_update(batch, [derivatives_field])
+                    for instance in batch:
+                        delete_derivatives(rows[instance.pk][1], keep=getattr(instance, derivatives_field))
+                    return len(batch)
+
+                done, failed, batch = 0, 0, []
+                futures = [pool.submit(render, pk, name, widths) for pk, (name, _) in rows.items()]
+                for future in as_completed(futures):
+                    pk, derivatives, error = future.result()
+                    if error:
+                        failed += 1
+                        self.stderr.write(f'{model.__name__} {pk} ({rows[pk][0]}): {error}')
+                        continue
+                    batch.append(model(pk=pk, **{derivatives_field: derivatives}))
+                    if len(batch) >= options['batch_size']:
+                        done, batch = done + save(batch), []
+                done += save(batch)
+                self.stdout.write(self.style.SUCCESS(
+                    f'{model.__name__}: {done} images processed, {failed} failed'))
+        # bulk_update skips the signals
+        response_cache.invalidate_all()
@@ -0,0 +1,37 @@
+import json
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from myapp.ingest import INGESTS
+
+
+class Command(BaseCommand):
+    help = 'Bulk-create articles or comments from an NDJSON file (one JSON object per line)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('resource', choices=list(INGESTS))
+        parser.add_argument('path', help="NDJSON file, or - for stdin")
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows written per transaction')
+        parser.add_argument('--default-author', help='Username used for rows without an author/user')
+        parser.add_argument('--no-create-categories', action='store_true',
+                            help='Reject rows naming a category that does not exist')
+
+    def handle(self, *args, **options):
+        default_user = None
+        if options['default_author']:
+            default_user = User.objects.filter(username=options['default_author']).first()
+            if default_user is None:
+                raise CommandError(f"Unknown user {options['default_author']!r}")
+        ingest = INGESTS[options['resource']](default_user=default_user, chunk_size=options['chunk_size'],
+                                              create_categories=not options['no_create_categories'])
+        if options['path'] == '-':
+            report = ingest.run(sys.stdin)
+        else:
+            try:
+                with open(options['path'], 'rb') as lines:
+                    report = ingest.run(lines)
+            except OSError as e:
+                raise CommandError(str(e))
+        for error in report['errors']:
+            self.stderr.write(f"line {error['line']}: {json.dumps(error['errors'])}")
+        self.stdout.write(f"{report['created']} created, {report['failed']} failed")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from myapp.models import Article
+from myapp.response_cache import response_cache
+from myapp.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the article search index from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        indexed = backend.rebuild(Article.objects.all(), chunk_size=options['chunk_size'])
+        response_cache.invalidate('articles')
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} articles with {type(backend).__name__}'))
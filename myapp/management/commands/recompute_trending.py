@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from myapp.trending import recompute_trending
+
+
+class Command(BaseCommand):
+    help = 'Rescore articles for ?ordering=trending from their views, likes and comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100000)
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep rescoring every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            result = recompute_trending(chunk_size=options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Rescored {result['articles']} articles, {result['updated']} changed, in {result['seconds']:.2f}s"))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from myapp.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized like, comment and reply counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        visited = reconcile_counters(chunk_size=options['chunk_size'])
+        for model, rows in visited.items():
+            self.stdout.write(self.style.SUCCESS(f'Reconciled {rows} {model} rows'))
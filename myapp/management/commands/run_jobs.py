@@ -0,0 +1,99 @@
+import json
+import multiprocessing
+import signal
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from myapp.jobs import claim, purge_finished, queue_stats, requeue_stale, run, stats
+from myapp.trending import schedule_recompute
+
+
+def work(threads, once, poll_interval, stop):
+    """Run jobs on ``threads`` threads until ``stop`` is set (or, with
+    ``once``, until no job is due)."""
+    def loop():
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                job = claim()
+                if job is not None:
+                    run(job)
+                elif once:
+                    break
+                else:
+                    stop.wait(poll_interval)
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=loop, name=f'jobs-{i}', daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def work_in_process(threads, once, poll_interval, stop):
+    # Connections inherited from the parent must not be shared
+    import django
+    django.setup()
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(threads, once, poll_interval, stop)
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help='Worker threads per process')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Worker processes; more than one forks a pool of them')
+        parser.add_argument('--once', action='store_true', help='Exit once no job is due')
+        parser.add_argument('--poll-interval', type=float, default=None)
+        parser.add_argument('--stats-interval', type=float, default=60,
+                            help='Seconds between queue depth/latency log lines, requeueing stale jobs, '
+                                 'purging finished ones and checking the trending job is queued '
+                                 '(0: only at startup)')
+
+    def handle(self, *args, **options):
+        poll_interval = options['poll_interval'] or settings.JOB_QUEUE_POLL_INTERVAL
+        requeue_stale()
+        purge_finished()
+        schedule_recompute()
+        if options['processes'] > 1:
+            stop = multiprocessing.Event()
+            arguments = (options['threads'], options['once'], poll_interval, stop)
+            pool = [multiprocessing.Process(target=work_in_process, args=arguments)
+                    for _ in range(options['processes'])]
+            connections.close_all()
+            for process in pool:
+                process.start()
+            done = lambda: not any(process.is_alive() for process in pool)
+        else:
+            stop = threading.Event()
+            runner = threading.Thread(target=work, args=(options['threads'], options['once'], poll_interval, stop))
+            runner.start()
+            done = lambda: not runner.is_alive()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        interval = options['stats_interval']
+        next_report = time.monotonic() + interval
+        try:
+            while not done():
+                time.sleep(0.2)
+                if interval and time.monotonic() >= next_report:
+                    next_report += interval
+                    requeue_stale()
+                    purge_finished()
+                    schedule_recompute()
+                    self.report()
+        finally:
+            stop.set()
+        self.report()
+
+    def report(self):
+        # Worker timings only cover jobs run in this process
+        self.stdout.write(json.dumps({'queue': queue_stats(), 'worker': stats.snapshot()}))
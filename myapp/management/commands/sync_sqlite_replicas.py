@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from myapp.db_router import sync_sqlite_replicas
+
+
+class Command(BaseCommand):
+    help = ('Copy the SQLite primary database over the SQLite replicas in DATABASE_REPLICA_URLS, '
+            'to try replica routing locally')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep copying every this many seconds (simulated replication lag)')
+
+    def handle(self, *args, **options):
+        while True:
+            synced = sync_sqlite_replicas()
+            if not synced:
+                raise CommandError('No SQLite replica configured (DATABASE_REPLICA_URLS=sqlite:///...)')
+            self.stdout.write(f"Synced {', '.join(synced)}")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
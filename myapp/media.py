@@ -0,0 +1,100 @@
+"""Uploaded images served straight from MEDIA_ROOT.
+
+``MediaMiddleware`` answers GET and HEAD requests under MEDIA_URL for the
+directories in MEDIA_SERVE_DIRS with WhiteNoise's responder, which handles
+If-None-Match/If-Modified-Since (304), single byte ranges (206, or 416 past
+the end) and precompressed ``.br``/``.gz`` siblings chosen by Accept-Encoding.
+On top of what WhiteNoise does for static files:
+
+- the ETag is strong, taken from the bytes rather than the mtime: the hash in
+  the name for derivatives (see images.py), an MD5 of the file otherwise
+- content-hashed names are cached for a year as ``immutable``; other uploads,
+  whose names can come back once deleted, for MEDIA_MAX_AGE seconds
+- the body is a FileResponse over the open file, so WSGI servers whose
+  ``wsgi.file_wrapper`` uses sendfile() (gunicorn) send it without copying it
+  through Python; byte ranges are copied, and under ASGI the file is read
+  in ASYNC_BLOCK_SIZE pieces on a thread
+
+Uploads appear while the server runs, so files are looked up per request;
+the responder of a file is kept until its size, mtime or inode changes,
+which leaves one stat() per request. Under ASGI the lookup, the first hash
+of a file and opening it run on a thread, never on the event loop.
+"""
+import hashlib
+import os
+import posixpath
+import re
+import stat
+from functools import lru_cache
+from urllib.parse import urlsplit
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+from whitenoise.media_types import MediaTypes
+from whitenoise.responders import StaticFile
+
+# thumbnails/shot_320w.1a2b3c4d5e6f.webp
+HASHED_NAME = re.compile(r'\.([0-9a-f]{12})\.\w+$')
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+ASYNC_BLOCK_SIZE = 64 * 1024
+
+media_types = MediaTypes()
+
+
+def file_etag(path):
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, lambda: hashlib.md5(usedforsecurity=False)).hexdigest()
+
+
+async def read_async(file):
+    # Django's ASGI handler would otherwise iterate the file in a thread
+    # 4 kB at a time; the response still closes it
+    read = sync_to_async(file.read, thread_sensitive=False)
+    while chunk := await read(ASYNC_BLOCK_SIZE):
+        yield chunk
+
+
+class MediaFiles:
+    def __init__(self):
+        # Nothing to serve when media lives on another host (a CDN or bucket)
+        served = not urlsplit(settings.MEDIA_URL).netloc
+        self.prefix = settings.MEDIA_URL
+        self.root = str(settings.MEDIA_ROOT)
+        self.directories = tuple(directory.strip('/') + '/'
+                                 for directory in settings.MEDIA_SERVE_DIRS) if served else ()
+        self.responder = lru_cache(maxsize=settings.MEDIA_CACHED_FILES)(self.build_responder)
+
+    def name_for(self, path_info):
+        # The upload a request path asks for, without touching the disk
+        if not self.directories or not path_info.startswith(self.prefix):
+            return None
+        name = path_info[len(self.prefix):]
+        if not name.startswith(self.directories) or posixpath.normpath(name) != name:
+            return None
+        return name
+
+    def find(self, path_info):
+        # The responder for a request path, or None to leave it to the URLconf
+        name = self.name_for(path_info)
+        if name is None:
+            return None
+        try:
+            path = safe_join(self.root, name)
+            info = os.stat(path)
+        except (SuspiciousFileOperation, OSError, ValueError):
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        return self.responder(path, name, info.st_size, info.st_mtime_ns, info.st_ino)
+
+    def build_responder(self, path, name, size, mtime_ns, inode):
+        hashed = HASHED_NAME.search(name)
+        if hashed:
+            etag, cache_control = hashed[1], f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            etag, cache_control = file_etag(path), f'public, max-age={settings.MEDIA_MAX_AGE}'
+        headers = [('Content-Type', media_types.get_type(path)), ('Cache-Control', cache_control),
+                   ('ETag', f'"{etag}"')]
+        return StaticFile(path, headers, {encoding: path + suffix for encoding, suffix in ENCODINGS.items()})
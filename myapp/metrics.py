@@ -0,0 +1,257 @@
+"""Per-route request metrics.
+
+MetricsMiddleware times every request and, through a database execute
+wrapper installed on every connection, counts and times its queries (also
+those an async view runs on other threads). Serializers
+(DynamicFieldsMixin) and the JSON renderer add their own time. The numbers feed Prometheus histograms
+labelled by URL route (served at /metrics) and a ``Server-Timing`` header.
+Requests slower than SLOW_REQUEST_THRESHOLD_MS are logged to
+``myapp.slow_requests`` along with the SQL they ran.
+
+Metrics live in the process that served the request; with several gunicorn
+workers set PROMETHEUS_MULTIPROC_DIR so prometheus_client aggregates them.
+"""
+import hmac
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import REGISTRY, Collector
+from rest_framework.renderers import JSONRenderer
+from .jobs import queue_stats, stats
+from .response_cache import response_cache
+from .throttling import TokenBucketThrottle
+
+slow_logger = logging.getLogger('myapp.slow_requests')
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency',
+                            ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+DB_QUERIES = Histogram('http_request_db_queries', 'Database queries per request',
+                       ['method', 'route'], buckets=QUERY_BUCKETS)
+DB_SECONDS = Histogram('http_request_db_duration_seconds', 'Time spent in database queries per request',
+                       ['method', 'route'], buckets=LATENCY_BUCKETS)
+SERIALIZE_SECONDS = Histogram('http_request_serialize_duration_seconds',
+                              'Time spent in serializers and rendering per request',
+                              ['method', 'route'], buckets=LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_size_bytes', 'Response body size', ['method', 'route'],
+                           buckets=SIZE_BUCKETS)
+SLOW_REQUESTS = Counter('http_slow_requests', 'Requests over SLOW_REQUEST_THRESHOLD_MS', ['method', 'route'])
+IN_PROGRESS = Gauge('http_requests_in_progress', 'Requests being served', multiprocess_mode='livesum')
+
+current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.render_seconds = 0.0
+        self.serializing = False
+        # (sql, milliseconds), kept for the slow request log
+        self.statements = []
+        # Async views run queries on several threads at once
+        self.lock = threading.Lock()
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.queries += 1
+                self.db_seconds += elapsed
+                if len(self.statements) < settings.SLOW_REQUEST_MAX_STATEMENTS:
+                    self.statements.append((sql, round(elapsed * 1000, 3)))
+
+    def server_timing(self, total):
+        return ', '.join([
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.queries} queries"',
+            f'serialize;dur={self.serialize_seconds * 1000:.1f}',
+            f'render;dur={self.render_seconds * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def record_query(execute, sql, params, many, context):
+    # ``current`` follows the request into sync_to_async threads
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.record_query(execute, sql, params, many, context)
+
+
+def instrument_connection(sender, connection, **kwargs):
+    # Connected to connection_created (see apps.py). First in line, so
+    # wrappers added and removed with connection.execute_wrapper() stay
+    # at the end of the list.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+@contextmanager
+def _timed(metrics, field):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(metrics, field, getattr(metrics, field) + time.perf_counter() - started)
+
+
+def serializing():
+    # Times the outermost serializer only; nested ones run inside it
+    metrics = current.get()
+    if metrics is None or metrics.serializing:
+        return nullcontext()
+    return _serializing(metrics)
+
+
+@contextmanager
+def _serializing(metrics):
+    metrics.serializing = True
+    try:
+        with _timed(metrics, 'serialize_seconds'):
+            yield
+    finally:
+        metrics.serializing = False
+
+
+class TimedJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        metrics = current.get()
+        with _timed(metrics, 'render_seconds') if metrics else nullcontext():
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    # The pattern, not the path, so ids do not explode the label set
+    return '/' + match.route if match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            self.stop(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.stop(token)
+        return self.finish(request, response, metrics)
+
+    def start(self):
+        metrics = RequestMetrics()
+        IN_PROGRESS.inc()
+        return metrics, current.set(metrics)
+
+    def stop(self, token):
+        IN_PROGRESS.dec()
+        current.reset(token)
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        method, route = request.method, route_of(request)
+        REQUEST_SECONDS.labels(method, route, response.status_code).observe(total)
+        DB_QUERIES.labels(method, route).observe(metrics.queries)
+        DB_SECONDS.labels(method, route).observe(metrics.db_seconds)
+        SERIALIZE_SECONDS.labels(method, route).observe(metrics.serialize_seconds + metrics.render_seconds)
+        if not response.streaming:
+            RESPONSE_BYTES.labels(method, route).observe(len(response.content))
+        response['Server-Timing'] = metrics.server_timing(total)
+
+        threshold = settings.SLOW_REQUEST_THRESHOLD_MS
+        if threshold is not None and total * 1000 >= threshold:
+            SLOW_REQUESTS.labels(method, route).inc()
+            slow_logger.warning(
+                'Slow request %s %s (%s): %.1f ms, %d queries in %.1f ms\n%s',
+                method, request.get_full_path(), route, total * 1000, metrics.queries, metrics.db_seconds * 1000,
+                '\n'.join(f'  [{ms} ms] {sql}' for sql, ms in metrics.statements),
+            )
+        return response
+
+
+class AppStatsCollector(Collector):
+    """Response cache and job queue numbers, read when /metrics is scraped."""
+
+    def collect(self):
+        cache_stats = response_cache.stats()
+        cache = GaugeMetricFamily('response_cache_events', 'Response cache lookups and invalidations',
+                                  labels=['event'])
+        for event in ('hits', 'misses', 'invalidations'):
+            cache.add_metric([event], cache_stats.get(event, 0))
+        yield cache
+
+        queue = queue_stats()
+        depth = GaugeMetricFamily('job_queue_depth', 'Jobs per status', labels=['status'])
+        for status, count in queue['depth'].items():
+            depth.add_metric([status], count)
+        yield depth
+        yield GaugeMetricFamily('job_queue_oldest_due_seconds', 'How overdue the oldest due job is',
+                                value=queue['oldest_due_seconds'])
+        jobs = GaugeMetricFamily('job_worker_events', 'Jobs run by this process', labels=['outcome'])
+        for outcome, count in stats.snapshot()['counts'].items():
+            jobs.add_metric([outcome], count)
+        yield jobs
+
+    def describe(self):
+        # Keeps registration from calling collect(), which queries the database
+        return []
+
+
+REGISTRY.register(AppStatsCollector())
+
+
+def metrics_view(request):
+    # Prometheus text format for scrapers sending METRICS_TOKEN as a bearer
+    # token; open without one only under DEBUG. A scrape queries the job
+    # table, so clients are throttled by address ('metrics' in THROTTLE_RATES)
+    throttle = TokenBucketThrottle()
+    if not throttle.allow_request(request, metrics_view):
+        return HttpResponse(status=429, headers={'Retry-After': str(math.ceil(throttle.wait()))})
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            return HttpResponse(status=403)
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                 f'Bearer {settings.METRICS_TOKEN}'.encode()):
+        return HttpResponse(status=401)
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(AppStatsCollector())
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics_view.throttle_scope = 'metrics'
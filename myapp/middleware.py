@@ -0,0 +1,99 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from whitenoise import middleware as whitenoise
+from .db_router import pin_to_primary, replica_aliases
+from .media import MediaFiles, read_async
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReadYourWritesMiddleware:
+    # Clients that just wrote read from the primary for a while, see db_router.py
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if self.should_pin(request, response):
+            pin_to_primary(request, response)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if self.should_pin(request, response):
+            # request.user may still have to be loaded
+            await sync_to_async(pin_to_primary)(request, response)
+        return response
+
+    def should_pin(self, request, response):
+        return request.method not in SAFE_METHODS and response.status_code < 400 and replica_aliases()
+
+
+class WhiteNoiseMiddleware(whitenoise.WhiteNoiseMiddleware):
+    # WhiteNoise's own middleware is sync only, which under ASGI would move
+    # every request below it onto a thread; finding a static file is a
+    # dict lookup (a stat with autorefresh), fine on the event loop
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
+
+
+class MediaMiddleware:
+    # Uploaded images, see media.py; anything else under MEDIA_URL falls
+    # through to the URLconf and 404s
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.media = MediaFiles()
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.serve(request)
+        return self.get_response(request) if response is None else response
+
+    async def __acall__(self, request):
+        if self.media.name_for(request.path_info) is None:
+            return await self.get_response(request)
+        # The stat(), hashing a file the first time it is served without a
+        # hash in its name, and opening it all block
+        response = await sync_to_async(self.serve, thread_sensitive=False)(request)
+        if response is None:
+            return await self.get_response(request)
+        if response.file_to_stream is not None:
+            response.streaming_content = read_async(response.file_to_stream)
+        return response
+
+    def serve(self, request):
+        responder = self.media.find(request.path_info)
+        if responder is None:
+            return None
+        return whitenoise.WhiteNoiseMiddleware.serve(responder, request)
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:50
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count(model, field):
+    counts = (model.objects.filter(**{field: OuterRef('pk')}).order_by()
+              .values(field).annotate(total=Count('pk')).values('total'))
+    return Coalesce(Subquery(counts), 0)
+
+
+def populate_counters(apps, schema_editor):
+    Article = apps.get_model('myapp', 'Article')
+    Comment = apps.get_model('myapp', 'Comment')
+    Like = apps.get_model('myapp', 'Like')
+    Article.objects.update(like_count=count(Like, 'article'), comment_count=count(Comment, 'article'))
+    Comment.objects.update(like_count=count(Like, 'comment'), reply_count=count(Comment, 'parent'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_alter_article_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.4 on 2026-10-18 06:54
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def remove_duplicate_likes(apps, schema_editor):
+    # Racing toggles could store the same like twice; keep the oldest row
+    # and recount the affected targets before the constraints go on
+    Article = apps.get_model('myapp', 'Article')
+    Comment = apps.get_model('myapp', 'Comment')
+    Like = apps.get_model('myapp', 'Like')
+    for field, other, model in (('article', 'comment', Article), ('comment', 'article', Comment)):
+        duplicates = (Like.objects.filter(**{f'{other}__isnull': True, f'{field}__isnull': False})
+                      .values('user', field).annotate(keep=Min('id'), total=Count('id'))
+                      .filter(total__gt=1))
+        targets = set()
+        for duplicate in duplicates:
+            Like.objects.filter(user=duplicate['user'], **{field: duplicate[field], f'{other}__isnull': True}) \
+                .exclude(id=duplicate['keep']).delete()
+            targets.add(duplicate[field])
+        if targets:
+            counts = (Like.objects.filter(**{field: OuterRef('pk')}).order_by()
+                      .values(field).annotate(total=Count('pk')).values('total'))
+            model.objects.filter(pk__in=targets).update(like_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_denormalized_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='like',
+            unique_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['created_at', 'id'], name='article_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['category', 'created_at', 'id'], name='article_category_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['article', 'created_at'], name='comment_article_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['user', 'created_at'], name='comment_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent', 'created_at'], name='comment_parent_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(condition=models.Q(('comment__isnull', True)), fields=('user', 'article'), name='unique_article_like'),
+        ),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(condition=models.Q(('article__isnull', True)), fields=('user', 'comment'), name='unique_comment_like'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite-only; other databases use the LIKE search backend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS myapp_article_fts "
+        "USING fts5(title, content, tokenize = 'porter unicode61')"
+    )
+    schema_editor.execute(
+        "INSERT INTO myapp_article_fts (rowid, title, content) "
+        "SELECT id, title, content FROM myapp_article"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS myapp_article_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
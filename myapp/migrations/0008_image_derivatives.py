@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0007_article_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='article',
+            name='thumbnail_derivatives',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_picture_derivatives',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0009_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='auth_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
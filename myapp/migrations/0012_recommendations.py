@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-18 07:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('myapp', '0011_article_trending_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedArticles',
+            fields=[
+                ('article', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='related_articles', serialize=False, to='myapp.article')),
+                ('article_ids', models.JSONField(default=list)),
+                ('scores', models.JSONField(default=list)),
+                ('built_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserRecommendations',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recommendations', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('article_ids', models.JSONField(default=list)),
+                ('scores', models.JSONField(default=list)),
+                ('built_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 08:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0012_recommendations'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', '-finished_at'], name='job_finished_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+import math
+from datetime import datetime, timezone
+from django.db import migrations
+
+# myapp/trending.py's formula with the default TRENDING_WEIGHTS and
+# TRENDING_HALF_LIFE_HOURS as they were when this migration was written, so
+# it backfills the same scores whatever the code or settings say later;
+# `manage.py recompute_trending` brings them in line with those
+WEIGHTS = {'views': 0.05, 'likes': 1.0, 'comments': 2.0}
+HALF_LIFE_HOURS = 36
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+def trending_score(article):
+    engagement = (WEIGHTS['views'] * article.views + WEIGHTS['likes'] * article.like_count
+                  + WEIGHTS['comments'] * article.comment_count)
+    decay = math.log(2) / (HALF_LIFE_HOURS * 3600)
+    return math.log1p(engagement) + (article.created_at.timestamp() - EPOCH) * decay
+
+
+def backfill_trending_scores(apps, schema_editor):
+    # Articles that existed before 0011 were added with a score of 0 and
+    # would rank below every newer one until `manage.py recompute_trending`
+    Article = apps.get_model('myapp', 'Article')
+    articles = Article.objects.using(schema_editor.connection.alias)
+    batch = []
+    for article in articles.only('id', 'views', 'like_count', 'comment_count', 'created_at').order_by('id').iterator():
+        article.trending_score = trending_score(article)
+        batch.append(article)
+        if len(batch) >= 1000:
+            articles.bulk_update(batch, ['trending_score'])
+            batch = []
+    articles.bulk_update(batch, ['trending_score'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0013_job_finished_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_trending_scores, migrations.RunPython.noop),
+    ]
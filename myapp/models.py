@@ -1,10 +1,17 @@
 from django.db import models
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     bio = models.TextField(blank=True, null=True)
     profile_picture = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
+    # Resized copies of the picture, see images.py
+    profile_picture_derivatives = models.JSONField(default=dict, blank=True)
+    # Tokens carrying an older version are rejected, see authentication.py
+    auth_version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"Profile of {self.user.username}"
@@ -16,34 +23,181 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+class ArticleQuerySet(models.QuerySet):
+    def with_related(self):
+        return self.select_related('author__profile', 'category')
+
+    def with_comments(self):
+        comments = Comment.objects.for_listing().order_by('id')
+        return self.prefetch_related(Prefetch('comments', queryset=comments))
+
+    def for_listing(self):
+        # Everything ArticleSerializer touches, in a fixed number of queries
+        return self.with_related().with_comments()
+
+    def for_fields(self, fields):
+        # Only join, prefetch and annotate what the requested fields will read
+        queryset = self
+        if 'author' in fields:
+            queryset = queryset.select_related('author__profile')
+        elif 'author_username' in fields:
+            queryset = queryset.select_related('author')
+        if 'category' in fields or 'category_name' in fields:
+            queryset = queryset.select_related('category')
+        if 'comments' in fields:
+            queryset = queryset.with_comments()
+        if 'content' not in fields:
+            queryset = queryset.defer('content')
+        return queryset
+
 class Article(models.Model):
     title = models.CharField(max_length=200)
     thumbnail = models.ImageField(upload_to='thumbnails/')
+    thumbnail_derivatives = models.JSONField(default=dict, blank=True)
     content = models.TextField()
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     views = models.PositiveIntegerField(default=0)
+    # Denormalized counters, kept in step by the signals in signals.py and
+    # rebuilt by `manage.py reconcile_counters`
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    # Time-decayed engagement (see trending.py), refreshed by
+    # `manage.py recompute_trending`
+    trending_score = models.FloatField(default=0)
+
+    objects = ArticleQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Feed ordering, plain and per category (keyset pages included)
+            models.Index(fields=['created_at', 'id'], name='article_feed_idx'),
+            models.Index(fields=['category', 'created_at', 'id'], name='article_category_feed_idx'),
+            # ?ordering=trending, plain and per category
+            models.Index(fields=['trending_score', 'id'], name='article_trending_idx'),
+            models.Index(fields=['category', 'trending_score', 'id'], name='article_category_trending_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+class CommentQuerySet(models.QuerySet):
+    def for_listing(self):
+        return self.select_related('user__profile')
+
 class Comment(models.Model):
     article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='comments')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='replies')
     created_at = models.DateTimeField(auto_now_add=True)
+    like_count = models.PositiveIntegerField(default=0)
+    reply_count = models.PositiveIntegerField(default=0)
+
+    objects = CommentQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # ?article=, ?user= and ?parent= listings, each sorted by time
+            models.Index(fields=['article', 'created_at'], name='comment_article_idx'),
+            models.Index(fields=['user', 'created_at'], name='comment_user_idx'),
+            models.Index(fields=['parent', 'created_at'], name='comment_parent_idx'),
+        ]
 
     def __str__(self):
         return f"Comment by {self.user.username} on {self.article.title}"
 
+class LikeQuerySet(models.QuerySet):
+    # One query answering "which of these has the user liked" for a whole page
+    def liked_article_ids(self, user, article_ids):
+        if user is None or not user.is_authenticated:
+            return set()
+        liked = self.filter(user=user, article_id__in=article_ids, comment__isnull=True)
+        return set(liked.values_list('article_id', flat=True))
+
+    def liked_comment_ids(self, user, comment_ids):
+        if user is None or not user.is_authenticated:
+            return set()
+        # The isnull condition lets the partial unique index answer this
+        liked = self.filter(user=user, comment_id__in=comment_ids, article__isnull=True)
+        return set(liked.values_list('comment_id', flat=True))
+
 class Like(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     article = models.ForeignKey(Article, on_delete=models.CASCADE, null=True, blank=True)
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = LikeQuerySet.as_manager()
+
     class Meta:
-        unique_together = ('user', 'article', 'comment')
\ No newline at end of file
+        # NULLs never collide in a unique index, so the old three-column
+        # unique_together could not stop duplicate likes; one partial
+        # constraint per kind of like does
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'article'], condition=models.Q(comment__isnull=True),
+                name='unique_article_like',
+            ),
+            models.UniqueConstraint(
+                fields=['user', 'comment'], condition=models.Q(article__isnull=True),
+                name='unique_comment_like',
+            ),
+        ]
+
+
+class RelatedArticles(models.Model):
+    """An article's nearest neighbours, best first (see recommendations.py)."""
+    article = models.OneToOneField(Article, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='related_articles')
+    article_ids = models.JSONField(default=list)
+    scores = models.JSONField(default=list)
+    built_at = models.DateTimeField()
+
+
+class UserRecommendations(models.Model):
+    """Articles recommended to a user from what they liked, best first."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='recommendations')
+    article_ids = models.JSONField(default=list)
+    scores = models.JSONField(default=list)
+    built_at = models.DateTimeField()
+
+
+class Job(models.Model):
+    """A unit of background work, run by `manage.py run_jobs` (see jobs.py)."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list, blank=True)
+    # Idempotency key: at most one queued job per key
+    key = models.CharField(max_length=200, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Workers poll for the next due job
+            models.Index(fields=['status', 'run_at'], name='job_ready_idx'),
+            # Recently finished jobs (queue_stats) and purging old ones
+            models.Index(fields=['status', '-finished_at'], name='job_finished_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status='queued'), name='unique_queued_job_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
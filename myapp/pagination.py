@@ -0,0 +1,127 @@
+import base64
+import binascii
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Keyset ("seek") pagination over ``(created_at, id)``.
+
+    Each page is fetched with ``WHERE (created_at, id) < last seen`` instead
+    of an OFFSET, so deep pages cost the same as the first one and rows
+    inserted while a client scrolls never shift or repeat items. Cursors are
+    opaque tokens; pass ``?cursor=`` (empty) to start. The total ``count``
+    is only computed when asked for with ``?count=true``.
+
+    Views may define ``get_keyset_ordering()`` returning two fields, e.g.
+    ``('created_at', 'id')`` for oldest-first or ``('-trending_score',
+    '-id')``; the default is newest first.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        ordering = view.get_keyset_ordering() if hasattr(view, 'get_keyset_ordering') else self.ordering
+        self.fields = [field.lstrip('-') for field in ordering]
+        position, reverse = self.decode_cursor(request, queryset.model)
+
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+
+        # Walking backwards means flipping both the comparison and the order
+        descending = ordering[0].startswith('-') != reverse
+        if reverse:
+            ordering = [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+        if position is not None:
+            queryset = queryset.filter(self.after(position, descending))
+
+        rows = list(queryset.order_by(*ordering)[:page_size + 1])
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.page = rows
+        return rows
+
+    def after(self, position, descending):
+        first, second = self.fields
+        lookup = 'lt' if descending else 'gt'
+        return (Q(**{f'{first}__{lookup}': position[0]})
+                | Q(**{first: position[0], f'{second}__{lookup}': position[1]}))
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            value, pk, reverse = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            value = model._meta.get_field(self.fields[0]).to_python(value)
+            if value is None:
+                raise ValueError(value)
+            return (value, int(pk)), bool(reverse)
+        except (TypeError, ValueError, ValidationError, UnicodeEncodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        value = getattr(row, self.fields[0])
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        payload = [value, getattr(row, self.fields[1]), reverse]
+        token = base64.urlsafe_b64encode(json.dumps(payload).encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, '')
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        body = {'next': self.get_next_link(), 'previous': self.get_previous_link(), 'results': data}
+        if self.count is not None:
+            body = {'count': self.count, **body}
+        return Response(body)
+
+
+class KeysetPaginationMixin:
+    # Serve keyset pages whenever the client sends ?cursor=, and keep the
+    # view's regular pagination otherwise
+    def get_keyset_ordering(self):
+        return KeysetPagination.ordering
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            params = getattr(self.request, 'query_params', {})
+            if KeysetPagination.cursor_query_param in params:
+                self._paginator = KeysetPagination()
+        return super().paginator
@@ -0,0 +1,180 @@
+"""Live comment and like updates for an article.
+
+Writes publish small events to the article's group on the channel layer
+(CHANNEL_LAYERS: in memory by default, Redis when several processes must
+share it) once their transaction commits:
+
+    {"type": "comment.created" | "comment.updated", "comment": {...}}
+    {"type": "comment.deleted", "comment": {"id": 7, "parent": null}}
+    {"type": "article.deleted", "article": 3}
+    {"type": "likes", "article": 2, "comments": {"17": -1}}
+
+Like events carry count deltas. Each subscriber adds up the ones that arrive
+within REALTIME_LIKE_INTERVAL seconds and gets them as one event, so a burst
+of likes on a hot article costs its subscribers one message per interval.
+
+Clients subscribe with a WebSocket on ``/ws/articles/<id>/`` or with
+Server-Sent Events from ``/api/articles/<id>/events/``; both are served by
+the ASGI application in myproject/asgi.py, outside Django's middleware.
+WebSockets are accepted from REALTIME_ALLOWED_ORIGINS, and the event stream
+answers with the headers CorsMiddleware would add.
+"""
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from functools import partial
+from io import BytesIO
+from asgiref.sync import async_to_sync
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import HttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from .models import Comment
+
+
+def article_group(article_id):
+    return f'article.{article_id}'
+
+
+def send(article_id, event):
+    layer = get_channel_layer()
+    if layer is not None:
+        async_to_sync(layer.group_send)(article_group(article_id), {'type': 'article.event', 'event': event})
+
+
+def publish(article_id, event):
+    # Subscribers only hear about committed writes; a layer that is down
+    # is logged and never fails the request
+    transaction.on_commit(partial(send, article_id, event), robust=True)
+
+
+def comment_event(kind, comment):
+    # Built from the saved row alone; the author is already loaded on the
+    # paths that create comments
+    return {'type': kind, 'comment': {
+        'id': comment.id, 'article': comment.article_id, 'parent': comment.parent_id,
+        'user': {'id': comment.user_id, 'username': comment.user.username},
+        'content': comment.content, 'created_at': comment.created_at.isoformat(),
+        'likes': comment.like_count, 'replies_count': comment.reply_count,
+    }}
+
+
+def publish_likes(article_deltas=None, comment_deltas=None):
+    """Publish like count changes given as {article id: delta} and
+    {comment id: delta}; comments are routed to their article's group."""
+    events = defaultdict(lambda: {'type': 'likes', 'article': 0, 'comments': {}})
+    for article_id, delta in (article_deltas or {}).items():
+        events[article_id]['article'] += delta
+    comment_deltas = {pk: delta for pk, delta in (comment_deltas or {}).items() if delta}
+    if comment_deltas:
+        for comment_id, article_id in Comment.objects.filter(pk__in=comment_deltas).values_list('id', 'article_id'):
+            events[article_id]['comments'][str(comment_id)] = comment_deltas[comment_id]
+    for article_id, event in events.items():
+        if event['article'] or event['comments']:
+            publish(article_id, event)
+
+
+def cors_response(scope):
+    # What CorsMiddleware answers for this request: the preflight response,
+    # or an empty one carrying the CORS headers
+    return CorsMiddleware(lambda request: HttpResponse())(ASGIRequest(scope, BytesIO()))
+
+
+class ArticleEventsMixin(ABC):
+    """Joins the article's group and forwards its events, coalescing likes."""
+
+    async def subscribe(self):
+        self.group = article_group(self.scope['url_route']['kwargs']['pk'])
+        self.likes = Counter()
+        self.comment_likes = Counter()
+        self.flush_task = None
+        await self.channel_layer.group_add(self.group, self.channel_name)
+
+    async def unsubscribe(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.channel_layer.group_discard(self.group, self.channel_name)
+
+    async def article_event(self, message):
+        event = message['event']
+        if event['type'] != 'likes':
+            await self.send_event(event)
+            return
+        self.likes['article'] += event['article']
+        self.comment_likes.update(event['comments'])
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_likes())
+
+    async def flush_likes(self):
+        await asyncio.sleep(settings.REALTIME_LIKE_INTERVAL)
+        self.flush_task = None
+        event = {'type': 'likes', 'article': self.likes['article'],
+                 'comments': {pk: delta for pk, delta in self.comment_likes.items() if delta}}
+        self.likes.clear()
+        self.comment_likes.clear()
+        if event['article'] or event['comments']:
+            await self.send_event(event)
+
+    @abstractmethod
+    async def send_event(self, event):
+        pass
+
+
+class ArticleEventsConsumer(ArticleEventsMixin, AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        await self.subscribe()
+        await self.accept()
+
+    async def disconnect(self, code):
+        await self.unsubscribe()
+
+    async def send_event(self, event):
+        await self.send_json(event)
+
+    @classmethod
+    async def encode_json(cls, content):
+        return json.dumps(content, cls=JSONEncoder)
+
+
+class ArticleEventStream(ArticleEventsMixin, AsyncHttpConsumer):
+    """Server-Sent Events; a comment line every REALTIME_KEEPALIVE seconds
+    keeps proxies from closing an idle stream."""
+
+    async def http_request(self, message):
+        # The response stays open after the request body; the stream ends
+        # when the client goes away (http_disconnect)
+        if message.get('more_body'):
+            return
+        cors = cors_response(self.scope)
+        cors_headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in cors.items()
+                        if name.lower().startswith('access-control-') or name.lower() == 'vary']
+        if self.scope['method'] == 'OPTIONS':
+            await self.send_response(cors.status_code, b'', headers=cors_headers)
+            return
+        await self.subscribe()
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'), (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'), *cors_headers,
+        ])
+        await self.send_body(b': subscribed\n\n', more_body=True)
+        self.keepalive_task = asyncio.create_task(self.keepalive())
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(settings.REALTIME_KEEPALIVE)
+            await self.send_body(b': keepalive\n\n', more_body=True)
+
+    async def disconnect(self):
+        if getattr(self, 'group', None) is not None:
+            self.keepalive_task.cancel()
+            await self.unsubscribe()
+
+    async def send_event(self, event):
+        data = json.dumps(event, cls=JSONEncoder)
+        await self.send_body(f"event: {event['type']}\ndata: {data}\n\n".encode(), more_body=True)
@@ -0,0 +1,293 @@
+"""Related articles and per-user recommendations.
+
+Two article-to-article similarities are blended (RECOMMENDATIONS_LIKE_WEIGHT
+decides how much each counts): the cosine similarity of the sets of users
+who liked two articles, and the cosine similarity of the TF-IDF vectors of
+their title and content. Both are sparse matrix products, computed a block
+of rows at a time so memory stays bounded, and only the best
+RECOMMENDATIONS_TOP_K neighbours of each article are kept (RelatedArticles).
+A user's recommendations add up the neighbour lists of the articles they
+liked, leaving out those already liked (UserRecommendations). Requests read
+one of these rows.
+
+``build_recommendations()`` fits everything from scratch and saves the
+vectorizer and the TF-IDF matrix to RECOMMENDATIONS_DIR. With ``update=True``
+(the job queued when articles are added) only articles missing from the
+saved matrix are vectorized and scored against all others, each joins
+the lists of its own neighbours, and only users who liked an article whose
+list changed get their recommendations rebuilt. Like similarities of older
+articles wait for the next full build.
+"""
+import pickle
+import time
+from collections import defaultdict
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+from .models import Article, Like, RelatedArticles, UserRecommendations
+from .response_cache import response_cache
+
+# Cells of the dense similarity block scored at once (float32)
+BLOCK_CELLS = 8_000_000
+# Ids per IN (...) lookup
+ID_BATCH = 10000
+
+
+def state_paths():
+    directory = Path(settings.RECOMMENDATIONS_DIR)
+    return directory / 'vectorizer.pickle', directory / 'tfidf.npz', directory / 'article_ids.npy'
+
+
+def save_state(vectorizer, tfidf, article_ids):
+    vectorizer_path, matrix_path, ids_path = state_paths()
+    vectorizer_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(vectorizer_path, 'wb') as f:
+        pickle.dump(vectorizer, f)
+    sparse.save_npz(matrix_path, tfidf, compressed=False)
+    np.save(ids_path, article_ids)
+
+
+def load_state():
+    vectorizer_path, matrix_path, ids_path = state_paths()
+    if not all(path.exists() for path in state_paths()):
+        return None
+    with open(vectorizer_path, 'rb') as f:
+        vectorizer = pickle.load(f)
+    return vectorizer, sparse.load_npz(matrix_path).tocsr(), np.load(ids_path)
+
+
+def article_texts(ids=None):
+    def rows(queryset):
+        return queryset.order_by('id').values_list('id', 'title', 'content').iterator(chunk_size=5000)
+
+    if ids is None:
+        chunks = [rows(Article.objects.all())]
+    else:
+        chunks = [rows(Article.objects.filter(id__in=ids[start:start + ID_BATCH]))
+                  for start in range(0, len(ids), ID_BATCH)]
+    article_ids, texts = [], []
+    for chunk in chunks:
+        for pk, title, content in chunk:
+            article_ids.append(pk)
+            # The title counts twice
+            texts.append(f'{title} {title} {content}')
+    return np.array(article_ids, dtype=np.int64), texts
+
+
+def like_matrix(article_ids, user_ids=None):
+    """Users x articles, 1 where the user liked the article, and the user ids
+    (all users with a like, or those of ``user_ids`` that have one)."""
+    columns = {pk: i for i, pk in enumerate(article_ids.tolist())}
+    likes = Like.objects.filter(article__isnull=False)
+    if user_ids is None:
+        querysets = [likes]
+    else:
+        querysets = [likes.filter(user_id__in=user_ids[start:start + ID_BATCH])
+                     for start in range(0, len(user_ids), ID_BATCH)]
+    pairs = [(user_id, columns[article_id]) for queryset in querysets for user_id, article_id in
+             queryset.values_list('user_id', 'article_id').iterator(chunk_size=20000)
+             if article_id in columns]
+    user_ids = np.array(sorted({user_id for user_id, _ in pairs}), dtype=np.int64)
+    rows = np.searchsorted(user_ids, [user_id for user_id, _ in pairs])
+    likes = sparse.csr_matrix((np.ones(len(pairs), dtype=np.float32), (rows, [column for _, column in pairs])),
+                              shape=(len(user_ids), len(article_ids)))
+    return likes, user_ids
+
+
+def normalized_columns(likes):
+    # Unit-length columns make the item-item product a cosine similarity
+    norms = np.sqrt(np.asarray(likes.sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    return (likes @ sparse.diags(1 / norms)).astype(np.float32).tocsr()
+
+
+def top_k(block, k, exclude):
+    """Best ``k`` columns of every row of a dense block as (columns, scores),
+    best first; ``exclude`` holds a column per row to skip (the article itself)."""
+    block[np.arange(len(block)), exclude] = -np.inf
+    k = min(k, block.shape[1])
+    columns = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(block, columns, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def neighbour_lists(tfidf, likes, article_ids, rows):
+    """Yields (article id, neighbour ids, scores) for the given row numbers."""
+    weight = settings.RECOMMENDATIONS_LIKE_WEIGHT
+    block_size = max(1, BLOCK_CELLS // max(len(article_ids), tfidf.shape[1], likes.shape[0], 1))
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        # Sparse times a dense slice: the products are mostly non-zero, and
+        # building them as sparse matrices costs more than the arithmetic
+        block = (1 - weight) * (tfidf @ tfidf[block_rows].T.toarray())
+        block += weight * (likes.T @ likes[:, block_rows].toarray())
+        block = np.ascontiguousarray(block.T, dtype=np.float32)
+        columns, scores = top_k(block, settings.RECOMMENDATIONS_TOP_K, block_rows)
+        for row, row_columns, row_scores in zip(block_rows, columns, scores):
+            keep = row_scores > 0
+            yield int(article_ids[row]), article_ids[row_columns[keep]].tolist(), row_scores[keep].tolist()
+
+
+def upsert(model, objects):
+    if objects:
+        model.objects.bulk_create(objects, update_conflicts=True, unique_fields=[model._meta.pk.name],
+                                  update_fields=['article_ids', 'scores', 'built_at'])
+
+
+def save_related(lists, built_at, batch_size=1000):
+    batch, saved = [], []
+    for article_id, ids, scores in lists:
+        batch.append(RelatedArticles(article_id=article_id, article_ids=ids,
+                                     scores=[round(score, 4) for score in scores], built_at=built_at))
+        saved.append((article_id, ids, scores))
+        if len(batch) >= batch_size:
+            upsert(RelatedArticles, batch)
+            batch = []
+    upsert(RelatedArticles, batch)
+    return saved
+
+
+def users_who_liked(article_ids):
+    users = set()
+    for start in range(0, len(article_ids), ID_BATCH):
+        users.update(Like.objects.filter(article_id__in=article_ids[start:start + ID_BATCH])
+                     .values_list('user_id', flat=True))
+    return sorted(users)
+
+
+def join_neighbour_lists(lists, built_at):
+    # Similarity is symmetric: a new article belongs in the lists of its
+    # own neighbours if it beats their weakest entry; returns the ids of the
+    # lists that changed
+    candidates = defaultdict(dict)
+    for article_id, ids, scores in lists:
+        for neighbour, score in zip(ids, scores):
+            candidates[neighbour][article_id] = round(score, 4)
+    k = settings.RECOMMENDATIONS_TOP_K
+    neighbour_ids = list(candidates)
+    changed = []
+    for start in range(0, len(neighbour_ids), ID_BATCH):
+        for related in RelatedArticles.objects.filter(article_id__in=neighbour_ids[start:start + ID_BATCH]):
+            merged = dict(zip(related.article_ids, related.scores))
+            merged.update(candidates[related.article_id])
+            best = sorted(merged.items(), key=lambda item: -item[1])[:k]
+            ids = [pk for pk, _ in best]
+            if ids != related.article_ids:
+                related.article_ids, related.scores, related.built_at = ids, [score for _, score in best], built_at
+                changed.append(related)
+    RelatedArticles.objects.bulk_update(changed, ['article_ids', 'scores', 'built_at'], batch_size=1000)
+    return [related.article_id for related in changed]
+
+
+def build_article_lists(built_at):
+    article_ids, texts = article_texts()
+    if not len(article_ids):
+        return {'articles': 0, 'scored': 0, 'matrix_bytes': 0}
+    vectorizer = TfidfVectorizer(max_features=settings.RECOMMENDATIONS_MAX_FEATURES, stop_words='english',
+                                 sublinear_tf=True, dtype=np.float32)
+    tfidf = vectorizer.fit_transform(texts).tocsr()
+    del texts
+    likes, _ = like_matrix(article_ids)
+    save_related(neighbour_lists(tfidf, normalized_columns(likes), article_ids, np.arange(len(article_ids))),
+                 built_at)
+    # Lists of articles that no longer have any neighbour
+    RelatedArticles.objects.filter(built_at__lt=built_at).delete()
+    save_state(vectorizer, tfidf, article_ids)
+    return {'articles': len(article_ids), 'scored': len(article_ids), 'matrix_bytes': matrix_bytes(tfidf)}
+
+
+def update_article_lists(state, built_at):
+    # Returns the result and the ids of the articles whose lists changed
+    vectorizer, tfidf, known_ids = state
+    existing = np.array(Article.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+    kept = np.isin(known_ids, existing)
+    tfidf, known_ids = tfidf[kept], known_ids[kept]
+    new_ids, texts = article_texts(np.setdiff1d(existing, known_ids).tolist())
+    result = {'articles': len(existing), 'scored': len(new_ids), 'joined': 0}
+    changed = []
+    if len(new_ids):
+        tfidf = sparse.vstack([tfidf, vectorizer.transform(texts).astype(np.float32)]).tocsr()
+        article_ids = np.concatenate([known_ids, new_ids])
+        likes, _ = like_matrix(article_ids)
+        rows = np.arange(len(known_ids), len(article_ids))
+        lists = save_related(neighbour_lists(tfidf, normalized_columns(likes), article_ids, rows), built_at)
+        joined = join_neighbour_lists(lists, built_at)
+        result['joined'] = len(joined)
+        changed = [article_id for article_id, _, _ in lists] + joined
+        known_ids = article_ids
+    if len(new_ids) or not kept.all():
+        save_state(vectorizer, tfidf, known_ids)
+    result['matrix_bytes'] = matrix_bytes(tfidf)
+    return result, changed
+
+
+def build_user_lists(built_at, user_ids=None, batch_size=1000):
+    """Rebuild the recommendations of every user, or only of ``user_ids``;
+    returns how many users were scored."""
+    if user_ids is not None and not user_ids:
+        return 0
+    article_ids = np.array(Article.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+    index = {pk: i for i, pk in enumerate(article_ids.tolist())}
+    rows, columns, values = [], [], []
+    for article_id, ids, scores in RelatedArticles.objects.values_list(
+            'article_id', 'article_ids', 'scores').iterator(chunk_size=5000):
+        for pk, score in zip(ids, scores):
+            if pk in index and article_id in index:
+                rows.append(index[article_id])
+                columns.append(index[pk])
+                values.append(score)
+    neighbours = sparse.csr_matrix((np.array(values, dtype=np.float32), (rows, columns)),
+                                   shape=(len(article_ids), len(article_ids)))
+    likes, liked_by = like_matrix(article_ids, user_ids)
+    totals = (likes @ neighbours).tocsr()
+    totals = (totals - totals.multiply(likes)).tocsr()
+    totals.eliminate_zeros()
+
+    k = settings.RECOMMENDATIONS_TOP_K
+    batch = []
+    for row, user_id in enumerate(liked_by.tolist()):
+        start, end = totals.indptr[row], totals.indptr[row + 1]
+        if start == end:
+            continue
+        data, indices = totals.data[start:end], totals.indices[start:end]
+        best = np.argsort(-data, kind='stable')[:k]
+        batch.append(UserRecommendations(user_id=user_id, article_ids=article_ids[indices[best]].tolist(),
+                                         scores=np.round(data[best], 4).tolist(), built_at=built_at))
+        if len(batch) >= batch_size:
+            upsert(UserRecommendations, batch)
+            batch = []
+    upsert(UserRecommendations, batch)
+    # Users left without recommendations
+    stale = UserRecommendations.objects.filter(built_at__lt=built_at)
+    if user_ids is None:
+        stale.delete()
+    else:
+        for start in range(0, len(user_ids), ID_BATCH):
+            stale.filter(user_id__in=user_ids[start:start + ID_BATCH]).delete()
+    return len(liked_by)
+
+
+def matrix_bytes(matrix):
+    return int(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)
+
+
+def build_recommendations(update=False):
+    """Rebuild the neighbour lists and every user's recommendations; with
+    ``update``, when a saved model exists, only the lists of new articles and
+    the recommendations of users who liked an article whose list changed."""
+    started = time.perf_counter()
+    built_at = timezone.now()
+    state = load_state() if update else None
+    if state is not None:
+        result, changed = update_article_lists(state, built_at)
+        result['users'] = build_user_lists(built_at, users_who_liked(changed))
+    else:
+        result = build_article_lists(built_at)
+        result['users'] = build_user_lists(built_at)
+    response_cache.invalidate('recommendations')
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
@@ -0,0 +1,124 @@
+"""Cache for the public read endpoints.
+
+Serialized response data is kept in the RESPONSE_CACHE_ALIAS cache (the
+local-memory LRU by default; point it at Redis or Memcached for a cache
+shared between workers) for RESPONSE_CACHE_TIMEOUT seconds. Every entry is
+keyed on the versions of the tags it was built from ('articles',
+'article:3', 'user:7', ...). Invalidating a tag moves it to a new version,
+so entries built on the old one are never read again and age out of the
+LRU; the signals in signals.py invalidate the tags a write touches.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from rest_framework.utils.encoders import JSONEncoder
+
+# Part of every key, bumped by invalidate_all()
+GLOBAL_TAG = '*'
+
+
+class ResponseCache:
+    prefix = 'rc'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    @property
+    def cache(self):
+        return caches[settings.RESPONSE_CACHE_ALIAS]
+
+    @property
+    def enabled(self):
+        return bool(settings.RESPONSE_CACHE_TIMEOUT)
+
+    def versions(self, tags):
+        keys = sorted(f'{self.prefix}:tag:{tag}' for tag in {GLOBAL_TAG, *tags})
+        found = self.cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                # A tag evicted from the LRU must not fall back to a version
+                # older entries were stored under, so start from the clock
+                self.cache.add(key, time.time_ns(), None)
+                found[key] = self.cache.get(key)
+        return [found[key] for key in keys]
+
+    def key(self, request, tags, variant=None):
+        parts = [request.get_host(), request.path, sorted(request.query_params.lists()),
+                 variant, self.versions(tags)]
+        digest = hashlib.md5(json.dumps(parts, default=str).encode()).hexdigest()
+        return f'{self.prefix}:{digest}'
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        self.count('misses' if entry is None else 'hits')
+        return entry
+
+    def set(self, key, entry):
+        self.cache.set(key, entry, settings.RESPONSE_CACHE_TIMEOUT)
+
+    def invalidate(self, *tags):
+        self._bump(tags)
+        if connection.in_atomic_block:
+            # Bump again once the write is visible, so a read racing the
+            # transaction cannot keep stale data under the new version
+            transaction.on_commit(lambda: self._bump(tags))
+
+    def invalidate_all(self):
+        self.invalidate(GLOBAL_TAG)
+
+    def _bump(self, tags):
+        self.cache.set_many({f'{self.prefix}:tag:{tag}': time.time_ns() for tag in tags}, None)
+        self.count('invalidations', len(tags))
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self):
+        # Per process; hit_ratio is None until something was looked up
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_ratio'] = round(stats.get('hits', 0) / lookups, 4) if lookups else None
+        return stats
+
+
+response_cache = ResponseCache()
+
+
+def etag_for(data):
+    return '"%s"' % hashlib.md5(json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()).hexdigest()
+
+
+# Tags touched by writes to each model
+
+def article_tags(article_id):
+    # Comments render their article's title
+    return ['articles', f'article:{article_id}', 'comments']
+
+
+def comment_tags(article_id):
+    # Articles render their comments and comment count
+    return ['comments', 'articles', f'article:{article_id}']
+
+
+def like_tags(article_ids=(), comment_ids=()):
+    from .models import Comment
+
+    tags = set()
+    if article_ids:
+        tags |= {'articles', *(f'article:{pk}' for pk in article_ids)}
+    if comment_ids:
+        article_ids = Comment.objects.filter(pk__in=comment_ids).values_list('article_id', flat=True)
+        tags |= {'comments', *(f'article:{pk}' for pk in set(article_ids))}
+    return tags
+
+
+def user_tags(user_id):
+    return ['users', f'user:{user_id}']
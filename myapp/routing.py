@@ -0,0 +1,11 @@
+from django.urls import path
+from .realtime import ArticleEventsConsumer, ArticleEventStream
+
+# Served by the ASGI application ahead of Django's own URLs
+http_urlpatterns = [
+    path('api/articles/<int:pk>/events/', ArticleEventStream.as_asgi(), name='article_events'),
+]
+
+websocket_urlpatterns = [
+    path('ws/articles/<int:pk>/', ArticleEventsConsumer.as_asgi(), name='article_events_ws'),
+]
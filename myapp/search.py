@@ -0,0 +1,178 @@
+"""Full-text search over article titles and content.
+
+The backend is picked by the SEARCH_BACKEND setting (a dotted path); when
+unset, SQLite databases use the FTS5 index created by migration 0007 and
+every other database falls back to ``LikeSearchBackend``. Backends are kept
+up to date by the Article signals in signals.py and can be rebuilt with
+``manage.py rebuild_search_index``.
+"""
+import re
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+@dataclass
+class SearchHit:
+    article_id: int
+    score: float
+    snippet: str
+
+
+class BaseSearchBackend(ABC):
+    """Interface every search backend implements."""
+
+    @abstractmethod
+    def index(self, articles):
+        pass
+
+    @abstractmethod
+    def remove(self, article_ids):
+        pass
+
+    @abstractmethod
+    def rebuild(self, queryset, chunk_size=2000):
+        # Returns the number of articles indexed
+        pass
+
+    @abstractmethod
+    def search(self, query, limit):
+        # Best matches first, at most ``limit`` of them
+        pass
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """Ranked search backed by an SQLite FTS5 table.
+
+    Queries match every word, the last one (or all of them with
+    ``SEARCH_PREFIX_ALL_TERMS``) as a prefix, and are ranked by bm25 with
+    title hits weighted above content hits.
+    """
+    table = 'myapp_article_fts'
+    title_weight = 10.0
+    content_weight = 1.0
+    snippet_tokens = 16
+
+    def index(self, articles):
+        rows = [(article.id, article.title, article.content) for article in articles]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(row[0],) for row in rows])
+            cursor.executemany(f'INSERT INTO {self.table} (rowid, title, content) VALUES (%s, %s, %s)', rows)
+
+    def remove(self, article_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {self.table} WHERE rowid = %s', [(pk,) for pk in article_ids])
+
+    def rebuild(self, queryset, chunk_size=2000):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+        indexed, batch = 0, []
+        for article in queryset.only('id', 'title', 'content').iterator(chunk_size=chunk_size):
+            batch.append(article)
+            if len(batch) >= chunk_size:
+                self.index(batch)
+                indexed, batch = indexed + len(batch), []
+        self.index(batch)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return indexed + len(batch)
+
+    def match_expression(self, query):
+        words = WORD_RE.findall(query.lower())
+        if not words:
+            return None
+        prefix_all = settings.SEARCH_PREFIX_ALL_TERMS
+        terms = [f'"{word}"*' if prefix_all or i == len(words) - 1 else f'"{word}"'
+                 for i, word in enumerate(words)]
+        return ' AND '.join(terms)
+
+    def search(self, query, limit):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+        sql = (
+            f'SELECT rowid, bm25({self.table}, %s, %s) AS score, '
+            f"snippet({self.table}, -1, '\x02', '\x03', '…', %s) "
+            f'FROM {self.table} WHERE {self.table} MATCH %s ORDER BY score LIMIT %s'
+        )
+        params = [self.title_weight, self.content_weight, self.snippet_tokens, expression, limit]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        # bm25 is lower-is-better; flip it so higher scores rank first
+        return [SearchHit(pk, -score, highlight(snippet)) for pk, score, snippet in rows]
+
+
+class LikeSearchBackend(BaseSearchBackend):
+    """Portable fallback: substring matching over title and content.
+
+    Needs no index of its own (so index/remove/rebuild are no-ops); titles
+    that match rank above content-only matches, newest first.
+    """
+    snippet_chars = 80
+
+    def index(self, articles):
+        pass
+
+    def remove(self, article_ids):
+        pass
+
+    def rebuild(self, queryset, chunk_size=2000):
+        return 0
+
+    def search(self, query, limit):
+        from .models import Article
+
+        words = WORD_RE.findall(query)
+        if not words:
+            return []
+        condition = Q()
+        for word in words:
+            condition &= Q(title__icontains=word) | Q(content__icontains=word)
+        matches = (Article.objects.filter(condition).order_by('-created_at')
+                   .values_list('id', 'title', 'content')[:limit])
+        hits = []
+        for pk, title, content in matches:
+            in_title = all(word.lower() in title.lower() for word in words)
+            hits.append(SearchHit(pk, 1.0 if in_title else 0.0, self.excerpt(title, content, words)))
+        hits.sort(key=lambda hit: -hit.score)
+        return hits
+
+    def excerpt(self, title, content, words):
+        for text in (title, content):
+            position = text.lower().find(words[0].lower())
+            if position >= 0:
+                start = max(0, position - self.snippet_chars // 2)
+                text = text[start:start + self.snippet_chars]
+                pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+                marked = pattern.sub(lambda match: f'\x02{match.group(0)}\x03', text)
+                return highlight(('…' if start else '') + marked)
+        return ''
+
+
+def highlight(snippet):
+    # Backends mark hits with \x02/\x03 so the text can be escaped safely
+    # before the <mark> tags go in
+    return escape(snippet or '').replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    path = settings.SEARCH_BACKEND
+    if not path:
+        path = ('myapp.search.SQLiteFTSBackend' if connection.vendor == 'sqlite'
+                else 'myapp.search.LikeSearchBackend')
+    return _load_backend(path)
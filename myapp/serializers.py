@@ -1,13 +1,52 @@
+from collections import deque
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from rest_framework import serializers
+from .images import srcset, stored_files
+from .jobs import enqueue
+from .metrics import serializing
 from .models import Category, Article, Comment, Like, UserProfile
 from django.contrib.auth.models import User
 
+class DynamicFieldsMixin:
+    """Lets callers pick which fields a serializer renders.
+
+    ``Meta.default_fields`` (all fields when unset) are rendered unless the
+    caller passes ``fields``; names in ``expand`` are always added, which is
+    how heavier nested relations that are not rendered by default get
+    switched on. Write-only fields are never dropped.
+    """
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        visible = self.visible_field_names(fields, expand)
+        for name in list(self.fields):
+            if name not in visible and not self.fields[name].write_only:
+                self.fields.pop(name)
+
+    @classmethod
+    def visible_field_names(cls, fields=None, expand=None):
+        names = set(fields or getattr(cls.Meta, 'default_fields', cls.Meta.fields))
+        names |= set(expand or ())
+        return names & set(cls.Meta.fields)
+
+    def to_representation(self, instance):
+        with serializing():
+            return super().to_representation(instance)
+
+def absolute_url(context, url):
+    request = context.get('request')
+    if request:
+        return request.build_absolute_uri(url)
+    return f"{getattr(settings, 'BASE_URL', 'http://localhost:8000')}{url}"
+
 class UserProfileSerializer(serializers.ModelSerializer):
     profile_picture = serializers.SerializerMethodField()
+    profile_picture_srcset = serializers.SerializerMethodField()
     
     class Meta:
         model = UserProfile
-        fields = ['bio', 'profile_picture']
+        fields = ['bio', 'profile_picture', 'profile_picture_srcset']
     
     def get_profile_picture(self, obj):
         if obj.profile_picture:
@@ -31,6 +70,9 @@ class UserProfileSerializer(serializers.ModelSerializer):
                 return None
         return None
 
+    def get_profile_picture_srcset(self, obj):
+        return srcset(obj.profile_picture_derivatives, lambda url: absolute_url(self.context, url))
+
 class ProfileUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserProfile
@@ -38,7 +80,7 @@ class ProfileUpdateSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'profile_picture': {'required': False}
         }
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     profile = UserProfileSerializer(read_only=True)
 
     class Meta:
@@ -67,24 +109,98 @@ class CommentCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Article ID is required")
         return data
 
+def group_replies(comments):
+    # Map parent id -> child comments so reply trees can be rendered from an
+    # already-fetched list instead of querying obj.replies per node
+    children = {}
+    for comment in comments:
+        if comment.parent_id is not None:
+            children.setdefault(comment.parent_id, []).append(comment)
+    return children
+
+def build_comment_threads(roots, thread, context=None, fields=None):
+    """Render ``roots`` with their nested replies without recursion.
+
+    ``thread`` is the flat list of comments replies are taken from, normally
+    one query ordered by parent and creation time. Each reachable comment is
+    serialized once and the trees are then linked together in O(n), cut off
+    at ``comment_max_depth`` levels and ``comment_replies_limit`` replies
+    per comment (both read from the context, defaulting to settings).
+    """
+    context = dict(context or {})
+    max_depth = context.get('comment_max_depth', settings.COMMENT_MAX_DEPTH)
+    limit = context.get('comment_replies_limit', settings.COMMENT_REPLIES_PAGE_SIZE)
+    children = group_replies(thread)
+    context.update(comment_children=children, comment_tree=True)
+
+    # Breadth-first, so every comment is first reached at its smallest depth
+    reachable = {}
+    queue = deque((root, 0) for root in roots)
+    while queue:
+        comment, depth = queue.popleft()
+        if comment.id in reachable:
+            continue
+        reachable[comment.id] = comment
+        if depth < max_depth:
+            queue.extend((child, depth + 1) for child in children.get(comment.id, [])[:limit])
+
+    comments = list(reachable.values())
+    if 'liked_comment_ids' not in context:
+        request = context.get('request')
+        context['liked_comment_ids'] = Like.objects.liked_comment_ids(
+            getattr(request, 'user', None), list(reachable))
+    rendered = CommentSerializer(comments, many=True, context=context, fields=fields).data
+    base = {comment.id: data for comment, data in zip(comments, rendered)}
+
+    def copy_node(comment):
+        node = dict(base[comment.id])
+        if 'replies' in node:
+            node['replies'] = []
+        return node
+
+    threads = []
+    for root in roots:
+        node = copy_node(root)
+        threads.append(node)
+        if 'replies' not in node:
+            continue
+        stack = [(root, node, 0)]
+        while stack:
+            comment, node, depth = stack.pop()
+            if depth >= max_depth:
+                continue
+            for child in children.get(comment.id, [])[:limit]:
+                child_node = copy_node(child)
+                node['replies'].append(child_node)
+                stack.append((child, child_node, depth + 1))
+    return threads
+
 # Update the existing CommentSerializer
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     replies = serializers.SerializerMethodField()
+    replies_count = serializers.SerializerMethodField()
     article = serializers.SerializerMethodField()
     likes = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
-        fields = ['id', 'article', 'user', 'content', 'parent', 'replies', 
+        fields = ['id', 'article', 'user', 'content', 'parent', 'replies', 'replies_count',
                  'created_at', 'likes', 'is_liked']
         read_only_fields = ['user', 'created_at']
 
     def get_replies(self, obj):
-        if obj.replies.exists():
-            return CommentSerializer(obj.replies.all(), many=True).data
-        return []
+        if self.context.get('comment_tree'):
+            # Filled in by build_comment_threads
+            return []
+        request = self.context.get('request')
+        thread = (Comment.objects.for_listing().select_related('article').filter(article_id=obj.article_id)
+                  .order_by('parent_id', 'created_at'))
+        return build_comment_threads([obj], thread, self.context, list(self.fields))[0]['replies']
+
+    def get_replies_count(self, obj):
+        return obj.reply_count
 
     def get_article(self, obj):
         return {
@@ -94,15 +210,18 @@ class CommentSerializer(serializers.ModelSerializer):
         }
 
     def get_likes(self, obj):
-        return obj.like_set.count()
+        return obj.like_count
 
     def get_is_liked(self, obj):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
+            liked = self.context.get('liked_comment_ids')
+            if liked is not None:
+                return obj.id in liked
             return obj.like_set.filter(user=request.user).exists()
         return False
 
-class ArticleSerializer(serializers.ModelSerializer):
+class ArticleSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
     category_id = serializers.PrimaryKeyRelatedField(
         queryset=Category.objects.all(), 
@@ -111,29 +230,73 @@ class ArticleSerializer(serializers.ModelSerializer):
         required=False  # Make this optional for updates
     )
     author = UserSerializer(read_only=True)
-    comments = CommentSerializer(many=True, read_only=True)
+    comments = serializers.SerializerMethodField()
     likes = serializers.SerializerMethodField()
     views = serializers.IntegerField(read_only=True)
     thumbnail = serializers.ImageField(required=False)  # Make thumbnail optional
+    thumbnail_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Article
-        fields = ['id', 'title', 'thumbnail', 'content', 'category', 'category_id', 
+        fields = ['id', 'title', 'thumbnail', 'thumbnail_srcset', 'content', 'category', 'category_id',
                  'author', 'comments', 'likes', 'views', 'created_at', 'updated_at']
 
+    def get_comments(self, obj):
+        comments = list(obj.comments.all())
+        return build_comment_threads(comments, comments, self.context)
+
     def get_likes(self, obj):
-        return obj.like_set.count()
+        return obj.like_count
+
+    def get_thumbnail_srcset(self, obj):
+        return srcset(obj.thumbnail_derivatives, lambda url: absolute_url(self.context, url))
+
+    def create(self, validated_data):
+        instance = super().create(validated_data)
+        if instance.thumbnail:
+            enqueue('process_thumbnail', instance.id, key=f'process_thumbnail:{instance.id}')
+        return instance
 
     def update(self, instance, validated_data):
         # Handle thumbnail separately
         thumbnail = validated_data.pop('thumbnail', None)
+        # The view passes the current file back in when none was sent
+        if not isinstance(thumbnail, UploadedFile):
+            thumbnail = None
+        replaced = []
         if thumbnail:
-            # Delete old thumbnail if exists
-            if instance.thumbnail:
-                instance.thumbnail.delete()
+            # The old thumbnail and its derivatives are deleted in the background
+            replaced = stored_files(instance.thumbnail, instance.thumbnail_derivatives)
             instance.thumbnail = thumbnail
+            instance.thumbnail_derivatives = {}
         
-        return super().update(instance, validated_data)
+        instance = super().update(instance, validated_data)
+        if thumbnail:
+            if replaced:
+                enqueue('delete_files', replaced)
+            enqueue('process_thumbnail', instance.id, key=f'process_thumbnail:{instance.id}')
+        return instance
+
+class ArticleSummarySerializer(ArticleSerializer):
+    # Compact representation used by the article feed; the heavy nested
+    # relations are only rendered when requested through ?expand=
+    category_name = serializers.CharField(source='category.name', read_only=True)
+    author_username = serializers.CharField(source='author.username', read_only=True)
+    comments_count = serializers.SerializerMethodField()
+    snippet = serializers.SerializerMethodField()
+
+    class Meta(ArticleSerializer.Meta):
+        fields = ArticleSerializer.Meta.fields + ['category_name', 'author_username', 'comments_count', 'snippet']
+        default_fields = ['id', 'title', 'thumbnail', 'thumbnail_srcset', 'category_name', 'author_username',
+                          'likes', 'comments_count', 'views', 'created_at']
+
+    def get_comments_count(self, obj):
+        return obj.comment_count
+
+    def get_snippet(self, obj):
+        # Highlighted match, only rendered for ?search= results
+        hit = (self.context.get('search_hits') or {}).get(obj.id)
+        return hit.snippet if hit else None
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     bio = serializers.CharField(write_only=True, required=False, allow_blank=True)
@@ -149,8 +312,10 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         profile_picture = validated_data.pop('profile_picture', None)
         user = User.objects.create_user(**validated_data)
         # Use get_or_create to handle existing profiles
-        UserProfile.objects.get_or_create(
+        profile, _ = UserProfile.objects.get_or_create(
             user=user,
             defaults={'bio': bio, 'profile_picture': profile_picture}
         )
+        if profile.profile_picture:
+            enqueue('process_profile_picture', profile.id, key=f'process_profile_picture:{profile.id}')
         return user
\ No newline at end of file
@@ -1,9 +1,139 @@
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from .authentication import forget_user_state
+from .counters import adjust
+from .jobs import enqueue
+from .realtime import comment_event, publish, publish_likes
+from .models import Article, Category, Comment, Job, Like, UserProfile
+from .response_cache import article_tags, comment_tags, like_tags, response_cache, user_tags
+from .search import get_backend
+from .trending import score_article
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.create(user=instance)
\ No newline at end of file
+        UserProfile.objects.create(user=instance)
+
+# Keep the denormalized counters in step; these run inside the same
+# transaction as the insert/delete (including cascaded deletes)
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, **kwargs):
+    if created:
+        adjust(Article, instance.article_id, 'comment_count', 1)
+        adjust(Comment, instance.parent_id, 'reply_count', 1)
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, **kwargs):
+    adjust(Article, instance.article_id, 'comment_count', -1)
+    adjust(Comment, instance.parent_id, 'reply_count', -1)
+
+@receiver(post_save, sender=Like)
+def count_like(sender, instance, created, **kwargs):
+    if created:
+        adjust(Article, instance.article_id, 'like_count', 1)
+        adjust(Comment, instance.comment_id, 'like_count', 1)
+
+@receiver(post_delete, sender=Like)
+def uncount_like(sender, instance, **kwargs):
+    adjust(Article, instance.article_id, 'like_count', -1)
+    adjust(Comment, instance.comment_id, 'like_count', -1)
+
+# New articles start out with their trending score; engagement changes are
+# picked up by the recompute_trending job (see trending.py)
+@receiver(pre_save, sender=Article)
+def score_new_article(sender, instance, **kwargs):
+    if instance._state.adding:
+        instance.trending_score = score_article(instance)
+
+# New articles join the related-article lists shortly after; a queued job
+# picks up every article created before it runs, so most saves only check
+# that there is one
+@receiver(post_save, sender=Article)
+def recommend_new_article(sender, instance, created, **kwargs):
+    key = 'update_recommendations'
+    if created and not Job.objects.filter(key=key, status=Job.QUEUED).exists():
+        enqueue('update_recommendations', key=key, delay=settings.RECOMMENDATIONS_UPDATE_DELAY)
+
+# Incremental search index maintenance; bulk writes that skip signals are
+# picked up by `manage.py rebuild_search_index`
+@receiver(post_save, sender=Article)
+def index_article(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'title', 'content'} & set(update_fields):
+        get_backend().index([instance])
+
+@receiver(post_delete, sender=Article)
+def unindex_article(sender, instance, **kwargs):
+    get_backend().remove([instance.id])
+
+# Response cache invalidation. Likes removed or added in bulk by likes.py
+# skip these signals and invalidate there.
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    response_cache.invalidate('categories')
+
+@receiver([post_save, post_delete], sender=Article)
+def invalidate_article(sender, instance, **kwargs):
+    response_cache.invalidate(*article_tags(instance.id))
+
+@receiver([post_save, post_delete], sender=Comment)
+def invalidate_comment(sender, instance, **kwargs):
+    response_cache.invalidate(*comment_tags(instance.article_id))
+
+@receiver([post_save, post_delete], sender=Like)
+def invalidate_like(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, (User, Article, Comment)):
+        # Cascade; the deleted user, article or comment invalidates
+        return
+    if instance.article_id is not None:
+        response_cache.invalidate(*like_tags(article_ids=[instance.article_id]))
+    elif instance.comment_id is not None:
+        response_cache.invalidate(*like_tags(comment_ids=[instance.comment_id]))
+
+# Live updates for the article's subscribers (see realtime.py); likes
+# written in bulk by likes.py skip these signals and publish there
+@receiver(post_save, sender=Comment)
+def publish_comment(sender, instance, created, **kwargs):
+    publish(instance.article_id, comment_event('comment.created' if created else 'comment.updated', instance))
+
+@receiver(post_delete, sender=Comment)
+def publish_deleted_comment(sender, instance, origin=None, **kwargs):
+    # Replies go with the comment they answer, and comments with their article
+    if isinstance(origin, Article) or (isinstance(origin, Comment) and origin.pk != instance.pk):
+        return
+    publish(instance.article_id, {'type': 'comment.deleted',
+                                  'comment': {'id': instance.id, 'parent': instance.parent_id}})
+
+@receiver(post_delete, sender=Article)
+def publish_deleted_article(sender, instance, **kwargs):
+    publish(instance.id, {'type': 'article.deleted', 'article': instance.id})
+
+@receiver([post_save, post_delete], sender=Like)
+def publish_like(sender, instance, created=True, origin=None, **kwargs):
+    if not created or isinstance(origin, (User, Article, Comment)):
+        return
+    delta = 1 if kwargs['signal'] is post_save else -1
+    if instance.article_id is not None:
+        publish_likes(article_deltas={instance.article_id: delta})
+    elif instance.comment_id is not None:
+        publish_likes(comment_deltas={instance.comment_id: delta})
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_user(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which no cached response shows
+    if sender is User and update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    response_cache.invalidate(*user_tags(instance.id if sender is User else instance.user_id))
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    # Their likes and comments could be on any page
+    response_cache.invalidate_all()
+
+@receiver([post_save, post_delete], sender=User)
+def forget_auth_state(sender, instance, update_fields=None, **kwargs):
+    # Deleted or deactivated users lose their tokens; logins only touch last_login
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        forget_user_state(instance.id)
@@ -0,0 +1,48 @@
+"""Background jobs run by `manage.py run_jobs` (see jobs.py)."""
+from django.core.files.storage import default_storage
+from .counters import reconcile_counters
+from .images import process_profile_picture, process_thumbnail
+from .jobs import task
+from .models import Article, UserProfile
+from .trending import recompute_trending, schedule_recompute
+
+
+# Both process whatever image is current when the job runs, so a queued
+# job keyed on the object covers every upload made before it starts
+
+@task('process_thumbnail')
+def thumbnail(article_id):
+    article = Article.objects.filter(id=article_id).first()
+    if article is not None:
+        process_thumbnail(article)
+
+
+@task('process_profile_picture')
+def profile_picture(profile_id):
+    profile = UserProfile.objects.filter(id=profile_id).first()
+    if profile is not None:
+        process_profile_picture(profile)
+
+
+@task('delete_files')
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+@task('reconcile_counters')
+def reconcile(chunk_size=10000):
+    reconcile_counters(chunk_size=chunk_size)
+
+
+@task('recompute_trending')
+def trending(chunk_size=100000):
+    recompute_trending(chunk_size=chunk_size)
+    schedule_recompute()
+
+
+@task('update_recommendations')
+def recommendations():
+    # Imported here so web processes never load scikit-learn
+    from .recommendations import build_recommendations
+    build_recommendations(update=True)
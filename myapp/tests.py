@@ -1,3 +1,1857 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from hashlib import md5
+from importlib import import_module
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models.signals import post_delete
+from django.test import AsyncClient, AsyncRequestFactory, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from PIL import Image
+from prometheus_client import REGISTRY
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+from myproject.asgi import application
+from myproject.database import database_settings
+from .benchmarking import seed_dataset
+from .db_router import PIN_COOKIE, sync_sqlite_replicas
+from .authentication import token_for
+from .jobs import TASKS, enqueue, purge_finished, queue_stats, requeue_stale, run_pending, task
+from .images import stored_files
+from .loadtest import LoadTest
+from .media import file_etag
+from .metrics import RequestMetrics, current
+from .realtime import article_group
+from .recommendations import build_recommendations
+from .models import Category, Article, Comment, Job, Like, RelatedArticles, UserRecommendations
+from .response_cache import response_cache
+from .search import get_backend
+from .throttling import LocalMemoryStore, get_store, parse_rate
+from .trending import recompute_trending, schedule_recompute, score_article
+from .urls import urlpatterns
+from .view_counts import ViewCountBuffer, view_counts
+from .views import ArticleDetailView
 
-# Create your tests here.
+# Smallest valid GIF, used wherever an ImageField needs a file
+TINY_GIF = (
+    b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04'
+    b'\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+)
+
+
+def make_image(name='thumb.gif'):
+    return SimpleUploadedFile(name, TINY_GIF, content_type='image/gif')
+
+
+def make_png(name='shot.png', size=(800, 400)):
+    buffer = BytesIO()
+    Image.new('RGBA', size, (200, 30, 30, 128)).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+# Keep uploads made by the tests out of the real media directory
+TEST_MEDIA_ROOT = tempfile.mkdtemp(prefix='myapp-test-media-')
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+class FreshViewCountsMixin:
+    # Mixed into every test case: buffered hits must never outlive a test
+    # and land on another test's rows, or at exit on the real database
+    def run(self, result=None):
+        view_counts.clear()
+        try:
+            return super().run(result)
+        finally:
+            view_counts.clear()
+
+
+class APITestMixin:
+    # Builds a small but representative dataset: articles with nested
+    # comment threads and likes on both articles and comments
+    def create_dataset(self, articles=3, comments=3, depth=2):
+        self.category = Category.objects.create(name=f'cat-{Category.objects.count()}')
+        self.author = User.objects.create_user(f'author{User.objects.count()}', password='pass')
+        readers = [User.objects.create_user(f'reader{User.objects.count()}', password='pass') for _ in range(3)]
+        for i in range(articles):
+            article = Article.objects.create(
+                title=f'Article {i}', thumbnail='thumbnails/test.png', content=f'Body {i}',
+                category=self.category, author=self.author,
+            )
+            for reader in readers:
+                Like.objects.create(user=reader, article=article)
+            for j in range(comments):
+                parent = None
+                for level in range(depth + 1):
+                    parent = Comment.objects.create(
+                        article=article, user=readers[(j + level) % len(readers)],
+                        content=f'Comment {j}.{level}', parent=parent,
+                    )
+                    Like.objects.create(user=readers[level % len(readers)], comment=parent)
+        self.article = Article.objects.order_by('id').first()
+        self.comment = Comment.objects.filter(article=self.article, parent=None).order_by('id').first()
+        return readers
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, AUTH_STATE_TTL=60,
+                   VIEW_COUNT_FLUSH_THRESHOLD=None, VIEW_COUNT_FLUSH_INTERVAL=None)
+class QueryBudgetTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    """Asserts a fixed query count for every route in myapp/urls.py.
+
+    Read endpoints are measured at two dataset sizes: the budget must not grow
+    with the number of rows rendered.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.user = self.readers[0]
+
+    def assertQueryBudget(self, budget, method, url, data=None, user=None, **extra):
+        if user is not None:
+            self.client.force_authenticate(user)
+        with self.assertNumQueries(budget):
+            response = getattr(self.client, method)(url, data, **extra)
+        self.client.force_authenticate(None)
+        self.assertLess(response.status_code, 400, getattr(response, 'data', response))
+        return response
+
+    def assertReadBudget(self, budget, url, user=None):
+        self.assertQueryBudget(budget, 'get', url, user=user)
+        self.create_dataset(articles=6, comments=4, depth=3)
+        self.assertQueryBudget(budget, 'get', url, user=user)
+
+    def test_article_list(self):
+        self.assertReadBudget(2, reverse('article_list') + '?page_size=100')
+
+    def test_article_list_expanded(self):
+        url = reverse('article_list') + '?page_size=100&expand=author,category,comments'
+        self.assertReadBudget(4, url, user=self.user)
+
+    def test_article_detail(self):
+        self.assertReadBudget(2, reverse('article_detail', args=[self.article.id]))
+
+    def test_article_related(self):
+        ids = list(Article.objects.exclude(id=self.article.id).values_list('id', flat=True))
+        RelatedArticles.objects.create(article=self.article, article_ids=ids, scores=[1.0] * len(ids),
+                                       built_at=timezone.now())
+        self.assertReadBudget(2, reverse('article_related', args=[self.article.id]))
+
+    def test_recommendations(self):
+        ids = list(Article.objects.values_list('id', flat=True))
+        UserRecommendations.objects.create(user=self.user, article_ids=ids, scores=[1.0] * len(ids),
+                                           built_at=timezone.now())
+        self.assertReadBudget(2, reverse('recommendations'), user=self.user)
+
+    def test_recommendations_fallback(self):
+        self.assertReadBudget(3, reverse('recommendations'), user=self.user)
+
+    def test_article_search(self):
+        self.assertReadBudget(3, reverse('article_list') + '?search=article&page_size=100')
+
+    def test_comment_list(self):
+        self.assertReadBudget(3, reverse('comment_list'), user=self.user)
+
+    def test_comment_list_without_replies(self):
+        self.assertReadBudget(1, reverse('comment_list') + '?fields=id,content,likes', user=self.user)
+
+    def test_comment_detail(self):
+        self.assertReadBudget(2, reverse('comment_detail', args=[self.comment.id]))
+
+    def test_category_list(self):
+        self.assertReadBudget(1, reverse('category_list'))
+
+    def test_category_detail(self):
+        self.assertQueryBudget(1, 'get', reverse('category_detail', args=[self.category.id]))
+
+    def test_user_list(self):
+        self.assertReadBudget(1, reverse('user_list'), user=self.admin)
+
+    def test_user_list_without_profile(self):
+        self.assertReadBudget(1, reverse('user_list') + '?fields=id,username', user=self.admin)
+
+    def test_user_profile(self):
+        self.assertQueryBudget(1, 'get', reverse('user_profile', args=[self.user.id]))
+
+    def test_own_profile(self):
+        self.assertQueryBudget(0, 'get', reverse('profile'), user=self.user)
+
+    def test_profile_update(self):
+        self.assertQueryBudget(1, 'put', reverse('profile'), {'bio': 'hello'}, user=self.user, format='multipart')
+
+    def test_article_create(self):
+        data = {'title': 'New', 'content': 'Body', 'category_id': self.category.id, 'thumbnail': make_image()}
+        self.assertQueryBudget(9, 'post', reverse('article_list'), data, user=self.user, format='multipart')
+
+    def test_comment_create(self):
+        data = {'article': self.article.id, 'content': 'Nice'}
+        self.assertQueryBudget(5, 'post', reverse('comment_create'), data, user=self.user, format='json')
+
+    def test_category_create(self):
+        self.assertQueryBudget(2, 'post', reverse('category_list'), {'name': 'New'}, user=self.admin, format='json')
+
+    def test_like(self):
+        self.assertQueryBudget(9, 'post', reverse('like'), {'article_id': self.article.id}, user=self.admin, format='json')
+
+    def test_register(self):
+        data = {'username': 'newbie', 'password': 'a-long-password'}
+        self.assertQueryBudget(4, 'post', reverse('register'), data, format='json')
+
+    def test_token_obtain(self):
+        data = {'username': self.user.username, 'password': 'pass'}
+        self.assertQueryBudget(2, 'post', reverse('token_obtain_pair'), data, format='json')
+
+    def test_token_refresh(self):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': self.user.username, 'password': 'pass'}, format='json')
+        self.assertQueryBudget(0, 'post', reverse('token_refresh'), {'refresh': response.data['refresh']}, format='json')
+
+    def test_make_admin(self):
+        self.assertQueryBudget(3, 'post', reverse('make_admin', args=[self.user.id]), user=self.admin)
+
+    def test_suspend_user(self):
+        self.assertQueryBudget(79, 'post', reverse('suspend_user', args=[self.user.id]), user=self.admin)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class FieldSelectionTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=2)
+
+    def test_article_list_defaults_to_summary(self):
+        article = self.client.get(reverse('article_list')).data['results'][-1]
+        self.assertEqual(set(article), {
+            'id', 'title', 'thumbnail', 'thumbnail_srcset', 'category_name', 'author_username',
+            'likes', 'comments_count', 'views', 'created_at',
+        })
+        self.assertEqual(article['author_username'], self.author.username)
+        self.assertEqual(article['likes'], 3)
+        self.assertEqual(article['comments_count'], 9)
+
+    def test_article_list_fields_and_expand(self):
+        url = reverse('article_list') + '?fields=id,content&expand=comments'
+        article = self.client.get(url).data['results'][-1]
+        self.assertEqual(set(article), {'id', 'content', 'comments'})
+        self.assertEqual(len(article['comments']), 9)
+        self.assertEqual(len(article['comments'][0]['replies']), 1)
+
+    def test_article_detail_is_full_by_default(self):
+        article = self.client.get(reverse('article_detail', args=[self.article.id])).data
+        self.assertIn('comments', article)
+        self.assertIn('content', article)
+        self.assertEqual(article['author']['username'], self.author.username)
+
+    def test_comment_fields_apply_to_replies(self):
+        url = reverse('comment_list') + f'?article={self.article.id}&fields=id,replies'
+        comments = self.client.get(url).data
+        root = next(comment for comment in comments if comment['replies'])
+        self.assertEqual(set(root), {'id', 'replies'})
+        self.assertEqual(set(root['replies'][0]), {'id', 'replies'})
+
+    def test_unknown_fields_are_ignored(self):
+        article = self.client.get(reverse('article_list') + '?fields=id,password').data['results'][0]
+        self.assertEqual(set(article), {'id'})
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class CommentTreeTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=1, comments=2, depth=4)
+
+    def get_root(self, query=''):
+        return self.client.get(reverse('comment_detail', args=[self.comment.id]) + query).data
+
+    def test_every_listed_comment_renders_its_own_subtree(self):
+        comments = self.client.get(reverse('comment_list')).data
+        self.assertEqual(len(comments), 10)
+        for comment in comments:
+            node = comment
+            while node['replies']:
+                self.assertEqual(len(node['replies']), 1)
+                node = node['replies'][0]
+
+    def test_full_depth(self):
+        node, levels = self.get_root(), 0
+        while node['replies']:
+            node, levels = node['replies'][0], levels + 1
+        self.assertEqual(levels, 4)
+        self.assertEqual(node['replies_count'], 0)
+
+    def test_depth_limit(self):
+        root = self.get_root('?depth=1')
+        child = root['replies'][0]
+        self.assertEqual(child['replies'], [])
+        self.assertEqual(child['replies_count'], 1)
+
+    def test_replies_limit_and_paging(self):
+        for i in range(4):
+            Comment.objects.create(article=self.article, user=self.author, content=f'extra {i}', parent=self.comment)
+        root = self.get_root('?replies_limit=2')
+        self.assertEqual(len(root['replies']), 2)
+        self.assertEqual(root['replies_count'], 5)
+        url = reverse('comment_list') + f'?parent={self.comment.id}&limit=2&offset=2'
+        page = self.client.get(url).data
+        self.assertEqual(page['count'], 5)
+        self.assertEqual([reply['content'] for reply in page['results']], ['extra 1', 'extra 2'])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS,
+                   VIEW_COUNT_FLUSH_THRESHOLD=None, VIEW_COUNT_FLUSH_INTERVAL=None)
+class ViewCountTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=2, comments=0)
+
+    def test_detail_buffers_views_until_flush(self):
+        updated_at = self.article.updated_at
+        url = reverse('article_detail', args=[self.article.id])
+        self.assertEqual(self.client.get(url).data['views'], 1)
+        self.assertEqual(self.client.get(url).data['views'], 2)
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.views, 0)
+
+        call_command('flush_view_counts', stdout=StringIO())
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.views, 2)
+        self.assertEqual(self.article.updated_at, updated_at)
+        self.assertEqual(self.client.get(url).data['views'], 3)
+
+    def test_flush_batches_by_increment(self):
+        buffer = ViewCountBuffer()
+        other = Article.objects.exclude(id=self.article.id).get()
+        for article in (self.article, other, self.article):
+            buffer.record(article.id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(buffer.flush(), 3)
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(list(Article.objects.order_by('id').values_list('views', flat=True)), [2, 1])
+        self.assertEqual(buffer.pending(self.article.id), 0)
+
+    def test_hits_of_another_database_are_dropped(self):
+        # e.g. a test or throwaway database that was destroyed since
+        buffer = ViewCountBuffer()
+        with mock.patch('myapp.view_counts.current_database', return_value='/tmp/gone.sqlite3'):
+            buffer.record(self.article.id)
+            self.assertEqual(buffer.pending(self.article.id), 1)
+        self.assertEqual(buffer.pending(self.article.id), 0)
+        with self.assertLogs('myapp.view_counts', 'WARNING'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(Article.objects.get(id=self.article.id).views, 0)
+
+    @override_settings(VIEW_COUNT_FLUSH_THRESHOLD=3)
+    def test_threshold_triggers_flush(self):
+        buffer = ViewCountBuffer()
+        buffer.record(self.article.id)
+        buffer.record(self.article.id)
+        self.assertEqual(Article.objects.get(id=self.article.id).views, 0)
+        buffer.record(self.article.id)
+        self.assertEqual(Article.objects.get(id=self.article.id).views, 3)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class CounterTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=2, comments=2, depth=2)
+
+    def assertCountersMatch(self):
+        for article in Article.objects.all():
+            self.assertEqual(article.like_count, article.like_set.count())
+            self.assertEqual(article.comment_count, article.comments.count())
+        for comment in Comment.objects.all():
+            self.assertEqual(comment.like_count, comment.like_set.count())
+            self.assertEqual(comment.reply_count, comment.replies.count())
+
+    def test_counters_follow_likes_and_comments(self):
+        self.assertCountersMatch()
+        self.client.force_authenticate(self.author)
+        self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+        self.client.post(reverse('like'), {'comment_id': self.comment.id}, format='json')
+        data = {'article': self.article.id, 'content': 'Hi', 'parent': self.comment.id}
+        self.client.post(reverse('comment_create'), data, format='json')
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.like_count, 4)
+        self.assertCountersMatch()
+
+        self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+        self.client.force_authenticate(self.comment.user)
+        self.client.delete(reverse('comment_detail', args=[self.comment.id]))
+        self.assertCountersMatch()
+
+    def test_reconcile_counters(self):
+        Article.objects.update(like_count=0, comment_count=42)
+        Comment.objects.update(like_count=7, reply_count=0)
+        call_command('reconcile_counters', chunk_size=2, stdout=StringIO())
+        self.assertCountersMatch()
+
+    def test_is_liked_uses_one_batched_lookup(self):
+        reader = self.readers[0]
+        self.client.force_authenticate(reader)
+        url = reverse('comment_list') + f'?article={self.article.id}&fields=id,is_liked'
+        with self.assertNumQueries(2):
+            comments = self.client.get(url).data
+        liked = set(Like.objects.filter(user=reader, comment__article=self.article).values_list('comment_id', flat=True))
+        self.assertTrue(liked)
+        self.assertEqual({comment['id'] for comment in comments if comment['is_liked']}, liked)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class LikeToggleTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=2, comments=1, depth=0)
+        self.client.force_authenticate(self.author)
+
+    def test_toggle_returns_state_and_count(self):
+        response = self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'article_id': self.article.id, 'liked': True, 'likes': 4})
+        response = self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'article_id': self.article.id, 'liked': False, 'likes': 3})
+
+    def test_unlikes_update_counters_cache_and_subscribers(self):
+        # Unlikes are one DELETE without post_delete signals; likes.py does
+        # what the signal handlers would
+        deleted = []
+        handler = lambda sender, instance, **kwargs: deleted.append(instance.pk)
+        post_delete.connect(handler, sender=Like)
+        self.addCleanup(post_delete.disconnect, handler, sender=Like)
+        layer = get_channel_layer()
+        self.addCleanup(async_to_sync(layer.flush))
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(article_group(self.article.id), channel)
+
+        with mock.patch.object(response_cache, 'invalidate') as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.force_authenticate(self.readers[0])
+            self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+            self.client.force_authenticate(self.readers[1])
+            self.client.post(reverse('like'), {'likes': [{'article_id': self.article.id, 'liked': False}]},
+                             format='json')
+        self.assertEqual(deleted, [])
+        self.assertEqual(list(Like.objects.filter(article=self.article).values_list('user', flat=True)),
+                         [self.readers[2].id])
+        self.assertEqual(Article.objects.get(id=self.article.id).like_count, 1)
+        self.assertEqual(invalidate.call_count, 2)
+        for _ in range(2):
+            event = async_to_sync(layer.receive)(channel)['event']
+            self.assertEqual((event['type'], event['article']), ('likes', -1))
+
+    def test_toggle_validation(self):
+        self.assertEqual(self.client.post(reverse('like'), {}, format='json').status_code, 400)
+        response = self.client.post(reverse('like'), {'article_id': 999999}, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Like.objects.filter(article_id=999999).exists())
+
+    def test_bulk(self):
+        other = Article.objects.exclude(id=self.article.id).get()
+        Like.objects.create(user=self.author, article=other)
+        payload = {'likes': [
+            {'article_id': self.article.id, 'liked': True},
+            {'article_id': other.id},
+            {'comment_id': self.comment.id},
+            {'comment_id': self.comment.id, 'liked': True},
+            {'article_id': 999999, 'liked': True},
+        ]}
+        with self.assertNumQueries(15):
+            response = self.client.post(reverse('like'), payload, format='json')
+        self.assertEqual(response.data['results'], [
+            {'article_id': self.article.id, 'liked': True, 'likes': 4},
+            {'article_id': other.id, 'liked': False, 'likes': 3},
+            {'comment_id': self.comment.id, 'liked': True, 'likes': 2},
+            {'comment_id': self.comment.id, 'liked': True, 'likes': 2},
+            {'article_id': 999999, 'error': 'Not found'},
+        ])
+        self.assertEqual(Like.objects.filter(user=self.author).count(), 2)
+
+    def test_duplicate_likes_are_rejected(self):
+        Like.objects.create(user=self.author, article=self.article)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Like.objects.create(user=self.author, article=self.article)
+        Like.objects.create(user=self.author, comment=self.comment)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Like.objects.create(user=self.author, comment=self.comment)
+
+    def test_bulk_rejects_malformed_items(self):
+        payload = {'likes': [{'article_id': self.article.id}, {'article_id': 1, 'comment_id': 1}, {'liked': 'yes'}]}
+        response = self.client.post(reverse('like'), payload, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['invalid_items'], [1, 2])
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class LikeConcurrencyTests(FreshViewCountsMixin, TransactionTestCase):
+    """Hammers the toggle from many threads; every toggle must be applied
+    exactly once and the counter must match the rows left behind."""
+
+    threads = 8
+    toggles_per_thread = 15
+
+    def test_concurrent_toggles(self):
+        category = Category.objects.create(name='stress')
+        author = User.objects.create_user('stress-author', password='pass')
+        article = Article.objects.create(title='Hot', thumbnail='thumbnails/test.png', content='x',
+                                         category=category, author=author)
+        users = [User.objects.create_user(f'stress{i}', password='pass') for i in range(self.threads)]
+        errors = []
+
+        def hammer(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            try:
+                for _ in range(self.toggles_per_thread):
+                    response = client.post(reverse('like'), {'article_id': article.id}, format='json')
+                    if response.status_code not in (200, 201):
+                        errors.append(response.status_code)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=hammer, args=(user,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        article.refresh_from_db()
+        # An odd number of toggles per user leaves every user liking it
+        expected = self.threads if self.toggles_per_thread % 2 else 0
+        self.assertEqual(Like.objects.filter(article=article).count(), expected)
+        self.assertEqual(article.like_count, expected)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class KeysetPaginationTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=7, comments=1, depth=0)
+        # Identical timestamps force the id tie-breaker to do its job
+        Article.objects.filter(id__in=Article.objects.order_by('id').values('id')[:4]).update(
+            created_at=Article.objects.order_by('id').first().created_at)
+
+    def walk(self, url):
+        ids, pages = [], 0
+        while url:
+            page = self.client.get(url).data
+            ids += [item['id'] for item in page['results']]
+            url, pages = page['next'], pages + 1
+        return ids, pages
+
+    def test_walks_every_article_once_in_order(self):
+        ids, pages = self.walk(reverse('article_list') + '?cursor=&page_size=3&fields=id')
+        expected = list(Article.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_inserts_do_not_shift_later_pages(self):
+        first = self.client.get(reverse('article_list') + '?cursor=&page_size=3&fields=id').data
+        Article.objects.create(title='New', thumbnail='thumbnails/test.png', content='x',
+                               category=self.category, author=self.author)
+        ids, _ = self.walk(first['next'])
+        seen = [item['id'] for item in first['results']] + ids
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), 7)
+
+    def test_previous_link(self):
+        first = self.client.get(reverse('article_list') + '?cursor=&page_size=3&fields=id').data
+        self.assertIsNone(first['previous'])
+        second = self.client.get(first['next']).data
+        back = self.client.get(second['previous']).data
+        self.assertEqual(back['results'], first['results'])
+        self.assertIsNone(back['previous'])
+
+    def test_count_is_opt_in_and_no_offset_is_used(self):
+        url = reverse('article_list') + '?cursor=&fields=id'
+        self.assertNotIn('count', self.client.get(url).data)
+        self.assertEqual(self.client.get(url + '&count=true').data['count'], 7)
+        with self.settings(RESPONSE_CACHE_TIMEOUT=0), CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('OFFSET', queries[0]['sql'])
+
+    def test_comment_replies_oldest_first(self):
+        for i in range(3):
+            Comment.objects.create(article=self.article, user=self.author, content=f'r{i}', parent=self.comment)
+        url = reverse('comment_list') + f'?parent={self.comment.id}&cursor=&page_size=2&fields=content'
+        page = self.client.get(url).data
+        self.assertEqual([c['content'] for c in page['results']], ['r0', 'r1'])
+        self.assertEqual([c['content'] for c in self.client.get(page['next']).data['results']], ['r2'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('article_list') + '?cursor=bogus').status_code, 404)
+
+    def test_page_numbers_still_work_without_cursor(self):
+        page = self.client.get(reverse('article_list') + '?page=2&page_size=5').data
+        self.assertEqual(page['count'], 7)
+        self.assertEqual(len(page['results']), 2)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class SearchTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=0)
+        self.in_title = self.add('Tuning database indexes', 'Notes on btrees.')
+        self.in_content = self.add('Weekly notes', 'Why the database was slow & what fixed it.')
+        self.other = self.add('Cooking', 'Nothing relevant here.')
+
+    def add(self, title, content):
+        return Article.objects.create(title=title, thumbnail='thumbnails/test.png', content=content,
+                                      category=self.category, author=self.author)
+
+    def search(self, query, extra=''):
+        return self.client.get(reverse('article_list') + f'?search={query}{extra}').data['results']
+
+    def test_ranked_with_snippets(self):
+        results = self.search('database')
+        self.assertEqual([item['id'] for item in results], [self.in_title.id, self.in_content.id])
+        self.assertIn('<mark>database</mark>', results[0]['snippet'])
+        self.assertIn('&amp;', results[1]['snippet'])
+        self.assertNotIn('snippet', self.client.get(reverse('article_list')).data['results'][0])
+
+    def test_prefix_and_stemming(self):
+        self.assertEqual([item['id'] for item in self.search('datab')], [self.in_title.id, self.in_content.id])
+        self.assertEqual([item['id'] for item in self.search('index')], [self.in_title.id])
+        self.assertEqual(self.search('"%29%28*'), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.other.title = 'Database cooking'
+        self.other.save()
+        self.assertIn(self.other.id, [item['id'] for item in self.search('database')])
+        self.in_title.delete()
+        self.assertNotIn(self.in_title.id, [hit.article_id for hit in get_backend().search('database', 10)])
+
+    def test_combines_with_category_and_cursor(self):
+        self.assertEqual(self.search('database', f'&category={self.category.id + 1}'), [])
+        results = self.search('database', '&cursor=&fields=id')
+        self.assertEqual([item['id'] for item in results], [self.in_content.id, self.in_title.id])
+
+    def test_rebuild_command(self):
+        Article.objects.bulk_create([Article(title='Bulk database import', thumbnail='thumbnails/test.png',
+                                             content='x', category=self.category, author=self.author)])
+        self.assertEqual(len(self.search('bulk')), 0)
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 4 articles', out.getvalue())
+        self.assertEqual(len(self.search('bulk')), 1)
+
+    @override_settings(SEARCH_BACKEND='myapp.search.LikeSearchBackend')
+    def test_like_backend(self):
+        results = self.search('database')
+        self.assertEqual([item['id'] for item in results], [self.in_title.id, self.in_content.id])
+        self.assertIn('<mark>database</mark>', results[1]['snippet'])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class ResponseCacheTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=2, comments=2, depth=1)
+        self.detail = reverse('article_detail', args=[self.article.id])
+
+    def assertCached(self, url, user=None):
+        self.client.force_authenticate(user)
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        return second
+
+    def test_public_reads_are_cached(self):
+        for url in [reverse('category_list'), reverse('article_list'), reverse('comment_list'),
+                    reverse('user_profile', args=[self.author.id])]:
+            self.assertCached(url)
+        hits = response_cache.stats()['hits']
+        self.client.get(reverse('category_list'))
+        self.assertEqual(response_cache.stats()['hits'], hits + 1)
+
+    def test_logins_do_not_invalidate(self):
+        self.assertCached(reverse('article_list'))
+        response = self.client.post(reverse('token_obtain_pair'),
+                                    {'username': self.readers[0].username, 'password': 'pass'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('article_list'))['X-Cache'], 'HIT')
+
+    def test_writes_invalidate(self):
+        url = reverse('article_list') + '?fields=id,likes,comments_count,category_name'
+        other = Article.objects.exclude(id=self.article.id).get()
+        self.assertCached(url)
+        self.assertCached(reverse('article_detail', args=[other.id]))
+        self.client.force_authenticate(self.readers[0])
+        self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+        self.client.post(reverse('comment_create'), {'article': self.article.id, 'content': 'hi'}, format='json')
+        self.category.name = 'renamed'
+        self.category.save()
+        items = {item['id']: item for item in self.client.get(url).data['results']}
+        self.assertEqual(items[self.article.id]['likes'], 2)
+        self.assertEqual(items[self.article.id]['comments_count'], 5)
+        self.assertEqual(items[other.id]['category_name'], 'renamed')
+
+    def test_comment_likes_and_profiles_invalidate(self):
+        user = self.readers[0]
+        comment_url = reverse('comment_detail', args=[self.comment.id])
+        self.assertCached(self.detail, user)
+        self.assertCached(reverse('user_profile', args=[user.id]))
+        self.client.force_authenticate(user)
+        liked = self.client.post(reverse('like'), {'comment_id': self.comment.id}, format='json').data['liked']
+        comments = self.client.get(self.detail).data['comments']
+        self.assertEqual([c['is_liked'] for c in comments if c['id'] == self.comment.id], [liked])
+        self.assertEqual(self.client.get(comment_url).data['is_liked'], liked)
+        user.profile.bio = 'new bio'
+        user.profile.save()
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('user_profile', args=[user.id])).data['profile']['bio'], 'new bio')
+
+    def test_user_dependent_fields_are_cached_per_user(self):
+        url = reverse('comment_list') + f'?article={self.article.id}&fields=id,is_liked'
+        liked_by = {user.id: {c['id'] for c in self.assertCached(url, user).data if c['is_liked']}
+                    for user in self.readers}
+        self.assertEqual(len(set(map(frozenset, liked_by.values()))), len(self.readers))
+
+    def test_etag(self):
+        url = reverse('category_list')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        Category.objects.create(name='another')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_views_are_counted_on_hits(self):
+        self.assertEqual([self.client.get(self.detail).data['views'] for _ in range(3)], [1, 2, 3])
+        self.assertEqual(self.client.get(self.detail)['X-Cache'], 'HIT')
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.assertEqual(self.client.get(reverse('category_list'))['X-Cache'], 'BYPASS')
+        self.assertEqual(self.client.get(reverse('category_list'))['X-Cache'], 'BYPASS')
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS,
+                   THUMBNAIL_DERIVATIVE_WIDTHS=[320, 640, 1280], PROFILE_PICTURE_DERIVATIVE_WIDTHS=[64, 128],
+                   IMAGE_DERIVATIVE_FORMATS=['webp', 'jpeg'])
+class ImageDerivativeTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=1, comments=0)
+        self.client.force_authenticate(self.author)
+
+    def test_thumbnail_upload(self):
+        data = {'title': 'New', 'content': 'Body', 'category_id': self.category.id, 'thumbnail': make_png()}
+        created = self.client.post(reverse('article_list'), data, format='multipart').data
+        self.assertIsNone(created['thumbnail_srcset'])
+        self.assertEqual(run_pending(), 1)
+        article = Article.objects.get(id=created['id'])
+        self.assertEqual(set(article.thumbnail_derivatives['webp']), {'320', '640'})
+        name = article.thumbnail_derivatives['jpeg']['320']
+        self.assertRegex(name, '^' + re.escape(article.thumbnail.name.rsplit('.', 1)[0]) + r'_320w\.[0-9a-f]{12}\.jpg$')
+        with article.thumbnail.storage.open(name) as file:
+            self.assertEqual(Image.open(file).size, (320, 160))
+
+        srcset = self.client.get(reverse('article_list')).data['results'][0]['thumbnail_srcset']
+        self.assertRegex(srcset['webp'], r'^http://testserver/media/thumbnails/\S+_320w\.\w{12}\.webp 320w, \S+_640w\.\w{12}\.webp 640w$')
+
+        old = article.thumbnail_derivatives['webp']['320']
+        self.client.patch(reverse('article_detail', args=[article.id]),
+                          {'thumbnail': make_png('other.png', (300, 300))}, format='multipart')
+        self.assertTrue(article.thumbnail.storage.exists(old))
+        self.assertEqual(run_pending(), 2)
+        article.refresh_from_db()
+        self.assertFalse(article.thumbnail.storage.exists(old))
+        self.assertEqual(set(article.thumbnail_derivatives['webp']), {'300'})
+
+    def test_title_only_patch_keeps_thumbnail(self):
+        data = {'title': 'New', 'content': 'Body', 'category_id': self.category.id, 'thumbnail': make_png()}
+        created = self.client.post(reverse('article_list'), data, format='multipart').data
+        run_pending()
+        article = Article.objects.get(id=created['id'])
+        derivatives = article.thumbnail_derivatives
+        response = self.client.patch(reverse('article_detail', args=[article.id]), {'title': 'Renamed'},
+                                     format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(run_pending(), 0)
+        article.refresh_from_db()
+        self.assertEqual((article.title, article.thumbnail_derivatives), ('Renamed', derivatives))
+        self.assertTrue(article.thumbnail.storage.exists(article.thumbnail.name))
+
+    def test_profile_picture(self):
+        self.client.put(reverse('profile'), {'profile_picture': make_png('me.png', (100, 100))}, format='multipart')
+        run_pending()
+        profile = self.client.get(reverse('user_profile', args=[self.author.id])).data['profile']
+        self.assertRegex(profile['profile_picture_srcset']['webp'], r'me_64w\.[0-9a-f]{12}\.webp 64w')
+        self.assertNotIn('128w', profile['profile_picture_srcset']['webp'])
+        self.client.put(reverse('profile'), {'profile_picture': 'null'}, format='multipart')
+        self.assertEqual(run_pending(), 1)
+        self.author.profile.refresh_from_db()
+        self.assertEqual(self.author.profile.profile_picture_derivatives, {})
+
+    def test_backfill_command(self):
+        Article.objects.filter(id=self.article.id).update(thumbnail=default_storage.save('thumbnails/old.png', make_png()))
+        broken = Article.objects.create(title='Broken', thumbnail='thumbnails/missing.png', content='x',
+                                        category=self.category, author=self.author)
+        out, err = StringIO(), StringIO()
+        call_command('generate_image_derivatives', workers=2, stdout=out, stderr=err)
+        self.assertIn('Article: 1 images processed, 1 failed', out.getvalue())
+        self.assertIn(f'Article {broken.id}', err.getvalue())
+        self.article.refresh_from_db()
+        self.assertEqual(set(self.article.thumbnail_derivatives['jpeg']), {'320', '640'})
+
+    def test_backfill_never_leaves_maps_pointing_at_deleted_files(self):
+        original = default_storage.save('thumbnails/old.png', make_png())
+        Article.objects.filter(id=self.article.id).update(thumbnail=original)
+        call_command('generate_image_derivatives', workers=1, stdout=StringIO())
+        self.article.refresh_from_db()
+        derivatives = self.article.thumbnail_derivatives
+        names = stored_files(None, derivatives)
+
+        # Re-rendered files come out under the same names and are kept
+        call_command('generate_image_derivatives', workers=1, force=True, stdout=StringIO())
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.thumbnail_derivatives, derivatives)
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+
+        # A render that fails keeps the old map and its files
+        default_storage.delete(original)
+        call_command('generate_image_derivatives', workers=1, force=True, stdout=StringIO(), stderr=StringIO())
+        self.article.refresh_from_db()
+        self.assertEqual(self.article.thumbnail_derivatives, derivatives)
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, MEDIA_URL='/media/', MEDIA_SERVE_DIRS=['thumbnails', 'profile_pics'],
+                   MEDIA_MAX_AGE=60)
+class MediaServingTests(FreshViewCountsMixin, SimpleTestCase):
+    def setUp(self):
+        self.client = Client()
+        self.body = bytes(range(256)) * 4
+        self.plain = self.write('thumbnails/media-test.png', self.body)
+        self.hashed = self.write('thumbnails/media-test_320w.0123456789ab.webp', self.body)
+
+    def write(self, name, content):
+        path = Path(TEST_MEDIA_ROOT) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        self.addCleanup(path.unlink, missing_ok=True)
+        return '/media/' + name
+
+    def test_caching_headers(self):
+        response = self.client.get(self.plain)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        # Strong, from the bytes
+        self.assertEqual(response['ETag'], f'"{md5(self.body).hexdigest()}"')
+
+        response = self.client.get(self.hashed)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['ETag'], '"0123456789ab"')
+
+    def test_conditional_requests(self):
+        etag = self.client.get(self.plain)['ETag']
+        response = self.client.get(self.plain, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        # A new file under the same name gets a new ETag
+        self.write('thumbnails/media-test.png', b'replaced')
+        response = self.client.get(self.plain, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'replaced')
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.plain, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.body)}')
+        self.assertEqual(b''.join(response.streaming_content), self.body[10:20])
+        response = self.client.get(self.plain, HTTP_RANGE='bytes=-4')
+        self.assertEqual(b''.join(response.streaming_content), self.body[-4:])
+        response = self.client.get(self.plain, HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.body)}')
+
+    def test_precompressed_variant_and_head(self):
+        self.write('thumbnails/media-test.png.gz', b'gzipped')
+        response = self.client.get(self.plain, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(b''.join(response.streaming_content), b'gzipped')
+        self.assertNotIn('Content-Encoding', self.client.get(self.plain))
+
+        response = self.client.head(self.hashed)
+        self.assertEqual((response.status_code, response['Content-Length']), (200, str(len(self.body))))
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    def test_only_media_directories(self):
+        other = self.write('exports/media-test.png', self.body)
+        for url in [other, '/media/thumbnails/missing.png', '/media/thumbnails/../exports/media-test.png',
+                    '/media/thumbnails/']:
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+        self.assertEqual(self.client.post(self.plain).status_code, 405)
+
+    async def test_async_middleware_keeps_file_work_off_the_event_loop(self):
+        loop_thread = threading.current_thread()
+        hashed_on = []
+
+        def etag(path):
+            hashed_on.append(threading.current_thread())
+            return file_etag(path)
+
+        with mock.patch('myapp.media.file_etag', etag):
+            response = await AsyncClient().get(self.plain)
+        self.assertEqual(response['ETag'], f'"{md5(self.body).hexdigest()}"')
+        self.assertEqual(len(hashed_on), 1)
+        self.assertIsNot(hashed_on[0], loop_thread)
+        self.assertEqual((await AsyncClient().get('/media/thumbnails/missing.png')).status_code, 404)
+
+        response = await AsyncClient().get(self.hashed, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.body[:10])
+
+
+FLAKY_CALLS = []
+
+
+@task('test_flaky')
+def flaky(fail_times):
+    FLAKY_CALLS.append(fail_times)
+    if len(FLAKY_CALLS) <= fail_times:
+        raise RuntimeError('try again')
+
+
+@override_settings(JOB_QUEUE_MAX_ATTEMPTS=3, JOB_QUEUE_RETRY_BASE_DELAY=10)
+class JobQueueTests(FreshViewCountsMixin, TestCase):
+    def setUp(self):
+        FLAKY_CALLS.clear()
+
+    def make_due(self):
+        Job.objects.filter(status=Job.QUEUED).update(run_at=timezone.now())
+
+    def test_retries_with_backoff(self):
+        job = enqueue('test_flaky', 2)
+        self.assertEqual(run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('try again', job.last_error)
+        self.assertGreaterEqual(job.run_at, timezone.now() + timedelta(seconds=4))
+        self.assertEqual(run_pending(), 0)
+        self.make_due()
+        run_pending()
+        self.make_due()
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 3))
+        self.assertEqual(queue_stats()['depth'][Job.DONE], 1)
+
+    def test_gives_up_after_max_attempts(self):
+        job = enqueue('test_flaky', 10)
+        for _ in range(3):
+            self.make_due()
+            run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 3))
+        self.assertEqual(len(FLAKY_CALLS), 3)
+
+    def test_idempotency_key(self):
+        first = enqueue('test_flaky', 0, key='once')
+        self.assertEqual(enqueue('test_flaky', 0, key='once').id, first.id)
+        self.assertEqual(run_pending(), 1)
+        self.assertNotEqual(enqueue('test_flaky', 0, key='once').id, first.id)
+        with self.assertRaises(KeyError):
+            enqueue('no_such_job')
+
+    def test_stale_jobs_are_requeued(self):
+        job = enqueue('test_flaky', 0)
+        Job.objects.filter(id=job.id).update(status=Job.RUNNING, started_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual(run_pending(), 1)
+
+    @override_settings(JOB_QUEUE_KEEP_DONE=3600, JOB_QUEUE_KEEP_FAILED=None)
+    def test_finished_jobs_are_purged(self):
+        now = timezone.now()
+        jobs = [enqueue('test_flaky', 0) for _ in range(5)]
+        for job, status, finished in [(jobs[0], Job.DONE, now - timedelta(hours=2)), (jobs[1], Job.DONE, now),
+                                      (jobs[2], Job.FAILED, now - timedelta(days=90)),
+                                      (jobs[3], Job.DONE, now - timedelta(days=2))]:
+            Job.objects.filter(id=job.id).update(status=status, finished_at=finished)
+        self.assertEqual(purge_finished(batch_size=1), 2)
+        self.assertEqual(set(Job.objects.values_list('id', flat=True)), {jobs[1].id, jobs[2].id, jobs[4].id})
+
+
+@override_settings(JOB_QUEUE_POLL_INTERVAL=0.01)
+class JobWorkerTests(FreshViewCountsMixin, TransactionTestCase):
+    def test_run_jobs_command(self):
+        FLAKY_CALLS.clear()
+        for i in range(20):
+            enqueue('test_flaky', 0, key=f'job-{i}')
+        out = StringIO()
+        call_command('run_jobs', threads=3, once=True, stats_interval=0, stdout=out)
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), 20)
+        self.assertEqual(len(FLAKY_CALLS), 20)
+        self.assertIn('"done": 20', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class ExportTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=3, comments=2, depth=1)
+        self.first_category = self.category
+        self.create_dataset(articles=2, comments=1, depth=0)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.force_authenticate(self.admin)
+
+    def export(self, resource, query=''):
+        response = self.client.get(reverse('export', args=[resource]) + query)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_ndjson_with_filters(self):
+        response, body = self.export('articles', f'?category={self.first_category.id}')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        expected = Article.objects.filter(category=self.first_category).order_by('id')
+        self.assertEqual([row['id'] for row in rows], [article.id for article in expected])
+        self.assertEqual(rows[0]['category'], self.first_category.name)
+        self.assertEqual(rows[0]['likes'], 3)
+
+        _, body = self.export('comments', f'?author={self.readers_of_last()}&since=2000-01-01&until=2999-01-01')
+        self.assertTrue(body)
+        _, body = self.export('articles', '?until=2000-01-01')
+        self.assertEqual(body, b'')
+
+    def readers_of_last(self):
+        return Comment.objects.order_by('-id').first().user_id
+
+    def test_csv_and_cursor(self):
+        _, body = self.export('users', '?as=csv')
+        rows = list(csv.reader(body.decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'username', 'email', 'is_staff', 'is_active', 'bio', 'date_joined'])
+        self.assertEqual(len(rows) - 1, User.objects.count())
+        self.assertNotIn('password', body.decode())
+
+        ids = list(Comment.objects.order_by('id').values_list('id', flat=True))
+        _, body = self.export('comments', f'?as=csv&cursor={ids[4]}')
+        self.assertEqual([int(row[0]) for row in list(csv.reader(body.decode().splitlines()))[1:]], ids[5:])
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        _, body = self.export('articles', '?as=parquet')
+        table = pq.read_table(BytesIO(body))
+        self.assertEqual(table.column('id').to_pylist(), list(Article.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_validation_and_permissions(self):
+        for query in ['?as=xml', '?category=abc', '?since=yesterday']:
+            self.assertEqual(self.client.get(reverse('export', args=['articles']) + query).status_code, 400)
+        self.assertEqual(self.client.get(reverse('export', args=['users']) + '?category=1').status_code, 400)
+        self.assertEqual(self.client.get(reverse('export', args=['likes'])).status_code, 400)
+        self.client.force_authenticate(self.author)
+        self.assertEqual(self.client.get(reverse('export', args=['articles'])).status_code, 403)
+
+    async def test_streams_chunk_by_chunk_under_asgi(self):
+        access = await sync_to_async(lambda: str(token_for(self.admin).access_token))()
+        response = await AsyncClient().get(reverse('export', args=['comments']) + '?as=csv',
+                                           headers={'Authorization': f'Bearer {access}'})
+        self.assertEqual(response.status_code, 200)
+        # Not read to the end by Django before the first byte goes out
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(body.splitlines()) - 1, await Comment.objects.acount())
+
+    def test_constant_queries_and_command(self):
+        with self.assertNumQueries(1):
+            _, body = self.export('comments', '')
+        self.assertEqual(len(body.splitlines()), Comment.objects.count())
+        out = StringIO()
+        call_command('export_data', 'articles', '--format', 'csv', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), Article.objects.count() + 1)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS)
+class IngestTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=2, comments=1, depth=0)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.force_authenticate(self.admin)
+
+    def ingest(self, resource, rows, query=''):
+        body = ''.join(row if isinstance(row, str) else json.dumps(row) + '\n' for row in rows)
+        return self.client.generic('POST', reverse('ingest', args=[resource]) + query, body,
+                                   content_type='application/x-ndjson')
+
+    def test_articles_with_bad_rows(self):
+        rows = [
+            {'title': 'One', 'content': 'Imported fjordic text', 'category': self.category.name,
+             'author': self.author.username, 'created_at': '2020-05-01T10:00:00Z'},
+            {'title': 'Two', 'content': 'Body', 'category': 'Brand new', 'author_id': self.author.id},
+            {'title': 'Three', 'content': 'Body', 'category_id': self.category.id},
+            'not json\n',
+            {'title': '', 'content': 'Body', 'category': 'x'},
+            {'title': 'Six', 'content': 'Body', 'category': 'x', 'author': 'nobody'},
+            {'title': 'Seven', 'content': 'Body', 'category_id': 999999},
+        ]
+        response = self.ingest('articles', rows, '?chunk_size=2')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual(response.data['failed'], 4)
+        self.assertEqual([error['line'] for error in response.data['errors']], [4, 5, 6, 7])
+        self.assertIn('title', response.data['errors'][1]['errors'])
+
+        one = Article.objects.get(title='One')
+        self.assertEqual(one.created_at.year, 2020)
+        self.assertEqual(Article.objects.get(title='Two').category.name, 'Brand new')
+        # Rows without an author belong to whoever imports them
+        self.assertEqual(Article.objects.get(title='Three').author, self.admin)
+        self.assertEqual([hit.article_id for hit in get_backend().search('fjordic', 10)], [one.id])
+
+    def test_comments_update_counters(self):
+        reply_to = self.comment
+        rows = [
+            {'article_id': self.article.id, 'content': 'Top level', 'user': self.author.username},
+            {'article_id': self.article.id, 'parent_id': reply_to.id, 'content': 'Reply'},
+            {'article_id': Article.objects.exclude(id=self.article.id).first().id, 'parent_id': reply_to.id,
+             'content': 'Reply on the wrong article'},
+            {'article_id': 999999, 'content': 'Lost'},
+        ]
+        response = self.ingest('comments', rows)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 2))
+        self.article.refresh_from_db()
+        reply_to.refresh_from_db()
+        self.assertEqual(self.article.comment_count, Comment.objects.filter(article=self.article).count())
+        self.assertEqual(reply_to.reply_count, 1)
+
+    def test_queries_per_chunk_and_cache(self):
+        self.assertEqual(self.client.get(reverse('article_list'))['X-Cache'], 'MISS')
+        rows = [{'title': f'Bulk {i}', 'content': 'Body', 'category': self.category.name} for i in range(30)]
+        with CaptureQueriesContext(connection) as small:
+            self.ingest('articles', rows[:10])
+        with CaptureQueriesContext(connection) as large:
+            self.ingest('articles', rows)
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(self.client.get(reverse('article_list'))['X-Cache'], 'MISS')
+
+    def test_validation_permissions_and_command(self):
+        self.assertEqual(self.ingest('likes', []).status_code, 400)
+        self.assertEqual(self.ingest('articles', [], '?chunk_size=x').status_code, 400)
+        self.client.force_authenticate(self.author)
+        self.assertEqual(self.ingest('articles', []).status_code, 403)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as source:
+            source.write(json.dumps({'title': 'From file', 'content': 'Body', 'category': 'Files'}) + '\n')
+            source.flush()
+            out = StringIO()
+            call_command('ingest', 'articles', source.name, '--default-author', self.author.username,
+                         '--no-create-categories', stdout=out, stderr=StringIO())
+            self.assertIn('0 created, 1 failed', out.getvalue())
+            call_command('ingest', 'articles', source.name, '--default-author', self.author.username, stdout=out)
+        self.assertEqual(Article.objects.get(title='From file').author, self.author)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, AUTH_STATE_TTL=60)
+class StatelessAuthTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=1, comments=1, depth=0)
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+
+    def login(self, user):
+        response = self.client.post(reverse('token_obtain_pair'), {'username': user.username, 'password': 'pass'},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def get(self, url, access):
+        return self.client.get(url, HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def test_requests_are_served_from_claims(self):
+        tokens = self.login(self.author)
+        # The version check is a cache hit; only the profile itself is loaded
+        with self.assertNumQueries(1):
+            response = self.get(reverse('profile'), tokens['access'])
+        self.assertEqual(response.data['email'], self.author.email)
+        self.assertEqual(response.data['username'], self.author.username)
+
+        response = self.client.post(reverse('comment_create'), {'article': self.article.id, 'content': 'Hi'},
+                                    HTTP_AUTHORIZATION=f"Bearer {tokens['access']}", format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Comment.objects.get(content='Hi').user, self.author)
+        self.assertEqual(self.get(reverse('user_list'), tokens['access']).status_code, 403)
+
+    def test_make_admin_revokes_tokens_until_refreshed(self):
+        tokens = self.login(self.author)
+        admin_tokens = self.login(self.admin)
+        response = self.client.post(reverse('make_admin', args=[self.author.id]),
+                                    HTTP_AUTHORIZATION=f"Bearer {admin_tokens['access']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(reverse('profile'), tokens['access']).status_code, 401)
+
+        refreshed = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json').data
+        self.assertEqual(self.get(reverse('user_list'), refreshed['access']).status_code, 200)
+
+    def test_suspended_users_lose_access(self):
+        tokens = self.login(self.author)
+        admin_tokens = self.login(self.admin)
+        self.client.post(reverse('suspend_user', args=[self.author.id]),
+                         HTTP_AUTHORIZATION=f"Bearer {admin_tokens['access']}")
+        self.assertEqual(self.get(reverse('profile'), tokens['access']).status_code, 401)
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_suspension_revokes_tokens_itself(self):
+        tokens = self.login(self.author)
+        admin_tokens = self.login(self.admin)
+        self.assertEqual(self.get(reverse('profile'), tokens['access']).status_code, 200)
+        # Not left to the delete signal
+        with mock.patch('myapp.signals.forget_user_state'):
+            response = self.client.post(reverse('suspend_user', args=[self.author.id]),
+                                        HTTP_AUTHORIZATION=f"Bearer {admin_tokens['access']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(reverse('profile'), tokens['access']).status_code, 401)
+
+    def test_tokens_without_claims_still_work(self):
+        access = RefreshToken.for_user(self.author).access_token
+        response = self.get(reverse('profile'), str(access))
+        self.assertEqual(response.data['username'], self.author.username)
+
+
+class DatabaseSettingsTests(FreshViewCountsMixin, TestCase):
+    def test_sqlite_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def test_settings_from_environment(self):
+        with mock.patch.dict('os.environ', {'SQLITE_BUSY_TIMEOUT': '3', 'DATABASE_CONN_MAX_AGE': '0'}):
+            databases = database_settings(Path('/tmp'))
+        self.assertEqual(list(databases), ['default'])
+        self.assertEqual(databases['default']['OPTIONS']['timeout'], 3)
+        self.assertEqual(databases['default']['CONN_MAX_AGE'], 0)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, RESPONSE_CACHE_TIMEOUT=0)
+class ReplicaRoutingTests(FreshViewCountsMixin, APITestMixin, TransactionTestCase):
+    """A second SQLite file stands in for a replica that lags behind."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added once the test runner has set up the configured databases;
+        # connections.settings is settings.DATABASES, so the router sees it
+        cls.directory = tempfile.mkdtemp()
+        connections.settings['replica_0'] = dict(connection.settings_dict,
+                                                 NAME=os.path.join(cls.directory, 'replica.sqlite3'))
+        cls.databases = cls.databases | {'replica_0'}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica_0'].close()
+        del connections['replica_0']
+        del connections.settings['replica_0']
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=2, comments=1, depth=0)
+        connections['replica_0'].close()
+        self.assertEqual(sync_sqlite_replicas(), ['replica_0'])
+        self.fresh = Article.objects.create(title='Not replicated yet', content='Body', category=self.category,
+                                            author=self.author)
+
+    def listed_ids(self, client):
+        return {article['id'] for article in client.get(reverse('article_list')).data['results']}
+
+    def test_reads_go_to_the_replica(self):
+        self.assertNotIn(self.fresh.id, self.listed_ids(self.client))
+        self.assertEqual(self.client.get(reverse('article_detail', args=[self.fresh.id])).status_code, 404)
+        # Outside the read-only views everything uses the primary
+        self.assertEqual(Article.objects.count(), 3)
+        sync_sqlite_replicas()
+        self.assertIn(self.fresh.id, self.listed_ids(self.client))
+
+    def test_writers_read_their_writes(self):
+        writer = APIClient()
+        writer.force_authenticate(self.readers[0])
+        response = writer.post(reverse('comment_create'), {'article': self.fresh.id, 'content': 'First'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.assertIn(self.fresh.id, self.listed_ids(writer))
+
+        # Pinned by user as well, for clients without cookies
+        other_device = APIClient()
+        other_device.force_authenticate(self.readers[0])
+        self.assertIn(self.fresh.id, self.listed_ids(other_device))
+        # Everyone else still reads from the replica
+        self.assertNotIn(self.fresh.id, self.listed_ids(self.client))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, RESPONSE_CACHE_TIMEOUT=0)
+class MetricsTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=2, comments=2, depth=1)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_route_histograms_and_server_timing(self):
+        labels = {'method': 'GET', 'route': '/api/articles/<int:pk>/'}
+        requests = self.sample('http_request_db_queries_count', **labels)
+        queries = self.sample('http_request_db_queries_sum', **labels)
+
+        response = self.client.get(reverse('article_detail', args=[self.article.id]))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'serialize', 'render', 'total'})
+        self.assertIn('desc="2 queries"', timing['db'])
+
+        self.assertEqual(self.sample('http_request_db_queries_count', **labels), requests + 1)
+        self.assertEqual(self.sample('http_request_db_queries_sum', **labels), queries + 2)
+        self.assertGreater(self.sample('http_request_serialize_duration_seconds_sum', **labels), 0)
+        self.assertGreater(self.sample('http_response_size_bytes_sum', **labels), 0)
+
+    @override_settings(METRICS_TOKEN='secret', THROTTLE_RATES={'metrics': {'ip': '3/m'}})
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('category_list'))
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        body = response.content.decode()
+        self.assertIn('http_request_duration_seconds_bucket{', body)
+        self.assertIn('route="/api/categories/"', body)
+        self.assertIn('job_queue_depth{status="queued"}', body)
+        self.assertIn('response_cache_events{event="hits"}', body)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+    @override_settings(METRICS_TOKEN=None, THROTTLE_RATES={})
+    def test_metrics_need_a_token_outside_debug(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        with self.settings(DEBUG=True):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    def test_slow_requests_log_their_sql(self):
+        with self.settings(SLOW_REQUEST_THRESHOLD_MS=0), self.assertLogs('myapp.slow_requests') as logs:
+            self.client.get(reverse('comment_list'))
+        self.assertIn('/api/comments/', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, RESPONSE_CACHE_TIMEOUT=0,
+                   SLOW_REQUEST_THRESHOLD_MS=None, THROTTLE_RATES={})
+class LoadTestTests(FreshViewCountsMixin, TransactionTestCase):
+    def test_every_route_is_driven(self):
+        seed_dataset(users=20, categories=3, articles=20, comments_per_article=4, thread_depth=2,
+                     likes_per_article=3)
+        load_test = LoadTest(clients=2, requests=4, client_users=5)
+        routes = {route for route, _ in load_test.scenarios().values()}
+        self.assertEqual(routes, {pattern.name for pattern in urlpatterns})
+
+        with mock.patch('myapp.loadtest.in_throwaway_database', return_value=True):
+            load_test.prepare()
+        report = load_test.run()
+        for name, result in report.items():
+            self.assertEqual(result['requests'], 4, name)
+            self.assertEqual(result['errors'], 0, (name, result['statuses']))
+            self.assertEqual(set(result['latency']), {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'})
+        self.assertGreater(report['article_detail']['queries']['mean'], 0)
+        self.assertGreater(report['comment_create']['queries']['mean'], 0)
+        json.dumps(report)
+
+    def test_refuses_to_run_against_a_real_database(self):
+        seed_dataset(users=5, categories=1, articles=2, comments_per_article=0, likes_per_article=0)
+        passwords = dict(User.objects.values_list('id', 'password'))
+        with self.assertRaises(RuntimeError):
+            LoadTest(clients=1, requests=1).prepare()
+        self.assertEqual(dict(User.objects.values_list('id', 'password')), passwords)
+        self.assertFalse(User.objects.filter(is_superuser=True).exists())
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, THROTTLE_RATES={
+    'like': {'user': '2/m', 'ip': '3/m'},
+    'register': {'ip': '1/h'},
+    'token_refresh': {'ip': '1/m'},
+})
+class ThrottleTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=1, comments=0)
+        get_store().clear()
+
+    def like(self, user, **extra):
+        self.client.force_authenticate(user)
+        return self.client.post(reverse('like'), {'article_id': self.article.id}, format='json', **extra)
+
+    def test_user_and_ip_buckets(self):
+        first, second, third = self.readers
+        self.assertEqual(self.like(first).status_code, 200)
+        self.assertEqual(self.like(first).status_code, 201)
+        # The refused request never reaches the view or the database
+        with self.assertNumQueries(0):
+            response = self.like(first)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+        # Another user has a bucket of their own, but shares the address
+        self.assertEqual(self.like(second).status_code, 200)
+        self.assertEqual(self.like(second).status_code, 429)
+        self.assertEqual(self.like(third, REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_refused_address_leaves_user_bucket_alone(self):
+        first, second, third = self.readers
+        for user in (first, second, first):
+            self.assertEqual(self.like(user).status_code // 100, 2)
+        self.assertEqual(self.like(third).status_code, 429)
+        self.assertEqual(self.like(third, REMOTE_ADDR='10.0.0.2').status_code, 200)
+        self.assertEqual(self.like(third, REMOTE_ADDR='10.0.0.2').status_code, 201)
+
+    def test_forwarded_for_cannot_be_spoofed(self):
+        data = {'username': 'newcomer', 'email': 'new@example.com', 'password': 'pass'}
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          HTTP_X_FORWARDED_FOR='1.1.1.1').status_code, 201)
+        data['username'] = 'second'
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          HTTP_X_FORWARDED_FOR='2.2.2.2').status_code, 429)
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1})
+    def test_forwarded_for_behind_a_proxy(self):
+        data = {'username': 'newcomer', 'email': 'new@example.com', 'password': 'pass'}
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          HTTP_X_FORWARDED_FOR='1.1.1.1').status_code, 201)
+        data['username'] = 'second'
+        # The proxy appends the address it saw to whatever the client sent
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          HTTP_X_FORWARDED_FOR='2.2.2.2, 1.1.1.1').status_code, 429)
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          HTTP_X_FORWARDED_FOR='2.2.2.2').status_code, 201)
+
+    def test_anonymous_routes_limit_by_address(self):
+        data = {'username': 'newcomer', 'email': 'new@example.com', 'password': 'pass'}
+        self.assertEqual(self.client.post(reverse('register'), data, format='json').status_code, 201)
+        data['username'] = 'second'
+        self.assertEqual(self.client.post(reverse('register'), data, format='json').status_code, 429)
+        self.assertEqual(self.client.post(reverse('register'), data, format='json',
+                                          REMOTE_ADDR='10.0.0.2').status_code, 201)
+
+        refresh = str(RefreshToken.for_user(self.author))
+        self.assertEqual(self.client.post(reverse('token_refresh'), {'refresh': refresh}).status_code, 200)
+        self.assertEqual(self.client.post(reverse('token_refresh'), {'refresh': refresh}).status_code, 429)
+        # Unthrottled routes are not counted
+        for _ in range(5):
+            self.assertEqual(self.client.get(reverse('category_list')).status_code, 200)
+
+    def test_bucket_refills(self):
+        store = LocalMemoryStore()
+        with mock.patch('myapp.throttling.time.monotonic', return_value=100.0) as clock:
+            self.assertEqual([store.take('k', 2, 1.0)[0] for _ in range(3)], [True, True, False])
+            self.assertEqual(store.take('k', 2, 1.0), (False, 1.0))
+            clock.return_value = 101.5
+            self.assertEqual(store.take('k', 2, 1.0), (True, 0))
+            self.assertEqual(store.take('k', 2, 1.0), (False, 0.5))
+        self.assertEqual(parse_rate('30/m'), (30, 0.5))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, RESPONSE_CACHE_TIMEOUT=0,
+                   TRENDING_WEIGHTS={'views': 0.1, 'likes': 1.0, 'comments': 2.0}, TRENDING_HALF_LIFE_HOURS=24)
+class TrendingTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.create_dataset(articles=4, comments=0)
+        self.other = Category.objects.create(name='Other')
+        now = timezone.now()
+        # (views, likes, comments, age in hours)
+        engagement = [(0, 0, 0, 0), (100, 20, 5, 2), (5000, 200, 50, 24 * 10), (100, 20, 5, 26)]
+        self.ids = list(Article.objects.order_by('id').values_list('id', flat=True))
+        for pk, (views, likes, comments, hours) in zip(self.ids, engagement):
+            Article.objects.filter(pk=pk).update(views=views, like_count=likes, comment_count=comments,
+                                                 created_at=now - timedelta(hours=hours))
+
+    def trending(self, query=''):
+        response = self.client.get(reverse('article_list') + '?ordering=trending' + query)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_migration_backfills_existing_articles(self):
+        backfill = import_module('myapp.migrations.0014_backfill_trending_scores').backfill_trending_scores
+        Article.objects.update(trending_score=0)
+        # Scored as the default settings did, not as the current ones do
+        backfill(django_apps, connection.schema_editor())
+        with self.settings(TRENDING_WEIGHTS={'views': 0.05, 'likes': 1.0, 'comments': 2.0},
+                           TRENDING_HALF_LIFE_HOURS=36):
+            for article in Article.objects.all():
+                self.assertAlmostEqual(article.trending_score, score_article(article), places=6)
+            self.assertEqual(recompute_trending()['updated'], 0)
+
+    def test_job_rescores_engagement_and_stays_queued(self):
+        recompute_trending()
+        Article.objects.filter(pk=self.ids[0]).update(like_count=500)
+        job = schedule_recompute()
+        self.assertEqual(schedule_recompute(), job)
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(self.trending()['results'][0]['id'], self.ids[0])
+        # The next run is queued an interval later
+        queued = Job.objects.get(name='recompute_trending', status=Job.QUEUED)
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(seconds=250))
+
+    def test_recompute_orders_by_decayed_engagement(self):
+        # The first article's score from when it was created still holds
+        self.assertEqual(recompute_trending(), {'articles': 4, 'updated': 3, 'seconds': mock.ANY})
+        # A day of age halves the weight: ten days outweigh twenty times the
+        # engagement
+        expected = [self.ids[1], self.ids[3], self.ids[0], self.ids[2]]
+        self.assertEqual([article['id'] for article in self.trending()['results']], expected)
+        # Nothing moved, nothing written
+        with self.assertNumQueries(1):
+            self.assertEqual(recompute_trending()['updated'], 0)
+
+        Article.objects.filter(pk=self.ids[2]).update(like_count=100000)
+        self.assertEqual(recompute_trending(ids=[self.ids[2], self.ids[3]], chunk_size=1)['updated'], 1)
+        self.assertEqual(self.trending()['results'][0]['id'], self.ids[2])
+
+    def test_category_filter_and_keyset_pages(self):
+        recompute_trending()
+        Article.objects.filter(pk=self.ids[3]).update(category=self.other)
+        self.assertEqual([article['id'] for article in self.trending(f'&category={self.other.id}')['results']],
+                         [self.ids[3]])
+
+        page = self.trending('&cursor=&page_size=3')
+        self.assertEqual([article['id'] for article in page['results']], [self.ids[1], self.ids[3], self.ids[0]])
+        page = self.client.get(page['next']).data
+        self.assertEqual([article['id'] for article in page['results']], [self.ids[2]])
+        self.assertEqual(self.client.get(reverse('article_list') + '?ordering=trending&cursor=bad').status_code, 404)
+
+    def test_new_articles_are_scored(self):
+        recompute_trending()
+        article = Article.objects.create(title='Fresh', content='Body', category=self.category, author=self.author)
+        self.assertAlmostEqual(article.trending_score, score_article(article))
+        # Ahead of the older article without engagement
+        self.assertEqual([article['id'] for article in self.trending()['results']],
+                         [self.ids[1], self.ids[3], article.id, self.ids[0], self.ids[2]])
+        self.assertEqual(recompute_trending()['updated'], 0)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, RESPONSE_CACHE_TIMEOUT=0)
+class RecommendationTests(FreshViewCountsMixin, TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='myapp-test-recommendations-')
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(self.settings(RECOMMENDATIONS_DIR=directory))
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Topics')
+        self.author = User.objects.create_user('author', password='pass')
+        texts = ['Python django ORM queries', 'Python django views and templates', 'Gardening tomatoes in soil',
+                 'Gardening roses, soil and compost', 'Python asyncio event loops']
+        self.articles = [self.create_article(text) for text in texts]
+        self.users = [User.objects.create_user(f'reader{i}', password='pass') for i in range(4)]
+        likes = [(0, [0, 1]), (1, [0, 1, 2]), (2, [2, 3]), (3, [0])]
+        for user, liked in likes:
+            for article in liked:
+                Like.objects.create(user=self.users[user], article=self.articles[article])
+
+    def create_article(self, title):
+        return Article.objects.create(title=title, content=title, category=self.category,
+                                      author=self.author, thumbnail='thumbnails/test.png')
+
+    def related(self, article):
+        response = self.client.get(reverse('article_related', args=[article.id]))
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data]
+
+    def test_related_articles_blend_likes_and_text(self):
+        result = build_recommendations()
+        self.assertEqual(result, {'articles': 5, 'scored': 5, 'users': 4, 'matrix_bytes': mock.ANY,
+                                  'seconds': mock.ANY})
+        ids = [article.id for article in self.articles]
+        # Liked by the same readers and about the same thing, then liked by
+        # one of them, then only about the same thing
+        self.assertEqual(self.related(self.articles[0]), [ids[1], ids[2], ids[4]])
+        self.assertEqual(self.related(self.articles[3])[0], ids[2])
+        self.assertNotIn(ids[0], self.related(self.articles[0]))
+        stored = RelatedArticles.objects.get(article=self.articles[0])
+        self.assertEqual(stored.scores, sorted(stored.scores, reverse=True))
+
+        response = self.client.get(reverse('article_related', args=[ids[0]]) + '?fields=id,title')
+        self.assertEqual(set(response.data[0]), {'id', 'title'})
+        self.assertEqual(self.client.get(reverse('article_related', args=[9999])).status_code, 404)
+
+    def test_user_recommendations_leave_out_liked_articles(self):
+        build_recommendations()
+        ids = [article.id for article in self.articles]
+        self.client.force_authenticate(self.users[3])
+        recommended = [item['id'] for item in self.client.get(reverse('recommendations')).data]
+        self.assertEqual(recommended[0], ids[1])
+        self.assertNotIn(ids[0], recommended)
+
+        # Nothing liked yet: trending articles
+        newcomer = User.objects.create_user('newcomer', password='pass')
+        self.client.force_authenticate(newcomer)
+        self.assertEqual(len(self.client.get(reverse('recommendations')).data), 5)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('recommendations')).status_code, 401)
+
+    def test_update_scores_only_new_articles(self):
+        build_recommendations()
+        Job.objects.all().delete()
+        fresh = self.create_article('Python django ORM migrations')
+        self.assertEqual(Job.objects.filter(name='update_recommendations', status=Job.QUEUED).count(), 1)
+        self.create_article('Python django ORM admin')
+        self.assertEqual(Job.objects.filter(name='update_recommendations').count(), 1)
+
+        self.articles[4].delete()
+        result = build_recommendations(update=True)
+        self.assertEqual((result['articles'], result['scored']), (6, 2))
+        self.assertIn(self.articles[0].id, self.related(fresh))
+        # New articles join the lists of their neighbours too
+        self.assertIn(fresh.id, self.related(self.articles[0]))
+        self.assertNotIn(self.articles[4].id, self.related(self.articles[0]))
+        self.assertEqual(build_recommendations(update=True)['scored'], 0)
+
+    def test_update_rebuilds_only_affected_users(self):
+        build_recommendations()
+        built = dict(UserRecommendations.objects.values_list('user_id', 'built_at'))
+        fresh = self.create_article('Gardening compost and soil')
+        result = build_recommendations(update=True)
+        # Only the gardening lists took the new article: their readers are rescored
+        self.assertEqual(result['users'], 2)
+        rebuilt = {user_id for user_id, built_at in UserRecommendations.objects.values_list('user_id', 'built_at')
+                   if built_at != built[user_id]}
+        self.assertEqual(rebuilt, {self.users[1].id, self.users[2].id})
+        self.client.force_authenticate(self.users[2])
+        self.assertIn(fresh.id, [item['id'] for item in self.client.get(reverse('recommendations')).data])
+
+    def test_missing_state_falls_back_to_full_build(self):
+        self.assertEqual(build_recommendations(update=True)['scored'], 5)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, THROTTLE_RATES={})
+class RealtimeTests(FreshViewCountsMixin, APITestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.readers = self.create_dataset(articles=2, comments=1, depth=0)
+        self.layer = get_channel_layer()
+        self.addCleanup(async_to_sync(self.layer.flush))
+        self.group = article_group(self.article.id)
+
+    def subscribe(self):
+        channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(self.group, channel)
+        return lambda: async_to_sync(self.layer.receive)(channel)['event']
+
+    def test_writes_are_published_once_committed(self):
+        receive = self.subscribe()
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('comment_create'), {'article': self.article.id, 'content': 'Hi'}, format='json')
+        comment = Comment.objects.latest('id')
+        # Nothing is sent until the transaction commits
+        self.assertEqual(self.layer.channels, {})
+        for callback in callbacks:
+            callback()
+        event = receive()
+        self.assertEqual(event['type'], 'comment.created')
+        self.assertEqual((event['comment']['id'], event['comment']['content']), (comment.id, 'Hi'))
+        self.assertEqual(event['comment']['user']['username'], self.author.username)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('like'), {'article_id': self.article.id}, format='json')
+            self.client.post(reverse('like'), {'likes': [{'comment_id': self.comment.id}]}, format='json')
+            self.client.delete(reverse('comment_detail', args=[comment.id]))
+        self.assertEqual(receive(), {'type': 'likes', 'article': 1, 'comments': {}})
+        self.assertEqual(receive(), {'type': 'likes', 'article': 0, 'comments': {str(self.comment.id): 1}})
+        self.assertEqual(receive(), {'type': 'comment.deleted', 'comment': {'id': comment.id, 'parent': None}})
+
+
+
+@override_settings(REALTIME_LIKE_INTERVAL=0.2)
+class RealtimeStreamTests(FreshViewCountsMixin, SimpleTestCase):
+    # The consumers never query; they close stale connections on disconnect,
+    # which a TestCase transaction would not survive
+    group = article_group(1)
+
+    def setUp(self):
+        self.layer = get_channel_layer()
+        self.addCleanup(async_to_sync(self.layer.flush))
+
+    async def test_websocket_coalesces_likes(self):
+        # channels.testing needs daphne, so the handshake is spelled out
+        communicator = ApplicationCommunicator(application, {
+            'type': 'websocket', 'path': '/ws/articles/1/', 'query_string': b'',
+            'headers': [(b'origin', b'http://localhost:3000')], 'subprotocols': [],
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.accept')
+
+        async def receive_json():
+            return json.loads((await communicator.receive_output())['text'])
+
+        for delta, comments in [(1, {}), (1, {'5': 1}), (-1, {}), (1, {'5': -1})]:
+            await self.layer.group_send(self.group, {'type': 'article.event', 'event': {
+                'type': 'likes', 'article': delta, 'comments': comments}})
+        await self.layer.group_send(self.group, {'type': 'article.event', 'event': {
+            'type': 'comment.deleted', 'comment': {'id': 3, 'parent': None}}})
+        # Other events go straight out; likes come as one update per interval
+        self.assertEqual((await receive_json())['type'], 'comment.deleted')
+        self.assertEqual(await receive_json(), {'type': 'likes', 'article': 2, 'comments': {}})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait()
+
+    async def test_websocket_origins(self):
+        # The frontend's origin, not the backend's own hostnames
+        for origin, accepted in [(b'http://localhost:3000', True), (b'http://localhost', False),
+                                 (b'https://elsewhere.example', False)]:
+            communicator = ApplicationCommunicator(application, {
+                'type': 'websocket', 'path': '/ws/articles/1/', 'query_string': b'',
+                'headers': [(b'origin', origin)], 'subprotocols': [],
+            })
+            await communicator.send_input({'type': 'websocket.connect'})
+            output = await communicator.receive_output()
+            self.assertEqual(output['type'], 'websocket.accept' if accepted else 'websocket.close', origin)
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait()
+
+    async def test_server_sent_events_cross_origin(self):
+        scope = {'type': 'http', 'http_version': '1.1', 'scheme': 'http', 'path': '/api/articles/1/events/',
+                 'query_string': b'', 'headers': [(b'origin', b'https://frontend.example')]}
+        communicator = ApplicationCommunicator(application, {**scope, 'method': 'GET'})
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        headers = {name.lower(): value for name, value in start['headers']}
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+        self.assertEqual(headers[b'content-type'], b'text/event-stream')
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait()
+
+        communicator = ApplicationCommunicator(application, {**scope, 'method': 'OPTIONS', 'headers': [
+            *scope['headers'], (b'access-control-request-method', b'GET')]})
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        headers = {name.lower(): value for name, value in start['headers']}
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+        self.assertIn(b'GET', headers[b'access-control-allow-methods'])
+        await communicator.receive_output()
+        await communicator.wait()
+        self.assertEqual(self.layer.groups.get(self.group, {}), {})
+
+    async def test_server_sent_events(self):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/articles/1/events/', 'query_string': b'', 'headers': [],
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), start['headers'])
+        self.assertEqual((await communicator.receive_output())['body'], b': subscribed\n\n')
+
+        await self.layer.group_send(self.group, {'type': 'article.event', 'event': {
+            'type': 'article.deleted', 'article': 1}})
+        body = (await communicator.receive_output())['body'].decode()
+        self.assertEqual(body, 'event: article.deleted\ndata: {"type": "article.deleted", "article": 1}\n\n')
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait()
+        self.assertEqual(self.layer.groups.get(self.group, {}), {})
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, PASSWORD_HASHERS=FAST_HASHERS, RESPONSE_CACHE_TIMEOUT=0,
+                   VIEW_COUNT_FLUSH_THRESHOLD=None, VIEW_COUNT_FLUSH_INTERVAL=None)
+class AsyncReadViewTests(FreshViewCountsMixin, APITestMixin, TransactionTestCase):
+    # fetch() reads on pool threads with connections of their own, which
+    # only see committed rows
+    def setUp(self):
+        cache.clear()
+        self.readers = self.create_dataset(articles=3, comments=2, depth=2)
+        self.client = APIClient()
+        self.auth = {'Authorization': f'Bearer {token_for(self.readers[0]).access_token}'}
+
+    def compare(self, url, method='get', headers=None):
+        # The async handler must answer exactly like the sync view
+        expected = getattr(self.client, method)(url, headers=headers)
+        match = resolve(url.split('?')[0])
+        view = match.func.cls.as_async_view()
+        request = getattr(AsyncRequestFactory(), method)(url, headers=headers)
+        response = async_to_sync(view)(request, **match.kwargs)
+        response.render()
+        self.assertEqual(response.status_code, expected.status_code, url)
+        data, expected_data = json.loads(response.content), expected.json()
+        if isinstance(data, dict) and 'views' in data:
+            # Every hit counts
+            self.assertEqual(data.pop('views'), expected_data.pop('views') + 1)
+        self.assertEqual(data, expected_data, url)
+        return data
+
+    def test_matches_sync_views(self):
+        article = reverse('article_detail', args=[self.article.id])
+        comments = reverse('comment_list')
+        for url in [reverse('article_list'), reverse('article_list') + '?expand=comments&page_size=2',
+                    reverse('article_list') + '?cursor=&ordering=trending', article, article + '?fields=id,title',
+                    f'{comments}?article={self.article.id}', f'{comments}?article={self.article.id}&fields=id,is_liked',
+                    f'{comments}?user={self.readers[1].id}&limit=2', f'{comments}?parent={self.comment.id}',
+                    reverse('category_list'), reverse('user_profile', args=[self.author.id])]:
+            for headers in [None, self.auth]:
+                self.compare(url, headers=headers)
+        data = self.compare(f'{comments}?article={self.article.id}', headers=self.auth)
+        self.assertTrue(any(comment['is_liked'] for comment in data))
+
+    def test_errors_and_fallbacks(self):
+        self.compare(reverse('article_detail', args=[0]))
+        self.compare(reverse('user_profile', args=[0]))
+        self.compare(reverse('article_list') + '?page=99')
+        self.compare(reverse('article_list') + '?cursor=bogus')
+        # Search and writes run the sync view
+        self.compare(reverse('article_list') + '?search=Article')
+        self.compare(reverse('category_list'), method='post', headers=self.auth)
+
+    async def test_async_middleware(self):
+        # Under ASGI the middleware stack stays on the event loop; queries
+        # on other threads still count towards the request
+        response = await AsyncClient().get(reverse('article_detail', args=[self.article.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            view = ArticleDetailView.as_async_view()
+            await view(AsyncRequestFactory().get(reverse('article_detail', args=[self.article.id])), pk=self.article.id)
+        finally:
+            current.reset(token)
+        self.assertEqual(metrics.queries, 2)
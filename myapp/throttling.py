@@ -0,0 +1,165 @@
+"""Token-bucket throttling for the write-heavy and login endpoints.
+
+A view opts in with ``throttle_scope``; THROTTLE_RATES maps the scope to
+its rates per kind of client: ``'user'`` buckets are keyed on the user id
+(authenticated requests only, read from the token without a query) and
+``'ip'`` buckets on the client address (REST_FRAMEWORK's NUM_PROXIES
+decides how much of X-Forwarded-For to trust; unset, DRF would take the
+header verbatim from the client). A rate of ``'20/m'`` is a
+bucket holding 20 requests that refills at 20 a minute, so short bursts
+pass and sustained traffic is held to the rate. A request takes a token
+from each of its buckets or, when one of them is empty, from none, so a
+refused request does not use up the other limits.
+
+Buckets live in THROTTLE_STORE. LocalMemoryStore counts per process;
+RedisStore (THROTTLE_REDIS_URL) updates each bucket in one Lua script, so
+the limits hold across gunicorn workers. Either way a check is a constant
+number of dictionary or Redis operations and never touches the database.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """'20/m' -> (20, 20 / 60): bucket size and tokens added per second."""
+    count, period = rate.split('/')
+    return int(count), int(count) / PERIODS[period.strip()[0]]
+
+
+class LocalMemoryStore:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second):
+        # Returns (allowed, seconds until a token is available)
+        return self.take_all([(key, capacity, per_second)])
+
+    def take_all(self, buckets):
+        # ``buckets`` holds (key, capacity, per_second); a token is taken
+        # from each of them, or from none when one is empty
+        now = time.monotonic()
+        with self._lock:
+            refilled = []
+            for key, capacity, per_second in buckets:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                refilled.append((key, min(capacity, tokens + (now - updated) * per_second), per_second))
+            allowed = all(tokens >= 1 for _, tokens, _ in refilled)
+            for key, tokens, _ in refilled:
+                self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._buckets) > self.max_entries:
+                # The least recently used bucket; a client coming back
+                # after it was dropped starts with a full one
+                self._buckets.popitem(last=False)
+        if allowed:
+            return True, 0
+        return False, max((1 - tokens) / per_second for _, tokens, per_second in refilled if tokens < 1)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Refill every bucket, take a token from each when all have one and write
+# them back atomically; ARGV is the time, then capacity and refill rate per
+# key. A bucket expires once it would be full again.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local allowed, wait, refilled = 1, 0, {}
+for i, key in ipairs(KEYS) do
+    local capacity, per_second = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * per_second)
+    if tokens < 1 then
+        allowed = 0
+        wait = math.max(wait, (1 - tokens) / per_second)
+    end
+    refilled[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity, per_second = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local tokens = refilled[i] - allowed
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / per_second * 1000) + 1000)
+end
+return {allowed, tostring(wait)}
+"""
+
+
+class RedisStore:
+    prefix = 'throttle:'
+
+    def __init__(self):
+        import redis
+        self.client = redis.Redis.from_url(settings.THROTTLE_REDIS_URL)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, capacity, per_second):
+        return self.take_all([(key, capacity, per_second)])
+
+    def take_all(self, buckets):
+        args = [time.time()]
+        for _, capacity, per_second in buckets:
+            args += [capacity, per_second]
+        allowed, wait = self.script(keys=[self.prefix + key for key, _, _ in buckets], args=args)
+        return bool(allowed), float(wait)
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+@lru_cache(maxsize=None)
+def _load_store(path):
+    return import_string(path)()
+
+
+def get_store():
+    return _load_store(settings.THROTTLE_STORE)
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    if setting in ('THROTTLE_STORE', 'THROTTLE_REDIS_URL', 'THROTTLE_RATES'):
+        _load_store.cache_clear()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        rates = settings.THROTTLE_RATES.get(scope) if scope else None
+        if not rates:
+            return True
+        buckets = []
+        for kind, rate in rates.items():
+            ident = self.client_ident(kind, request)
+            if ident is not None:
+                buckets.append((f'{scope}:{kind}:{ident}', *parse_rate(rate)))
+        if not buckets:
+            return True
+        allowed, self.retry_after = get_store().take_all(buckets)
+        return allowed
+
+    def client_ident(self, kind, request):
+        if kind == 'ip':
+            return self.get_ident(request)
+        if kind == 'user':
+            user = request.user
+            return user.pk if user and user.is_authenticated else None
+        raise ValueError(f'Unknown throttle kind {kind!r}, use user or ip')
+
+    def wait(self):
+        return self.retry_after
@@ -0,0 +1,122 @@
+"""Trending order for articles (``/api/articles/?ordering=trending``).
+
+An article's engagement is its weighted views, likes and comments
+(TRENDING_WEIGHTS); it counts for half as much every
+TRENDING_HALF_LIFE_HOURS of the article's age. The stored score is the log
+of that,
+
+    log(1 + engagement) + ln 2 * (created_at - EPOCH) / half-life
+
+so the decay only depends on when the article was written: scores keep
+their order as time passes and never need rewriting for it. Only new
+engagement moves an article. ``recompute_trending()`` (``manage.py
+recompute_trending`` or the job of the same name) reads the counters of the
+whole table in chunks, scores each chunk with NumPy and writes back only the
+scores that changed. New articles get their score when they are saved; the
+likes, comments and views that come in later are picked up by the job,
+which ``run_jobs`` keeps queued every TRENDING_RECOMPUTE_INTERVAL seconds.
+"""
+import math
+import time
+from datetime import datetime, timezone as dt_timezone
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .jobs import enqueue
+from .models import Article
+from .response_cache import response_cache
+
+EPOCH = datetime(2020, 1, 1, tzinfo=dt_timezone.utc).timestamp()
+# Scores closer than this are left alone (SQLite's julianday() is only
+# good to about a millisecond)
+TOLERANCE = 1e-6
+
+
+def trending_scores(views, likes, comments, created):
+    # ``created`` in seconds since the Unix epoch; NumPy arrays or numbers
+    weights = settings.TRENDING_WEIGHTS
+    engagement = weights['views'] * views + weights['likes'] * likes + weights['comments'] * comments
+    decay = math.log(2) / (settings.TRENDING_HALF_LIFE_HOURS * 3600)
+    return np.log1p(engagement) + (created - EPOCH) * decay
+
+
+def score_article(article):
+    created = article.created_at or timezone.now()
+    return float(trending_scores(article.views, article.like_count, article.comment_count, created.timestamp()))
+
+
+def epoch_sql(column):
+    if connection.vendor == 'sqlite':
+        return f'(julianday({column}) - 2440587.5) * 86400.0'
+    if connection.vendor == 'postgresql':
+        return f'EXTRACT(EPOCH FROM {column})'
+    if connection.vendor == 'mysql':
+        return f'UNIX_TIMESTAMP({column})'
+    raise NotImplementedError(f'No epoch expression for {connection.vendor}')
+
+
+def read_chunk(last_id, ids, chunk_size):
+    """Rows of (id, views, likes, comments, created, score) as a float array."""
+    qn = connection.ops.quote_name
+    columns = ', '.join([qn('id'), qn('views'), qn('like_count'), qn('comment_count'),
+                         epoch_sql(qn('created_at')), qn('trending_score')])
+    sql = f'SELECT {columns} FROM {qn(Article._meta.db_table)} WHERE {qn("id")} > %s'
+    params = [last_id]
+    if ids is not None:
+        sql += f' AND {qn("id")} IN ({", ".join(["%s"] * len(ids))})'
+        params += ids
+    sql += f' ORDER BY {qn("id")} LIMIT %s'
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [chunk_size])
+        return np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+
+
+def read_chunks(ids, chunk_size):
+    if ids is not None:
+        ids = sorted(ids)
+        for start in range(0, len(ids), chunk_size):
+            yield read_chunk(0, ids[start:start + chunk_size], chunk_size)
+        return
+    last_id = 0
+    while True:
+        rows = read_chunk(last_id, None, chunk_size)
+        if len(rows):
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last_id = int(rows[-1, 0])
+
+
+def recompute_trending(ids=None, chunk_size=100000):
+    """Rescore every article (or the given ids); returns what it did.
+
+    Each chunk of ``chunk_size`` rows is one read and, when scores moved,
+    one ``executemany`` UPDATE in its own transaction.
+    """
+    started = time.perf_counter()
+    qn = connection.ops.quote_name
+    update = f'UPDATE {qn(Article._meta.db_table)} SET {qn("trending_score")} = %s WHERE {qn("id")} = %s'
+    visited = updated = 0
+    for rows in read_chunks(ids, chunk_size):
+        scores = trending_scores(rows[:, 1], rows[:, 2], rows[:, 3], rows[:, 4])
+        changed = np.abs(scores - rows[:, 5]) > TOLERANCE
+        if changed.any():
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(update, list(zip(scores[changed].tolist(),
+                                                    rows[changed, 0].astype(np.int64).tolist())))
+        visited += len(rows)
+        updated += int(changed.sum())
+    if updated:
+        # The stored order of article lists changed
+        response_cache.invalidate('articles')
+    return {'articles': visited, 'updated': updated, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def schedule_recompute():
+    # Queues the next run of the job unless one is queued already; the job
+    # calls this when it finishes, run_jobs when it starts and periodically
+    # after that in case a run failed for good
+    interval = settings.TRENDING_RECOMPUTE_INTERVAL
+    if interval is not None:
+        return enqueue('recompute_trending', key='recompute_trending', delay=interval)
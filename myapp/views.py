@@ -1,26 +1,195 @@
+from abc import ABCMeta, abstractmethod
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Case, IntegerField, Value, When
+from django.http import StreamingHttpResponse
+from django.shortcuts import aget_object_or_404
+from django.utils.http import parse_etags
 from rest_framework import generics, permissions, status
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import LimitOffsetPagination, PageNumberPagination
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework_simplejwt.tokens import RefreshToken
-from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework.exceptions import PermissionDenied
-from .models import Category, Article, Comment, Like, UserProfile
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework.exceptions import NotFound, PermissionDenied
+from .models import Category, Article, Comment, Like, RelatedArticles, UserProfile, UserRecommendations
+from .async_views import AsyncReadMixin, fetch, gather
+from .exports import ExportError, aiter_chunks, stream_export
+from .authentication import forget_user_state, full_user, revoke_tokens, token_for
+from .db_router import pinned_to_primary, replica_aliases, replica_reads
+from .images import stored_files
+from .ingest import INGESTS
+from .jobs import enqueue
+from .likes import apply_likes, toggle_like
+from .pagination import KeysetPaginationMixin
+from .response_cache import etag_for, response_cache
+from .search import get_backend
+from .view_counts import view_counts
 from rest_framework.parsers import MultiPartParser, FormParser
-from .serializers import CategorySerializer, ArticleSerializer, CommentSerializer, UserRegistrationSerializer, UserProfileSerializer, UserSerializer,ProfileUpdateSerializer, CommentCreateSerializer
+from .serializers import CategorySerializer, ArticleSerializer, ArticleSummarySerializer, CommentSerializer, UserRegistrationSerializer, UserProfileSerializer, UserSerializer,ProfileUpdateSerializer, CommentCreateSerializer, build_comment_threads
 
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
 
+def parse_list_param(value):
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+class SparseFieldsMixin:
+    # ?fields=a,b picks the rendered fields and ?expand=x,y adds nested
+    # relations; views use get_visible_fields() to shape their querysets
+    def get_field_selection(self):
+        if self.request.method != 'GET':
+            return None, None
+        params = self.request.query_params
+        return parse_list_param(params.get('fields')), parse_list_param(params.get('expand'))
+
+    def get_visible_fields(self):
+        fields, expand = self.get_field_selection()
+        return self.get_serializer_class().visible_field_names(fields, expand)
+
+    def get_serializer(self, *args, **kwargs):
+        fields, expand = self.get_field_selection()
+        kwargs.setdefault('fields', fields)
+        kwargs.setdefault('expand', expand)
+        return super().get_serializer(*args, **kwargs)
+
+class CommentThreadMixin:
+    # ?depth= and ?replies_limit= trim rendered reply trees, capped by the
+    # COMMENT_MAX_DEPTH and COMMENT_REPLIES_PAGE_SIZE settings
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        params = self.request.query_params
+        limits = [
+            ('depth', 'comment_max_depth', settings.COMMENT_MAX_DEPTH),
+            ('replies_limit', 'comment_replies_limit', settings.COMMENT_REPLIES_PAGE_SIZE),
+        ]
+        for param, key, ceiling in limits:
+            value = params.get(param, '')
+            if value.isdigit():
+                context[key] = min(int(value), ceiling)
+        return context
+
+    def get_article_context(self, articles, liked_comment_ids=None):
+        # One like lookup covering the comments of every article rendered
+        context = self.get_serializer_context()
+        if 'comments' in self.get_visible_fields():
+            if liked_comment_ids is None:
+                comment_ids = [comment.id for article in articles for comment in article.comments.all()]
+                liked_comment_ids = Like.objects.liked_comment_ids(self.request.user, comment_ids)
+            context['liked_comment_ids'] = liked_comment_ids
+        return context
+
+    async def aget_article_context(self, articles):
+        if self.request.user.is_authenticated and 'comments' in self.get_visible_fields():
+            return await fetch(self.get_article_context, articles)
+        return self.get_article_context(articles)
+
+class ReplicaReadsMixin:
+    # GET queries may go to a read replica unless the client just wrote
+    # (see db_router.py)
+    def get(self, request, *args, **kwargs):
+        if not replica_aliases() or pinned_to_primary(request):
+            return super().get(request, *args, **kwargs)
+        with replica_reads():
+            return super().get(request, *args, **kwargs)
+
+    async def aget(self, request, *args, **kwargs):
+        if not replica_aliases() or pinned_to_primary(request):
+            return await super().aget(request, *args, **kwargs)
+        with replica_reads():
+            return await super().aget(request, *args, **kwargs)
+
+class CachedResponseMixin:
+    """Serves GET from the response cache and answers If-None-Match with 304.
+
+    Views name the cache tags their data depends on in ``get_cache_tags()``;
+    when any of ``cache_user_fields`` is rendered the entry is kept per user.
+    ``prepare_response_data()`` runs on every request, hit or miss, for the
+    parts of a response that must not be cached. ``aget()`` is the same for
+    async views (see async_views.py).
+    """
+    cache_tags = ()
+    cache_user_fields = set()
+
+    def get_cache_tags(self):
+        return list(self.cache_tags)
+
+    def get_cache_variant(self):
+        user = self.request.user
+        if not self.cache_user_fields or not user.is_authenticated:
+            return None
+        if self.cache_user_fields & set(self.get_visible_fields()):
+            return user.pk
+        return None
+
+    def prepare_response_data(self, data):
+        return data
+
+    def lookup_entry(self, request):
+        if not response_cache.enabled:
+            return None, None, 'BYPASS'
+        key = response_cache.key(request, self.get_cache_tags(), self.get_cache_variant())
+        entry = response_cache.get(key)
+        return key, entry, 'MISS' if entry is None else 'HIT'
+
+    def store_entry(self, key, data):
+        entry = (data, etag_for(data))
+        if key is not None:
+            response_cache.set(key, entry)
+        return entry
+
+    def cached_response(self, request, entry, data, cache_status):
+        cached_data, etag = entry
+        if data is not cached_data:
+            etag = etag_for(data)
+        headers = {'ETag': etag, 'X-Cache': cache_status}
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+    def get(self, request, *args, **kwargs):
+        key, entry, cache_status = self.lookup_entry(request)
+        if entry is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            entry = self.store_entry(key, response.data)
+        return self.cached_response(request, entry, self.prepare_response_data(entry[0]), cache_status)
+
+    async def aget(self, request, *args, **kwargs):
+        key, entry, cache_status = self.lookup_entry(request)
+        if entry is None:
+            response = await super().aget(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            entry = self.store_entry(key, response.data)
+        data = await self.aprepare_response_data(entry[0])
+        return self.cached_response(request, entry, data, cache_status)
+
+    async def aprepare_response_data(self, data):
+        return self.prepare_response_data(data)
+
 class CustomTokenObtainPairView(TokenObtainPairView):
+    throttle_scope = 'token_obtain'
+
     def post(self, request, *args, **kwargs):
-        response = super().post(request, *args, **kwargs)
-        user = User.objects.get(username=request.data['username'])
-        profile, created = UserProfile.objects.get_or_create(user=user)
+        serializer = self.get_serializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        response = Response(serializer.validated_data, status=status.HTTP_200_OK)
+        # Loaded with its profile by UserWithProfileBackend
+        user = serializer.user
+        try:
+            profile = user.profile
+        except UserProfile.DoesNotExist:
+            profile = UserProfile.objects.create(user=user)
         response.data['user'] = {
             'id': user.id,
             'username': user.username,
@@ -29,17 +198,36 @@ class CustomTokenObtainPairView(TokenObtainPairView):
             'profile': UserProfileSerializer(profile).data
         }
         return response
-class UserProfileView(generics.RetrieveAPIView):
+
+class CustomTokenRefreshView(TokenRefreshView):
+    throttle_scope = 'token_refresh'
+
+class UserProfileView(ReplicaReadsMixin, CachedResponseMixin, SparseFieldsMixin, AsyncReadMixin,
+                      generics.RetrieveAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.AllowAny]
     lookup_field = 'id'
+
+    def get_cache_tags(self):
+        return [f"user:{self.kwargs['id']}"]
+
+    def get_queryset(self):
+        if 'profile' in self.get_visible_fields():
+            return self.queryset.select_related('profile')
+        return self.queryset
+
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await aget_object_or_404(self.get_queryset(), id=self.kwargs['id'])
+        return Response(self.get_serializer(instance).data)
 class RegisterView(APIView):
+    throttle_scope = 'register'
+
     def post(self, request):
         serializer = UserRegistrationSerializer(data=request.data)
         if serializer.is_valid():
             user = serializer.save()
-            refresh = RefreshToken.for_user(user)
+            refresh = token_for(user)
             return Response({
                 'refresh': str(refresh),
                 'access': str(refresh.access_token),
@@ -59,22 +247,22 @@ class ProfileView(APIView):
     parser_classes = [MultiPartParser, FormParser]
 
     def get(self, request):
-        profile = request.user.profile
-        serializer = UserSerializer(request.user, context={'request': request})
+        serializer = UserSerializer(full_user(request.user), context={'request': request})
         return Response(serializer.data)
 
     def put(self, request):
-        profile = request.user.profile
+        user = full_user(request.user)
+        profile = user.profile
         
-        # Handle profile picture
+        # Handle profile picture; the old one and its derivatives are
+        # deleted in the background
+        replaced = []
         if 'profile_picture' in request.data:
+            replaced = stored_files(profile.profile_picture, profile.profile_picture_derivatives)
+            profile.profile_picture_derivatives = {}
             if request.data['profile_picture'] == 'null':
-                if profile.profile_picture:
-                    profile.profile_picture.delete()
                 profile.profile_picture = None
             else:
-                if profile.profile_picture:
-                    profile.profile_picture.delete()
                 profile.profile_picture = request.data['profile_picture']
         
         # Handle bio
@@ -82,17 +270,23 @@ class ProfileView(APIView):
             profile.bio = request.data['bio']
         
         profile.save()
+        if replaced:
+            enqueue('delete_files', replaced)
+        if profile.profile_picture and 'profile_picture' in request.data:
+            enqueue('process_profile_picture', profile.id, key=f'process_profile_picture:{profile.id}')
         
-        serializer = UserSerializer(request.user, context={'request': request})
+        serializer = UserSerializer(user, context={'request': request})
         return Response(serializer.data)
 
-class UserListView(generics.ListAPIView):
+class UserListView(SparseFieldsMixin, generics.ListAPIView):
     permission_classes = [permissions.IsAdminUser]
     serializer_class = UserSerializer
     queryset = User.objects.all().order_by('-date_joined')
     
     def get_queryset(self):
         queryset = super().get_queryset()
+        if 'profile' in self.get_visible_fields():
+            queryset = queryset.select_related('profile')
         search = self.request.query_params.get('search', None)
         if search:
             queryset = queryset.filter(username__icontains=search)
@@ -112,51 +306,151 @@ class CategoryDetailView(generics.RetrieveUpdateDestroyAPIView):
         if instance.article_set.exists():
             raise PermissionDenied("Cannot delete category with associated articles")
         instance.delete()
-class CategoryListView(generics.ListCreateAPIView):
+class CategoryListView(ReplicaReadsMixin, CachedResponseMixin, AsyncReadMixin, generics.ListCreateAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_tags = ['categories']
 
     def get_permissions(self):
         if self.request.method == 'GET':
             return [permissions.AllowAny()]
         return [permissions.IsAdminUser()]
 
-class ArticleListView(generics.ListCreateAPIView):
+    async def alist(self, request, *args, **kwargs):
+        categories = [category async for category in self.filter_queryset(self.get_queryset())]
+        return Response(self.get_serializer(categories, many=True).data)
+
+class ArticleListView(ReplicaReadsMixin, CachedResponseMixin, KeysetPaginationMixin, SparseFieldsMixin,
+                      CommentThreadMixin, AsyncReadMixin, generics.ListCreateAPIView):
     queryset = Article.objects.all().order_by('-created_at')
     serializer_class = ArticleSerializer
     pagination_class = StandardResultsSetPagination
+    cache_user_fields = {'comments'}
+    # ?ordering=; trending reads the stored scores (see trending.py)
+    orderings = {'latest': ('-created_at', '-id'), 'trending': ('-trending_score', '-id')}
+
+    def get_cache_tags(self):
+        # View counts are left to expire with the entries
+        tags = ['articles', 'categories', 'users']
+        if 'comments' in self.get_visible_fields():
+            tags.append('comments')
+        return tags
 
     def get_permissions(self):
         if self.request.method == 'GET':
             return [permissions.AllowAny()]
         return [permissions.IsAuthenticated()]
 
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return ArticleSummarySerializer
+        return ArticleSerializer
+
+    def get_field_selection(self):
+        fields, expand = super().get_field_selection()
+        if expand is not None and self.request.query_params.get('search'):
+            expand = expand + ['snippet']
+        return fields, expand
+
+    def get_keyset_ordering(self):
+        return self.orderings.get(self.request.query_params.get('ordering'), self.orderings['latest'])
+
     def get_queryset(self):
-        queryset = Article.objects.all().order_by('-created_at')
+        queryset = Article.objects.for_fields(self.get_visible_fields())
+        queryset = queryset.order_by(*self.get_keyset_ordering())
         search = self.request.query_params.get('search', None)
         category = self.request.query_params.get('category', None)
         if search:
-            queryset = queryset.filter(Q(title__icontains=search))
+            queryset = self.search(queryset, search)
         if category:
             queryset = queryset.filter(category__id=category)
         return queryset
 
+    def search(self, queryset, query):
+        # Best matches first; keyset pages (?cursor=) stay in time order
+        hits = get_backend().search(query, settings.SEARCH_MAX_RESULTS)
+        self.search_hits = {hit.article_id: hit for hit in hits}
+        if not hits:
+            return queryset.none()
+        rank = Case(*[When(id=hit.article_id, then=Value(position)) for position, hit in enumerate(hits)],
+                    output_field=IntegerField())
+        return queryset.filter(id__in=self.search_hits).order_by(rank, '-created_at')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['search_hits'] = getattr(self, 'search_hits', None)
+        return context
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        articles = list(page if page is not None else queryset)
+        serializer = self.get_serializer(articles, many=True, context=self.get_article_context(articles))
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    @classmethod
+    def async_get_supported(cls, request):
+        # Search goes through the search backend's own queries
+        return not request.GET.get('search')
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = await fetch(self.paginate_queryset, queryset)
+        articles = page if page is not None else await fetch(list, queryset)
+        context = await self.aget_article_context(articles)
+        serializer = self.get_serializer(articles, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-class ArticleDetailView(generics.RetrieveUpdateDestroyAPIView):
+class ArticleDetailView(ReplicaReadsMixin, CachedResponseMixin, SparseFieldsMixin, CommentThreadMixin,
+                        AsyncReadMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Article.objects.all()
     serializer_class = ArticleSerializer
     parser_classes = [MultiPartParser, FormParser]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    cache_user_fields = {'comments'}
+
+    def get_cache_tags(self):
+        return [f"article:{self.kwargs['pk']}", 'categories', 'users']
+
+    def get_queryset(self):
+        if self.request.method == 'GET':
+            return Article.objects.for_fields(self.get_visible_fields())
+        return Article.objects.for_listing()
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
-        instance.views += 1
-        instance.save()
-        serializer = self.get_serializer(instance)
+        serializer = self.get_serializer(instance, context=self.get_article_context([instance]))
         return Response(serializer.data)
 
+    async def aretrieve(self, request, *args, **kwargs):
+        # The article with its comments, and which of them the user liked
+        liked = None
+        if request.user.is_authenticated and 'comments' in self.get_visible_fields():
+            comment_ids = Comment.objects.filter(article_id=self.kwargs['pk']).values('id')
+            liked = fetch(Like.objects.liked_comment_ids, request.user, comment_ids)
+        instance, liked_comment_ids = await gather(fetch(self.get_object), liked)
+        context = self.get_article_context([instance], liked_comment_ids)
+        return Response(self.get_serializer(instance, context=context).data)
+
+    def prepare_response_data(self, data):
+        # Views are buffered and flushed in batches (which invalidates the
+        # entry); show the count including this hit
+        pending = view_counts.record(int(self.kwargs['pk']))
+        if 'views' not in data:
+            return data
+        return {**data, 'views': data['views'] + pending}
+
+    async def aprepare_response_data(self, data):
+        # Recording a view may flush the buffer
+        return await sync_to_async(self.prepare_response_data)(data)
+
     def perform_update(self, serializer):
         # Only allow the author or admin to update
         if self.request.user == serializer.instance.author or self.request.user.is_staff:
@@ -179,14 +473,67 @@ class ArticleDetailView(generics.RetrieveUpdateDestroyAPIView):
         
         return Response(serializer.data)
 
+class RecommendedArticlesMixin(SparseFieldsMixin, CommentThreadMixin, metaclass=ABCMeta):
+    # Serves a stored list of article ids (see recommendations.py) in its
+    # order: one lookup for the list and one for the articles
+    serializer_class = ArticleSummarySerializer
+    pagination_class = None
+    cache_user_fields = {'comments'}
+
+    @abstractmethod
+    def get_article_ids(self):
+        pass
+
+    def list(self, request, *args, **kwargs):
+        ids = self.get_article_ids()
+        found = Article.objects.for_fields(self.get_visible_fields()).in_bulk(ids)
+        articles = [found[pk] for pk in ids if pk in found]
+        serializer = self.get_serializer(articles, many=True, context=self.get_article_context(articles))
+        return Response(serializer.data)
+
+class RelatedArticlesView(ReplicaReadsMixin, CachedResponseMixin, RecommendedArticlesMixin, generics.ListAPIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get_cache_tags(self):
+        return ['recommendations', 'articles', 'categories', 'users']
+
+    def get_article_ids(self):
+        related = RelatedArticles.objects.filter(article_id=self.kwargs['pk']).values_list('article_ids', flat=True)
+        ids = related.first()
+        if ids is None:
+            # Not scored yet, or no such article
+            if not Article.objects.filter(id=self.kwargs['pk']).exists():
+                raise NotFound()
+            return []
+        return ids
+
+class RecommendationsView(ReplicaReadsMixin, CachedResponseMixin, RecommendedArticlesMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    cache_tags = ['recommendations', 'articles', 'categories', 'users']
+
+    def get_cache_variant(self):
+        return self.request.user.pk
+
+    def get_article_ids(self):
+        recommended = UserRecommendations.objects.filter(user=self.request.user).values_list('article_ids', flat=True)
+        ids = recommended.first()
+        if not ids:
+            # Nothing liked yet: what is trending
+            ids = list(Article.objects.order_by('-trending_score', '-id')
+                       .values_list('id', flat=True)[:settings.RECOMMENDATIONS_TOP_K])
+        return ids
+
 # Update the CommentCreateView
 class CommentCreateView(generics.CreateAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentCreateSerializer  # Use the new serializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'comment_create'
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        # The counter signals run in the same transaction as the insert
+        with transaction.atomic():
+            serializer.save(user=self.request.user)
 
     def create(self, request, *args, **kwargs):
         try:
@@ -197,27 +544,109 @@ class CommentCreateView(generics.CreateAPIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-class CommentListView(generics.ListAPIView):
+class CommentTreeMixin(CommentThreadMixin):
+    # Fetches every comment of the affected articles in one flat query and
+    # assembles the reply trees in memory
+    def get_thread(self, comments):
+        return self.get_article_thread({comment.article_id for comment in comments})
+
+    def get_article_thread(self, article_ids):
+        thread = Comment.objects.for_listing().select_related('article')
+        return list(thread.filter(article_id__in=article_ids).order_by('parent_id', 'created_at'))
+
+    def get_tree_data(self, comments, thread=None, liked_comment_ids=None):
+        # ``thread`` and ``liked_comment_ids`` may be fetched up front for
+        # the articles involved; they are looked up here otherwise
+        context = self.get_serializer_context()
+        fields = self.get_visible_fields()
+        if liked_comment_ids is not None:
+            context['liked_comment_ids'] = liked_comment_ids
+        if 'replies' not in fields:
+            if 'is_liked' in fields and liked_comment_ids is None:
+                context['liked_comment_ids'] = Like.objects.liked_comment_ids(
+                    self.request.user, [comment.id for comment in comments])
+            return self.get_serializer(comments, many=True, context=context).data
+        if thread is None:
+            thread = self.get_thread(comments)
+        return build_comment_threads(comments, thread, context, fields)
+
+class RepliesPagination(LimitOffsetPagination):
+    # Only kicks in when ?limit= is given, e.g. ?parent=<id>&limit=20&offset=20
+    # to page through the replies of one thread
+    max_limit = 100
+
+class CommentListView(ReplicaReadsMixin, CachedResponseMixin, KeysetPaginationMixin, SparseFieldsMixin,
+                      CommentTreeMixin, AsyncReadMixin, generics.ListAPIView):
     serializer_class = CommentSerializer
+    pagination_class = RepliesPagination
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    cache_tags = ['comments', 'users']
+    cache_user_fields = {'is_liked'}
 
     def get_queryset(self):
         article_id = self.request.query_params.get('article')
         user_id = self.request.query_params.get('user')
+        parent_id = self.request.query_params.get('parent')
         
-        queryset = Comment.objects.all()
+        queryset = Comment.objects.for_listing()
         if article_id:
             queryset = queryset.filter(article_id=article_id)
         if user_id:
             queryset = queryset.filter(user_id=user_id)
+        if parent_id:
+            # Replies of one thread, oldest first like in the nested trees
+            queryset = queryset.filter(parent_id=parent_id)
+            return queryset.select_related('article', 'user').order_by('created_at', 'id')
         
         return queryset.select_related('article', 'user').order_by('-created_at')
+
+    def get_keyset_ordering(self):
+        if self.request.query_params.get('parent'):
+            return ('created_at', 'id')
+        return ('-created_at', '-id')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        data = self.get_tree_data(list(page if page is not None else queryset))
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        article_id = request.query_params.get('article', '')
+        if not article_id.isdigit():
+            page = await fetch(self.paginate_queryset, queryset)
+            comments = page if page is not None else await fetch(list, queryset)
+            data = await fetch(self.get_tree_data, comments)
+        else:
+            # The page, the article's reply threads and its liked comments
+            # do not depend on each other
+            fields = self.get_visible_fields()
+            thread = liked = None
+            if 'replies' in fields:
+                thread = fetch(self.get_article_thread, [article_id])
+            if request.user.is_authenticated and fields & {'replies', 'is_liked'}:
+                comment_ids = Comment.objects.filter(article_id=article_id).values('id')
+                liked = fetch(Like.objects.liked_comment_ids, request.user, comment_ids)
+            page, thread, liked = await gather(fetch(self.paginate_queryset, queryset), thread, liked)
+            comments = page if page is not None else await fetch(list, queryset)
+            data = self.get_tree_data(comments, thread, liked if liked is not None else set())
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
 # Add to views.py
-class CommentDetailView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Comment.objects.all()
+class CommentDetailView(SparseFieldsMixin, CommentTreeMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def get_queryset(self):
+        return Comment.objects.for_listing().select_related('article')
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.get_tree_data([self.get_object()])[0])
+
     def get_permissions(self):
         if self.request.method == 'GET':
             return [permissions.AllowAny()]
@@ -234,35 +663,118 @@ class CommentDetailView(generics.RetrieveUpdateDestroyAPIView):
 
     def perform_destroy(self, instance):
         if self.request.user == instance.user or self.request.user.is_staff:
-            instance.delete()
+            with transaction.atomic():
+                instance.delete()
         else:
             raise PermissionDenied("You don't have permission to delete this comment")
 
+def parse_like_item(data):
+    # -> (key, target_id, liked) or None when the item is malformed
+    if not isinstance(data, dict):
+        return None
+    keys = [key for key in ('article_id', 'comment_id') if data.get(key) not in (None, '')]
+    if len(keys) != 1:
+        return None
+    liked = data.get('liked')
+    if liked is not None and not isinstance(liked, bool):
+        return None
+    try:
+        return keys[0], int(data[keys[0]]), liked
+    except (TypeError, ValueError):
+        return None
+
 class LikeView(APIView):
+    """Toggle a like, or apply a batch of like changes.
+
+    ``{"article_id": 1}`` or ``{"comment_id": 2}`` flips the like and
+    returns the new state and count. ``{"likes": [{"article_id": 1,
+    "liked": true}, {"comment_id": 2}, ...]}`` sets (or, without ``liked``,
+    toggles) many likes in one transaction, e.g. to sync offline actions.
+    """
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'like'
 
     def post(self, request):
-        article_id = request.data.get('article_id')
-        comment_id = request.data.get('comment_id')
-        
-        if article_id:
-            like, created = Like.objects.get_or_create(
-                user=request.user,
-                article_id=article_id,
-                defaults={'comment': None}
+        if 'likes' in request.data:
+            return self.post_bulk(request)
+
+        item = parse_like_item(request.data)
+        if item is None or item[2] is not None:
+            return Response(
+                {'error': 'Provide exactly one of article_id or comment_id'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        key, target_id, _ = item
+        liked, likes = toggle_like(request.user, key, target_id)
+        return Response(
+            {key: target_id, 'liked': liked, 'likes': likes},
+            status=status.HTTP_201_CREATED if liked else status.HTTP_200_OK
+        )
+
+    def post_bulk(self, request):
+        entries = request.data.get('likes')
+        if not isinstance(entries, list) or len(entries) > settings.LIKE_BULK_MAX_ITEMS:
+            return Response(
+                {'error': f'likes must be a list of at most {settings.LIKE_BULK_MAX_ITEMS} items'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            if not created:
-                like.delete()
-        elif comment_id:
-            like, created = Like.objects.get_or_create(
-                user=request.user,
-                comment_id=comment_id,
-                defaults={'article': None}
+        items = [parse_like_item(entry) for entry in entries]
+        invalid = [index for index, item in enumerate(items) if item is None]
+        if invalid:
+            return Response(
+                {'error': 'Each item needs one of article_id or comment_id and an optional boolean liked',
+                 'invalid_items': invalid},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            if not created:
-                like.delete()
-        
-        return Response(status=status.HTTP_201_CREATED)
+        return Response({'results': apply_likes(request.user, items)})
+
+class ExportView(APIView):
+    """Streams every article, comment or user as NDJSON, CSV or Parquet.
+
+    ``?as=ndjson|csv|parquet`` picks the format; ``category``, ``author``
+    and ``since``/``until`` (ISO dates) filter the rows, and ``cursor`` (the
+    last id received) resumes an interrupted export.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, resource):
+        params = request.query_params
+        file_format = params.get('as', 'ndjson')
+        try:
+            chunks, content_type = stream_export(
+                resource, file_format, category=params.get('category'), author=params.get('author'),
+                since=params.get('since'), until=params.get('until'), cursor=params.get('cursor'),
+            )
+        except ExportError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(request._request, ASGIRequest):
+            chunks = aiter_chunks(chunks)
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{resource}.{file_format}"'
+        return response
+
+class IngestView(APIView):
+    """Bulk-creates articles or comments from an NDJSON request body.
+
+    Rows are validated and written in chunks; a bad row is reported with its
+    line number and does not stop the others. ``?chunk_size=`` overrides the
+    chunk size and ``?create_categories=0`` rejects unknown category names.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request, resource):
+        if resource not in INGESTS:
+            return Response({'error': f'Unknown resource {resource!r}, choose from {", ".join(INGESTS)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            chunk_size = int(request.query_params.get('chunk_size') or 0) or None
+        except ValueError:
+            return Response({'error': 'chunk_size must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        ingest = INGESTS[resource](default_user=request.user, chunk_size=chunk_size,
+                                   create_categories=request.query_params.get('create_categories') != '0')
+        stream = request.stream
+        report = ingest.run(iter(stream.readline, b'') if stream is not None else [])
+        return Response(report, status=status.HTTP_201_CREATED if report['created'] else status.HTTP_200_OK)
 
 class SuspendUserView(APIView):
     permission_classes = [permissions.IsAdminUser]
@@ -275,7 +787,10 @@ class SuspendUserView(APIView):
                     {'error': 'Cannot suspend admin users'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            user_id = user.id
             user.delete()
+            # Tokens already issued to the user stop authenticating
+            forget_user_state(user_id)
 
             return Response(
                 {'message': f'User account {"suspended" if not user.is_active else "activated"}'},
@@ -300,6 +815,8 @@ class MakeAdminView(APIView):
                 )
             user.is_staff = True
             user.save()
+            # Tokens claiming is_staff=false are refreshed
+            revoke_tokens(user.id)
             return Response(
                 {'message': f'User {user.username} is now an admin'},
                 status=status.HTTP_200_OK
@@ -2,6 +2,9 @@
 ASGI config for myproject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Besides the Django views, with the hot read endpoints mounted as async views
+(myapp/async_views.py), it serves live article updates (myapp/realtime.py)
+over WebSockets and Server-Sent Events.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -10,7 +13,22 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
+# Hot read endpoints as async views (myapp/async_views.py)
+os.environ.setdefault('ASYNC_READ_VIEWS', 'True')
 
-application = get_asgi_application()
+# Set up Django before the consumers import models
+django_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.security.websocket import OriginValidator  # noqa: E402
+from django.conf import settings  # noqa: E402
+from myapp.routing import http_urlpatterns, websocket_urlpatterns  # noqa: E402
+
+application = ProtocolTypeRouter({
+    'http': URLRouter([*http_urlpatterns, re_path(r'', django_application)]),
+    # Browsers on the frontend's origins, not only on ALLOWED_HOSTS
+    'websocket': OriginValidator(URLRouter(websocket_urlpatterns), settings.REALTIME_ALLOWED_ORIGINS),
+})
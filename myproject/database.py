@@ -0,0 +1,88 @@
+"""DATABASES built from the environment.
+
+DATABASE_URL                  primary database (dj-database-url syntax); the
+                              SQLite file db.sqlite3 when unset
+DATABASE_REPLICA_URLS         comma-separated read replicas, registered as
+                              replica_0, replica_1, ... (see myapp/db_router.py)
+DATABASE_CONN_MAX_AGE         seconds a connection is reused across requests
+DATABASE_POOL_MAX_SIZE        PostgreSQL: use psycopg's connection pool of up to
+                              this many connections instead of persistent ones
+DATABASE_POOL_MIN_SIZE        PostgreSQL: connections the pool keeps open
+DATABASE_DISABLE_SERVER_SIDE_CURSORS
+                              PostgreSQL: set to True behind PgBouncer in
+                              transaction pooling mode
+SQLITE_BUSY_TIMEOUT           seconds a connection waits for the write lock
+SQLITE_MMAP_SIZE              bytes of the database file read through mmap
+"""
+import os
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def sqlite_options():
+    pragmas = [
+        # Readers no longer block the writer (and the other way round)
+        'PRAGMA journal_mode=WAL',
+        # Durable in WAL mode except on power loss; no fsync per commit
+        'PRAGMA synchronous=NORMAL',
+        f"PRAGMA mmap_size={env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)}",
+        'PRAGMA temp_store=MEMORY',
+    ]
+    return {
+        # Writers queue for the lock instead of failing with "database is locked"
+        'timeout': env_int('SQLITE_BUSY_TIMEOUT', 20),
+        # Take the write lock when a transaction starts: a deferred one that
+        # reads first cannot wait for the lock when it later writes
+        'transaction_mode': 'IMMEDIATE',
+        'init_command': ';'.join(pragmas),
+    }
+
+
+def database_config(url, conn_max_age):
+    if url.startswith('sqlite:///'):
+        # Local files, e.g. a primary and a replica to try routing with
+        config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': url[len('sqlite:///'):],
+                  'CONN_MAX_AGE': conn_max_age, 'CONN_HEALTH_CHECKS': True}
+    else:
+        import dj_database_url
+        config = dj_database_url.parse(url, conn_max_age=conn_max_age, conn_health_checks=True)
+    if config['ENGINE'] == 'django.db.backends.sqlite3':
+        config['OPTIONS'] = sqlite_options()
+    elif config['ENGINE'] == 'django.db.backends.postgresql':
+        pool_size = env_int('DATABASE_POOL_MAX_SIZE', 0)
+        if pool_size:
+            # Pooled connections are returned after every request; Django
+            # refuses persistent connections together with a pool
+            config['CONN_MAX_AGE'] = 0
+            config.setdefault('OPTIONS', {})['pool'] = {
+                'min_size': env_int('DATABASE_POOL_MIN_SIZE', 2), 'max_size': pool_size, 'timeout': 10,
+            }
+        config['DISABLE_SERVER_SIDE_CURSORS'] = os.environ.get('DATABASE_DISABLE_SERVER_SIDE_CURSORS') == 'True'
+    return config
+
+
+def database_settings(base_dir):
+    conn_max_age = env_int('DATABASE_CONN_MAX_AGE', 60)
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        databases = {'default': database_config(url, conn_max_age)}
+    else:
+        databases = {'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': base_dir / 'db.sqlite3',
+            'OPTIONS': sqlite_options(),
+            'CONN_MAX_AGE': conn_max_age,
+            'CONN_HEALTH_CHECKS': True,
+            # A file rather than the shared in-memory default, so tests can
+            # exercise real concurrent connections
+            'TEST': {'NAME': base_dir / 'test_db.sqlite3'},
+        }}
+    replicas = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    for i, replica_url in enumerate(replicas):
+        config = database_config(replica_url.strip(), conn_max_age)
+        # Tests read the primary through the replica aliases
+        config['TEST'] = {'MIRROR': 'default'}
+        databases[f'replica_{i}'] = config
+    return databases
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 from datetime import timedelta
+from .database import database_settings
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,17 +44,21 @@ INSTALLED_APPS = [
     'corsheaders',
     'rest_framework',
     'rest_framework_simplejwt',
+    'channels',
 ]
 CORS_ALLOW_ALL_ORIGINS = True
 MIDDLEWARE = [
+    'myapp.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'myapp.middleware.WhiteNoiseMiddleware',
+    'myapp.middleware.MediaMiddleware',
 
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'myapp.middleware.ReadYourWritesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -77,16 +82,20 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'myproject.wsgi.application'
+ASGI_APPLICATION = 'myproject.asgi.application'
+# Mount the hot read endpoints as async views (see myapp/async_views.py);
+# myproject/asgi.py turns this on, WSGI workers keep the sync views
+ASYNC_READ_VIEWS = os.environ.get('ASYNC_READ_VIEWS', 'False') == 'True'
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+# Configured through DATABASE_URL and friends, see myproject/database.py
+DATABASES = database_settings(BASE_DIR)
+DATABASE_ROUTERS = ['myapp.db_router.PrimaryReplicaRouter']
+# After a write a client reads from the primary for this long, so it sees
+# its own changes while the replicas catch up
+DATABASE_READ_YOUR_WRITES_SECONDS = 5
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -136,11 +145,42 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'myapp.authentication.StatelessJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [],
+    'DEFAULT_RENDERER_CLASSES': [
+        'myapp.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Only views with a throttle_scope in THROTTLE_RATES are limited
+    'DEFAULT_THROTTLE_CLASSES': ['myapp.throttling.TokenBucketThrottle'],
+    # Reverse proxies in front of the app: 'ip' throttles trust that many
+    # X-Forwarded-For entries; 0 uses REMOTE_ADDR and ignores the header
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', '0')),
 }
 
+# Token buckets per throttle_scope (see myapp/throttling.py): 'user' limits
+# each authenticated user, 'ip' each client address. Use RedisStore with
+# more than one worker process so they share the buckets.
+THROTTLE_RATES = {
+    'token_obtain': {'ip': '20/m'},
+    'token_refresh': {'ip': '60/m'},
+    'register': {'ip': '10/h'},
+    'comment_create': {'user': '10/m', 'ip': '60/m'},
+    'like': {'user': '60/m', 'ip': '300/m'},
+    'metrics': {'ip': '30/m'},
+}
+THROTTLE_STORE = os.environ.get('THROTTLE_STORE', 'myapp.throttling.LocalMemoryStore')
+THROTTLE_REDIS_URL = os.environ.get('THROTTLE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Requests slower than this are logged to myapp.slow_requests with (up to
+# SLOW_REQUEST_MAX_STATEMENTS of) their SQL; None disables the log
+SLOW_REQUEST_THRESHOLD_MS = 500
+SLOW_REQUEST_MAX_STATEMENTS = 100
+# Bearer token /metrics asks for; without one the endpoint only answers
+# under DEBUG
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=30),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=90),
@@ -171,5 +211,121 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_EXP_CLAIM': 'refresh_exp',
     'SLIDING_TOKEN_LIFETIME': timedelta(days=30),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=90),
+
+    'TOKEN_OBTAIN_SERIALIZER': 'myapp.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'myapp.authentication.ClaimsTokenRefreshSerializer',
 }
+
+AUTHENTICATION_BACKENDS = ['myapp.authentication.UserWithProfileBackend']
+
+# Access tokens carry username, is_staff and an auth version; requests only
+# check the version, cached this many seconds per user (see
+# myapp/authentication.py). Revoking a token clears the cached version, so
+# every worker has to share the cache: with AUTH_STATE_REDIS_URL unset the
+# versions are only cached under DEBUG and otherwise read per request.
+AUTH_STATE_REDIS_URL = os.environ.get('AUTH_STATE_REDIS_URL')
+AUTH_STATE_CACHE_ALIAS = 'auth'
+AUTH_STATE_TTL = 60 if AUTH_STATE_REDIS_URL or DEBUG else 0
+# Comment threads: nested replies are cut off below this many levels and
+# each comment renders at most this many replies (clients page the rest
+# through /api/comments/?parent=<id>&limit=..&offset=..)
+COMMENT_MAX_DEPTH = 8
+COMMENT_REPLIES_PAGE_SIZE = 50
+
+# Article views are buffered in memory and written out in batches once this
+# many hits are pending or this many seconds have passed (None disables)
+VIEW_COUNT_FLUSH_THRESHOLD = 500
+VIEW_COUNT_FLUSH_INTERVAL = 10
+
+# Largest batch accepted by the bulk form of /api/like/
+LIKE_BULK_MAX_ITEMS = 500
+
+# Article search (?search=). None picks SQLite FTS5 on SQLite and plain
+# LIKE matching elsewhere; otherwise a dotted path to a search backend.
+# Only the best SEARCH_MAX_RESULTS matches are paged through.
+SEARCH_BACKEND = None
+SEARCH_MAX_RESULTS = 1000
+SEARCH_PREFIX_ALL_TERMS = False
+
+# ?ordering=trending (see myapp/trending.py): weighted views, likes and
+# comments, counting half as much for every half-life of article age.
+# Rescored by the recompute_trending job, which run_jobs queues every
+# TRENDING_RECOMPUTE_INTERVAL seconds (None: only through `manage.py
+# recompute_trending [--interval N]`).
+TRENDING_WEIGHTS = {'views': 0.05, 'likes': 1.0, 'comments': 2.0}
+TRENDING_HALF_LIFE_HOURS = 36
+TRENDING_RECOMPUTE_INTERVAL = 300
+
+# Live article updates (see myapp/realtime.py) fan out through this channel
+# layer. The in-memory layer only reaches subscribers of the same process;
+# set CHANNEL_REDIS_URL (or any channels layer backend) when writes and
+# subscribers are spread over several workers.
+CHANNEL_REDIS_URL = os.environ.get('CHANNEL_REDIS_URL')
+CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [CHANNEL_REDIS_URL]}}
+    if CHANNEL_REDIS_URL else {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+}
+# Like count changes reach each subscriber at most this often (seconds);
+# idle Server-Sent Event streams get a keep-alive comment this often
+REALTIME_LIKE_INTERVAL = 1
+REALTIME_KEEPALIVE = 15
+# Origins of the browser frontends allowed to open the live-update
+# WebSocket (comma-separated; '*' for any). The event stream follows the
+# CORS settings like the rest of the API.
+REALTIME_ALLOWED_ORIGINS = [origin for origin in os.environ.get(
+    'REALTIME_ALLOWED_ORIGINS', 'http://localhost:3000,http://127.0.0.1:3000').split(',') if origin]
+
+# Related articles and recommendations (see myapp/recommendations.py):
+# RECOMMENDATIONS_TOP_K kept per article and per user, similarity blended
+# from co-likes (this weight) and TF-IDF text (the rest). Rebuilt by
+# `manage.py build_recommendations`; new articles are added by a job queued
+# RECOMMENDATIONS_UPDATE_DELAY seconds after they are created.
+RECOMMENDATIONS_TOP_K = 20
+RECOMMENDATIONS_LIKE_WEIGHT = 0.6
+RECOMMENDATIONS_MAX_FEATURES = 50000
+RECOMMENDATIONS_DIR = BASE_DIR / 'recommendations'
+RECOMMENDATIONS_UPDATE_DELAY = 60
+
+# Local-memory LRU per process; use a shared backend (Redis, Memcached) to
+# share cached responses between workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'jattclan',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'auth': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': AUTH_STATE_REDIS_URL}
+    if AUTH_STATE_REDIS_URL else {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth'},
+}
+
+# Cached public read endpoints (see myapp/response_cache.py); 0 disables
+RESPONSE_CACHE_ALIAS = 'default'
+RESPONSE_CACHE_TIMEOUT = 60
+
+# Resized copies generated for uploaded images (see myapp/images.py);
+# widths larger than the upload are skipped
+THUMBNAIL_DERIVATIVE_WIDTHS = [320, 640, 1280]
+PROFILE_PICTURE_DERIVATIVE_WIDTHS = [64, 128, 256]
+IMAGE_DERIVATIVE_FORMATS = ['webp', 'jpeg']
+IMAGE_DERIVATIVE_QUALITY = 80
+
+# Uploads served by myapp.middleware.MediaMiddleware (see myapp/media.py);
+# names with a content hash are immutable, others are cached for
+# MEDIA_MAX_AGE seconds and revalidated by ETag
+MEDIA_SERVE_DIRS = ['thumbnails', 'profile_pics']
+MEDIA_MAX_AGE = 60
+MEDIA_CACHED_FILES = 4096
+
+# Background jobs (myapp/jobs.py), run by `manage.py run_jobs`. Failed jobs
+# are retried after 1x, 2x, 4x... the base delay (seconds, capped) and
+# running jobs whose worker went away are requeued after JOB_QUEUE_STALE_AFTER.
+# Finished jobs are kept for JOB_QUEUE_KEEP_DONE/_FAILED seconds (None: forever)
+JOB_QUEUE_MAX_ATTEMPTS = 5
+JOB_QUEUE_RETRY_BASE_DELAY = 5
+JOB_QUEUE_RETRY_MAX_DELAY = 600
+JOB_QUEUE_STALE_AFTER = 900
+JOB_QUEUE_POLL_INTERVAL = 1
+JOB_QUEUE_KEEP_DONE = 7 * 24 * 3600
+JOB_QUEUE_KEEP_FAILED = 30 * 24 * 3600
+
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'